@@ -9,10 +9,26 @@ from cartopy.io.img_tiles import OSM
 from matplotlib import pyplot as plt
 from matplotlib.animation import FuncAnimation
 
+from tile_cache import OSM_URL, TILE_CACHE_DIR, TileCache
+
 DATA_DIR = "../data"
 DATA_FILE = pathlib.Path(DATA_DIR, "latest_cleaned_data_sample.pickle")
 STATION_NAMES_FILE = pathlib.Path(DATA_DIR, "latest_station_names.pickle")
 STATION_COORDS_FILE = pathlib.Path(DATA_DIR, "stations_loc.json")
+OSM_TILE_DIR = pathlib.Path(TILE_CACHE_DIR, "osm")
+
+
+class CachedOSM(OSM):
+    """OpenStreetMap imagery, read through a TileCache."""
+
+    def __init__(self, tile_cache, desired_tile_form="RGB"):
+        super().__init__(desired_tile_form=desired_tile_form)
+        self.tile_cache = tile_cache
+
+    def get_image(self, tile):
+        x, y, z = tile
+        img = self.tile_cache.image(z, x, y, self.desired_tile_form)
+        return img, self.tileextent(tile), "lower"
 
 
 df = pd.read_pickle(DATA_FILE)
@@ -27,7 +43,7 @@ start_time = np.datetime64("2016-10-07T00:00:00")
 
 pos = np.array([[v["lon"], v["lat"]] for k, v in station_latlon.items()])
 
-imagery = OSM(desired_tile_form="L")
+imagery = CachedOSM(TileCache(OSM_TILE_DIR, OSM_URL), desired_tile_form="L")
 fig, ax = plt.subplots(
     1, 1, figsize=(10, 10), subplot_kw=dict(projection=imagery.crs)
 )
@@ -1,6 +1,8 @@
 import folium
 
-from trip import Trip
+from chains import BikeIndex, assign_chain_ids
+from routes import fetch_trip_routes
+from trip import TripCollection
 from utils import get_colours
 
 
@@ -10,21 +12,29 @@ class Bike:
 
     def get_trips(self, df, stations):
 
-        routes = [Trip(df, self.id, trip_id, stations) for trip_id in df.index]
+        routes = TripCollection(df, self.id, stations)
         return routes
 
     def get_chains(self, stations):
-        chain_ids = self.bike_rides.chain_id.to_list()
+        if "chain_id" not in self.bike_rides.columns:
+            self.bike_rides = self.bike_rides.assign(
+                chain_id=assign_chain_ids(self.bike_rides)
+            )
         chains = {}
-        for chain_id in chain_ids:
-            chain_rides = self.bike_rides[
-                self.bike_rides["chain_id"] == chain_id
-            ]
+        for chain_id, chain_rides in self.bike_rides.groupby(
+            "chain_id", sort=False
+        ):
             chains[chain_id] = self.get_trips(chain_rides, stations)
         self.chains = chains
 
     def get_story(self, dataset, stations):
-        bike_rides = dataset[dataset["bike_id"] == self.id]
+        """Get the trips and chains of this bike from dataset, which can be
+        a chains.BikeIndex, or a DataFrame of trips, which is slower.
+        """
+        if isinstance(dataset, BikeIndex):
+            bike_rides = dataset.trips(self.id)
+        else:
+            bike_rides = dataset[dataset["bike_id"] == self.id]
         self.bike_rides = bike_rides
         self.get_chains(stations)
 
@@ -32,7 +42,19 @@ class Bike:
         usage = self.bike_rides["duration"].sum()
         return usage
 
-    def visualize_routes(self, key):
+    def visualize_routes(self, key, fetcher=None, store=None):
+        """Save a map of the routes of each chain of this bike. If fetcher,
+        a routes.RouteFetcher, is given, the routes that aren't cached yet
+        are all fetched at once with it first. If store, a
+        routes.RouteStore, is given, routes are cached there rather than
+        one file per trip.
+        """
+        if fetcher is not None:
+            fetch_trip_routes(
+                [trip for chain in self.chains.values() for trip in chain],
+                fetcher,
+                store=store,
+            )
 
         # Create base map
         London = [51.506949, -0.122876]
@@ -43,7 +65,7 @@ class Bike:
             colours = get_colours(len(chain))
 
             for counter, trip in enumerate(chain):
-                trip.get_route(key)
+                trip.get_route(key, store, fetcher)
                 if trip.route == {}:
                     continue
 
@@ -0,0 +1,120 @@
+"""Chains of trips: runs of trips of one bike, each starting where the last
+one ended.
+
+When a trip doesn't start at the station where the previous trip of the
+same bike ended, the bike has been moved in between, by a van or for repair,
+and a new chain begins. `assign_chain_ids` finds the chains of every bike in
+the data at once, by sorting the trips by bike and start date and comparing
+each trip's start station with the previous trip's end station.
+
+A BikeIndex keeps the trips in that order, so that the trips and chains of
+any one bike are found without looking at those of the others.
+"""
+import numpy as np
+import pandas as pd
+
+# Stands in for missing station and bike IDs.
+MISSING_ID = -1
+
+
+def _ids(series):
+    return series.to_numpy(dtype="int64", na_value=MISSING_ID)
+
+
+def _bike_order(df):
+    """Return the order of the trips in df by bike ID, then start date, and
+    the bike IDs in that order.
+    """
+    bike_ids = _ids(df["bike_id"])
+    start_dates = df["start_date"].to_numpy(dtype="datetime64[ns]")
+    # Sort by start date, then stably by bike. The trips are usually close to
+    # sorted by start date already, which the first sort is quick for.
+    order = np.argsort(start_dates.view("int64"), kind="stable")
+    order = order[np.argsort(bike_ids[order], kind="stable")]
+    return order, bike_ids[order]
+
+
+def _sorted_chain_ids(df, order, bike_ids):
+    """Return the chain IDs of the trips in df, in the order of _bike_order."""
+    start_station_ids = _ids(df["start_station_id"])[order]
+    end_station_ids = _ids(df["end_station_id"])[order]
+    breaks = np.ones(len(df), dtype=bool)
+    breaks[1:] = (
+        (bike_ids[1:] != bike_ids[:-1])
+        | (start_station_ids[1:] != end_station_ids[:-1])
+        | (start_station_ids[1:] == MISSING_ID)
+    )
+    breaks |= bike_ids == MISSING_ID
+    return (np.cumsum(breaks, dtype="int64") - 1).astype("int32")
+
+
+def assign_chain_ids(df):
+    """Return a Series of the chain ID of each trip in df, a DataFrame as
+    output by `clean_data.load_clean_data`, with the same index as df.
+
+    Chain IDs are integers from 0, numbered in order of bike ID and start
+    date, with the trips of unknown bike first. A trip of unknown bike, or
+    whose start station or the end station of the trip before it is
+    unknown, begins a new chain.
+    """
+    order, bike_ids = _bike_order(df)
+    chain_ids = np.empty(len(df), dtype="int32")
+    chain_ids[order] = _sorted_chain_ids(df, order, bike_ids)
+    return pd.Series(chain_ids, index=df.index, name="chain_id")
+
+
+class BikeIndex:
+    """The trips of a DataFrame as output by `clean_data.load_clean_data`,
+    sorted by bike ID and start date, with where each bike's trips begin, so
+    that the trips of any bike are one slice of the sorted trips.
+
+    The trips get a chain_id column from `assign_chain_ids`, unless they
+    have one already, in which case its chains should be runs of trips of
+    the sorted trips, as those of `assign_chain_ids` are.
+    """
+
+    def __init__(self, df):
+        order, bike_ids = _bike_order(df)
+        sorted_df = df.iloc[order]
+        if "chain_id" not in sorted_df.columns:
+            sorted_df = sorted_df.assign(
+                chain_id=_sorted_chain_ids(df, order, bike_ids)
+            )
+        self.df = sorted_df
+        unique_ids, starts = np.unique(bike_ids, return_index=True)
+        ends = np.append(starts[1:], len(bike_ids))
+        self.offsets = {
+            bike_id: (start, end)
+            for bike_id, start, end in zip(
+                unique_ids.tolist(), starts.tolist(), ends.tolist()
+            )
+            if bike_id != MISSING_ID
+        }
+
+    def __contains__(self, bike_id):
+        return bike_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def bike_ids(self):
+        return list(self.offsets)
+
+    def trips(self, bike_id):
+        """Return a DataFrame of the trips of bike_id, by start date."""
+        start, end = self.offsets.get(bike_id, (0, 0))
+        return self.df.iloc[start:end]
+
+    def chains(self, bike_id):
+        """Return a dictionary of DataFrames of the trips of each chain of
+        bike_id, by chain ID.
+        """
+        trips = self.trips(bike_id)
+        chain_ids = trips["chain_id"].to_numpy()
+        firsts = np.flatnonzero(np.diff(chain_ids, prepend=-1))
+        lasts = np.append(firsts[1:], len(chain_ids))
+        return {
+            int(chain_ids[first]): trips.iloc[first:last]
+            for first, last in zip(firsts.tolist(), lasts.tolist())
+        }
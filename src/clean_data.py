@@ -1,9 +1,13 @@
+import hashlib
 import json
 import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 # Columns of the CSV files that we need, and some data relate to them.
 COLUMNS = [
@@ -35,16 +39,37 @@ COLUMN_RENAMES = {
     "StartStation Id": "start_station_id",
     "StartStation Name": "start_station_name",
 }
+# Pairs of columns of station IDs and names.
+STATION_COLUMNS = (
+    ("StartStation Id", "StartStation Name"),
+    ("EndStation Id", "EndStation Name"),
+)
+# The types the columns are read as. IDs are nullable integers of the smallest
+# size that fits them, and names and dates are categoricals, since the same few
+# thousand station names, and the same timestamps, are repeated on many rows.
 COLUMN_DTYPES = {
-    "Rental Id": np.float_,
-    "Duration": np.float_,
-    "Bike Id": np.float_,
-    "End Date": str,
-    "EndStation Id": np.float_,
-    "EndStation Name": str,
-    "Start Date": str,
-    "StartStation Id": np.float_,
-    "StartStation Name": str,
+    "Rental Id": "Int32",
+    "Duration": "Int32",
+    "Bike Id": "Int32",
+    "End Date": "category",
+    "EndStation Id": "Int16",
+    "EndStation Name": "category",
+    "Start Date": "category",
+    "StartStation Id": "Int16",
+    "StartStation Name": "category",
+}
+# The types of the columns of the cleaned data.
+CLEAN_DTYPES = {
+    "rental_id": "Int32",
+    "duration": "Int32",
+    "bike_id": "Int32",
+    "end_date": "datetime64[ns]",
+    "end_station_id": "Int16",
+    "end_station_name": "category",
+    "start_date": "datetime64[ns]",
+    "start_station_id": "Int16",
+    "start_station_name": "category",
+    "filename": "category",
 }
 
 # This is the list of station names that were given the same ID as some other
@@ -153,6 +178,19 @@ MISIDED_STATIONS = [
 ]
 MISIDED_STATIONS_FLAT = sum(MISIDED_STATIONS, [])
 
+# The timestamps in the CSV files look like "31/12/2016 23:59:59", sometimes
+# without the seconds. These are the positions of the non-digits in them.
+TIMESTAMP_LENGTH = 19
+TIMESTAMP_SEPARATORS = {2: "/", 5: "/", 10: " ", 13: ":", 16: ":"}
+
+# Default size in bytes of the chunks yielded by iter_clean_data.
+DEFAULT_MAX_CHUNK_MEMORY = 2**30
+
+# Part of the key of every cache entry of load_data_file. Bump it whenever
+# the parsing or the dtypes of the cleaned data change, so that entries
+# written by older code are no longer used.
+CACHE_VERSION = 2
+
 
 def add_station_names(station_names, df, namecolumn, idcolumn):
     """Given a DataFrame df that has df[namecolumn] listing names of stations
@@ -176,93 +214,317 @@ def add_station_names(station_names, df, namecolumn, idcolumn):
         station_names[number] = current_names
 
 
+def parse_timestamps(strings):
+    """Parse an array of strings in the formats "%d/%m/%Y %H:%M" and
+    "%d/%m/%Y %H:%M:%S", which may be mixed, and return a pd.DatetimeIndex.
+
+    The format of each string is told apart by its length, and the fields are
+    read off by their positions, all in one go with numpy. Any strings in
+    neither format are left to pd.to_datetime, and become NaT if it can't
+    parse them either.
+    """
+    strings = np.asarray(strings, dtype=object)
+    lengths = np.fromiter(
+        map(len, strings), dtype=np.int64, count=len(strings)
+    )
+    # One row per string, one column per character, as Unicode code points.
+    chars = (
+        np.asarray(strings, dtype="U{}".format(TIMESTAMP_LENGTH))
+        .view(np.uint32)
+        .reshape(len(strings), TIMESTAMP_LENGTH)
+    )
+    has_seconds = lengths == TIMESTAMP_LENGTH
+    is_fixed = (lengths == TIMESTAMP_LENGTH - 3) | has_seconds
+    for position, separator in TIMESTAMP_SEPARATORS.items():
+        is_separator = chars[:, position] == ord(separator)
+        if position > TIMESTAMP_LENGTH - 4:
+            is_separator |= ~has_seconds
+        is_fixed &= is_separator
+    digits = chars.astype(np.int64) - ord("0")
+    for position in range(TIMESTAMP_LENGTH):
+        if position not in TIMESTAMP_SEPARATORS:
+            is_digit = (digits[:, position] >= 0) & (digits[:, position] <= 9)
+            if position > TIMESTAMP_LENGTH - 4:
+                is_digit |= ~has_seconds
+            is_fixed &= is_digit
+
+    def field(start, stop):
+        value = np.zeros(len(strings), dtype=np.int64)
+        for position in range(start, stop):
+            value = 10 * value + digits[:, position]
+        return value
+
+    # Fill in a valid date for the strings in neither format, so that
+    # pd.to_datetime doesn't choke on them.
+    fields = pd.DataFrame(
+        {
+            "year": np.where(is_fixed, field(6, 10), 1970),
+            "month": np.where(is_fixed, field(3, 5), 1),
+            "day": np.where(is_fixed, field(0, 2), 1),
+            "hour": np.where(is_fixed, field(11, 13), 0),
+            "minute": np.where(is_fixed, field(14, 16), 0),
+            "second": np.where(has_seconds & is_fixed, field(17, 19), 0),
+        }
+    )
+    timestamps = pd.to_datetime(fields, errors="coerce").to_numpy()
+    others = ~is_fixed | np.isnat(timestamps)
+    if others.any():
+        timestamps[others] = pd.to_datetime(
+            strings[others], dayfirst=True, errors="coerce"
+        )
+    return pd.DatetimeIndex(timestamps)
+
+
 def clean_datetime_column(df, colname, roundto="min"):
     """Parse df[colname] from strings to datetime objects, and round the times
     to the nearest minute. df is partially modified in place, but the return
     value should still be used.
+
+    Each distinct string is only parsed once, using `parse_timestamps`, so
+    rows may mix the formats with and without seconds.
     """
-    # A bit of a hacky way to use the first entry to figure out which date
-    # format this file uses. Not super robust, but works for our purposes.
-    if len(df[colname].iloc[0]) > 16:
-        format = "%d/%m/%Y %H:%M:%S"
-    else:
-        format = "%d/%m/%Y %H:%M"
-    df[colname] = pd.to_datetime(df[colname], format=format)
-    df[colname] = df[colname].dt.round(roundto)
+    # Files converted from spreadsheets have their dates parsed already.
+    if pd.api.types.is_datetime64_any_dtype(df[colname]):
+        df[colname] = df[colname].dt.round(roundto)
+        return df
+    # Timestamps repeat a lot, so we parse the distinct ones, and then pick
+    # from them for each row. Columns are read as categoricals, whose
+    # categories are exactly the distinct strings, but files that lacked some
+    # columns were read without types.
+    column = df[colname].astype("category")
+    parsed = parse_timestamps(column.cat.categories).round(roundto)
+    codes = column.cat.codes.to_numpy()
+    # Missing values have code -1, which picks the NaT at the end. There may
+    # be no categories at all, if the whole column is missing.
+    lookup = np.append(
+        parsed.to_numpy(dtype="datetime64[ns]"),
+        np.datetime64("NaT", "ns"),
+    )
+    df[colname] = lookup[codes]
     return df
 
 
-def load_clean_data(bikefolder="./bikes", num_files=None, datapaths=None):
-    """Load the cleaned bike usage data from disk.
-
-    Return a pd.DataFrame and a dictionary mapping station IDs to all names
-    they are known by.
+def list_data_paths(bikefolder="./bikes", num_files=None, zipfolder=None):
+    """Return the paths to all the CSV and Parquet files in bikefolder,
+    followed by all the CSV files inside the zip archives in zipfolder. The
+    latter are zipfile.Path objects, which `read_data_file` knows how to read.
 
     Args:
-      bikefolder: Path to where the data is kept. Default: "./bikes?
-      num_files: Number of data files to load. Default: all (which probably
-      won't fit in memory!)
-      datapaths: A list of filenames to load. Default: all. Overrides the other
-      arguments if set.
+      bikefolder: Path to a folder of CSV files, or None. Default: "./bikes"
+      num_files: Number of paths to return. Default: all
+      zipfolder: Path to a folder of zip archives, or None. Default: None
     """
-    if datapaths is None:
-        # Collect the paths to all the CSV files.
-        datafiles = sorted(os.listdir(bikefolder))
-        if num_files is not None:
-            datafiles = datafiles[:num_files]
+    datapaths = []
+    if bikefolder is not None:
         folderpath = Path(bikefolder)
-        datapaths = [folderpath / Path(file) for file in datafiles]
-        datapaths = [p for p in datapaths if p.suffix == ".csv"]
+        datapaths += [
+            folderpath / Path(file)
+            for file in sorted(os.listdir(bikefolder))
+            if Path(file).suffix in (".csv", ".parquet")
+        ]
+    if zipfolder is not None:
+        folderpath = Path(zipfolder)
+        for file in sorted(os.listdir(zipfolder)):
+            if Path(file).suffix != ".zip":
+                continue
+            with zipfile.ZipFile(folderpath / file) as z:
+                members = sorted(
+                    name for name in z.namelist() if name.endswith(".csv")
+                )
+            datapaths += [
+                zipfile.Path(folderpath / file, at=name) for name in members
+            ]
+    if num_files is not None:
+        datapaths = datapaths[:num_files]
+    return datapaths
 
-    # Initialize a dictionary that will have as keys station ID numbers, and as
-    # values sets that include all the names this station has had in the files.
-    station_allnames = {}
 
-    # Each CSV file will list trips in some time window. We process them
-    # one-by-one, collect all the DataFrames for individual time windows to
-    # `pieces`, and concatenate them at the end.
-    pieces = []
-    # At least one CSV file gives us trouble because it doesn't list station
-    # IDs, only station names. We'll collect the paths to those CSV files to
-    # `problem_paths` and deal with them at the end.
-    problem_paths = []
-    for path in datapaths:
-        print("Processing {}".format(path))
-        try:
-            df = pd.read_csv(
-                path,
-                usecols=COLUMNS,
-                encoding="ISO-8859-2",
-                dtype=COLUMN_DTYPES,
-            )
-        except ValueError:
-            # Some files have missing or abnormaly named columns. We'll deal
-            # with them later.
-            problem_paths.append(path)
-            continue
-        # Drop all rows where all values are missing. There literally are lines
-        # in the CSV files that specify such empty rows.
-        df = df[~df.isna().all(axis=1)]
-        df["filename"] = path
-        # Turn the date columns from strings into datetime objects rounded to
-        # the hour.
-        df = clean_datetime_column(df, "End Date")
-        df = clean_datetime_column(df, "Start Date")
-        pieces.append(df)
+def source_name(path):
+    """Return a Path naming the file at path, which may be a member of a zip
+    archive, in which case it's named as archive.zip/member.csv.
+    """
+    return Path(str(path))
 
-        # Add station names appearing in this file to our collection of names.
-        add_station_names(
-            station_allnames, df, "EndStation Name", "EndStation Id"
+
+def filename_column(path, length):
+    """Return a column of length rows, all with the name of the file at path,
+    as a categorical, so the name is only stored once.
+    """
+    return pd.Categorical.from_codes(
+        np.zeros(length, dtype=np.int8), categories=[str(source_name(path))]
+    )
+
+
+def concat_pieces(pieces):
+    """Concatenate the DataFrames in pieces like pd.concat, but keep the
+    categorical columns categorical, by giving them all the union of their
+    categories. Columns that are categorical in some pieces but not in
+    others are made categorical in all.
+    """
+    pieces = list(pieces)
+    categorical_columns = set()
+    for piece in pieces:
+        categorical_columns.update(
+            column
+            for column, dtype in piece.dtypes.items()
+            if isinstance(dtype, pd.CategoricalDtype)
+        )
+    for column in categorical_columns:
+        columns = [
+            piece[column].astype("category")
+            for piece in pieces
+            if column in piece.columns
+        ]
+        categories = union_categoricals(columns).categories
+        dtype = pd.CategoricalDtype(categories)
+        pieces = [
+            piece.assign(**{column: piece[column].astype(dtype)})
+            if column in piece.columns
+            else piece
+            for piece in pieces
+        ]
+    return pd.concat(pieces)
+
+
+def read_data_file(path, **kwargs):
+    """Call pd.read_csv on the CSV file at path, passing it kwargs. The file
+    may be a zipfile.Path, in which case it's read straight from the archive
+    without extracting it.
+
+    The file may also be a Parquet file converted from a spreadsheet by
+    `download.xlsx_to_parquet`. Then only the usecols and dtype keyword
+    arguments are used, and date columns are left as datetimes.
+    """
+    if source_name(path).suffix == ".parquet":
+        return _read_parquet(
+            path, usecols=kwargs.get("usecols"), dtype=kwargs.get("dtype")
         )
-        add_station_names(
-            station_allnames, df, "StartStation Name", "StartStation Id"
+    if isinstance(path, zipfile.Path):
+        with path.open("rb") as f:
+            return pd.read_csv(f, **kwargs)
+    return pd.read_csv(path, **kwargs)
+
+
+def _read_parquet(path, usecols=None, dtype=None):
+    df = pd.read_parquet(path)
+    if usecols is not None:
+        # Raise the same error as pd.read_csv does.
+        missing = [column for column in usecols if column not in df.columns]
+        if missing:
+            raise ValueError(
+                "Usecols do not match columns, columns expected but not "
+                "found: {}".format(missing)
+            )
+        df = df[usecols]
+    if dtype is not None:
+        df = df.astype(
+            {
+                column: column_dtype
+                for column, column_dtype in dtype.items()
+                if column in df.columns
+                and not pd.api.types.is_datetime64_any_dtype(df[column])
+            }
         )
+    return df
 
-    # Now that we've collected all the different names that the same station
-    # goes by, we'll pick one of them to be the name we'll use. We do this by
-    # just picking the one that is alphabetically first. We'll also make a
-    # dictionary that goes the other way around, for each name it gives the
-    # corresponding station ID.
+
+def _cache_path(cache_dir, path):
+    """Return the path in cache_dir where the cleaned contents of the data
+    file at path are cached. It depends on the path, size and modification
+    time of the file, so that a file that changes gets a new cache entry, and
+    on CACHE_VERSION.
+    """
+    if isinstance(path, zipfile.Path):
+        filepath = path.root.filename
+        member = path.at
+    else:
+        filepath = path
+        member = ""
+    stat = os.stat(filepath)
+    key = json.dumps(
+        [
+            CACHE_VERSION,
+            os.path.abspath(filepath),
+            member,
+            stat.st_size,
+            stat.st_mtime_ns,
+        ]
+    )
+    return Path(cache_dir) / (
+        hashlib.sha1(key.encode()).hexdigest() + ".parquet"
+    )
+
+
+def load_data_file(path, cache_dir=None):
+    """Read the data file at path, and clean it as far as can be done without
+    looking at the other files. Return a pd.DataFrame, or None if the file
+    is missing some of the expected columns, in which case it should be read
+    with `load_problem_file` once all the other files have been read.
+
+    If cache_dir is given, the result is cached there as a Parquet file, and
+    read from there the next time, unless the data file has changed.
+    """
+    if cache_dir is not None:
+        cache_path = _cache_path(cache_dir, path)
+        if cache_path.exists():
+            df = pd.read_parquet(cache_path)
+            df["filename"] = filename_column(path, len(df))
+            return df
+
+    df = _load_data_file(path)
+    if cache_dir is not None and df is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so that a killed run can't leave a
+        # truncated cache entry behind. It's named after the process, so that
+        # runs sharing cache_dir don't write to the same one.
+        tmppath = cache_path.with_suffix(".{}.tmp".format(os.getpid()))
+        df.drop(columns="filename").to_parquet(tmppath, index=False)
+        os.replace(tmppath, cache_path)
+    return df
+
+
+def _load_data_file(path):
+    try:
+        df = read_data_file(
+            path,
+            usecols=COLUMNS,
+            encoding="ISO-8859-2",
+            dtype=COLUMN_DTYPES,
+        )
+    except (ValueError, TypeError):
+        # Some files have missing or abnormaly named columns, or IDs that
+        # don't fit their types, which pandas raises a TypeError for. We'll
+        # deal with them later.
+        return None
+    # Drop all rows where all values are missing. There literally are lines in
+    # the CSV files that specify such empty rows.
+    df = df[~df.isna().all(axis=1)]
+    df["filename"] = filename_column(path, len(df))
+    # Turn the date columns from strings into datetime objects rounded to the
+    # hour.
+    df = clean_datetime_column(df, "End Date")
+    df = clean_datetime_column(df, "Start Date")
+    return df
+
+
+def collect_station_names(station_allnames, df):
+    """Add the station names appearing in df, as returned by
+    `load_data_file`, to the dictionary station_allnames, that has as keys
+    station ID numbers, and as values sets of all the names of that station.
+    """
+    add_station_names(station_allnames, df, "EndStation Name", "EndStation Id")
+    add_station_names(
+        station_allnames, df, "StartStation Name", "StartStation Id"
+    )
+
+
+def pick_station_names(station_allnames):
+    """Given a dictionary of all the names that each station ID goes by, pick
+    one of them to be the name we'll use. Return a dictionary that gives the
+    ID of each name, and one that gives the canonical name for each ID.
+    """
+    # We pick the name that is alphabetically first, skipping the names of
+    # stations that got the ID by mistake.
     station_ids = {}
     station_names = {}
     for k, v in station_allnames.items():
@@ -273,75 +535,114 @@ def load_clean_data(bikefolder="./bikes", num_files=None, datapaths=None):
         station_names[k] = v[0]
         for name in v:
             station_ids[name] = k
+    return station_ids, station_names
 
-    def get_station_id(name):
-        try:
-            return station_ids[name]
-        except KeyError:
-            return np.nan
 
-    def get_station_name(id):
-        try:
-            return station_names[id]
-        except KeyError:
-            return pd.NA
+def load_problem_file(path, station_ids):
+    """Read a data file that `load_data_file` couldn't, because it's missing
+    some of the expected columns. station_ids is a dictionary from station
+    names to IDs, as returned by `pick_station_names`, used to fill in station
+    IDs where they are missing.
+    """
 
-    # Let's deal with the problem cases. They are ones that are missing station
-    # ID columns. They do have the station names though, so we'll use those,
-    # with the above dictionary, to get the IDs.
-    print("Doing the problem cases ({} of them).".format(len(problem_paths)))
-    for path in problem_paths:
-        print(path)
-        df = pd.read_csv(
-            path,
-            encoding="ISO-8859-2",
-        )
-        # Drop all rows where all values are missing. There literally are lines
-        # in the CSV files that specify such empty rows.
-        df = df[~df.isna().all(axis=1)]
-        df["filename"] = path
-        # If one of the expected columns is missing, look for alternative names
-        # for it.
-        for column_name in COLUMNS:
-            if (
-                column_name not in df.columns
-                and column_name in COLUMNS_ALTERNATIVE_NAMES
-            ):
-                for alternative_name in COLUMNS_ALTERNATIVE_NAMES[column_name]:
-                    if alternative_name in df.columns:
-                        df[column_name] = df[alternative_name]
-        # Remove all the columns that we didn't expect.
-        for column_name in df.columns:
-            if column_name not in COLUMNS + ["filename"]:
-                df = df.drop(columns=column_name)
-        # Add a column of station IDs, based on names.
-        if "EndStation Id" not in df.columns:
-            df["EndStation Id"] = df["EndStation Name"].apply(get_station_id)
-        if "StartStation Id" not in df.columns:
-            df["StartStation Id"] = df["StartStation Name"].apply(
-                get_station_id
+    df = read_data_file(
+        path,
+        encoding="ISO-8859-2",
+    )
+    # Drop all rows where all values are missing. There literally are lines in
+    # the CSV files that specify such empty rows.
+    df = df[~df.isna().all(axis=1)]
+    df["filename"] = filename_column(path, len(df))
+    # If one of the expected columns is missing, look for alternative names
+    # for it.
+    for column_name in COLUMNS:
+        if (
+            column_name not in df.columns
+            and column_name in COLUMNS_ALTERNATIVE_NAMES
+        ):
+            for alternative_name in COLUMNS_ALTERNATIVE_NAMES[column_name]:
+                if alternative_name in df.columns:
+                    df[column_name] = df[alternative_name]
+    # Remove all the columns that we didn't expect.
+    for column_name in df.columns:
+        if column_name not in COLUMNS + ["filename"]:
+            df = df.drop(columns=column_name)
+    # Add a column of station IDs, based on names.
+    for id_column, name_column in STATION_COLUMNS:
+        if id_column not in df.columns:
+            df[id_column] = station_ids_from_names(
+                df[name_column], station_ids
             )
-        # Turn the date columns from strings into datetime objects rounded to
-        # the hour.
-        df = clean_datetime_column(df, "End Date")
-        df = clean_datetime_column(df, "Start Date")
-        pieces.append(df)
+    # Turn the date columns from strings into datetime objects rounded to the
+    # hour.
+    df = clean_datetime_column(df, "End Date")
+    df = clean_datetime_column(df, "Start Date")
+    return df
 
-    df = pd.concat(pieces)
 
-    # If station ID isn't there, but name is, fill the ID using the name.
-    filter = ~df["StartStation Name"].isna() & df["StartStation Id"].isna()
-    df.loc[filter, "StartStation Id"] = df.loc[
-        filter, "StartStation Name"
-    ].apply(get_station_id)
-    filter = ~df["EndStation Name"].isna() & df["EndStation Id"].isna()
-    df.loc[filter, "EndStation Id"] = df.loc[filter, "EndStation Name"].apply(
-        get_station_id
+def station_ids_from_names(names, station_ids):
+    """Return a float array of the IDs of the stations named in the Series
+    names, looked up in station_ids, a dictionary from names to IDs, with NaN
+    for unknown names. Each distinct name is only looked up once.
+    """
+    names = names.astype("category")
+    ids_by_code = pd.Series(names.cat.categories, dtype=object).map(
+        station_ids
     )
+    # Code -1 means a missing name, and picks the NaN on the end.
+    ids_by_code = np.append(ids_by_code.to_numpy(dtype=np.float64), np.nan)
+    return ids_by_code[names.cat.codes.to_numpy()]
+
+
+def canonical_station_names(ids, names, station_names):
+    """Return a categorical of the canonical names of the stations with IDs
+    ids, as given by the dictionary station_names, falling back on the
+    corresponding name in names for IDs that aren't in station_names.
+
+    The names are looked up by ID in an array, and the result is built out of
+    category codes, so no strings are handled row by row.
+    """
+    names = names.astype("category")
+    known_ids = [
+        int(id)
+        for id in station_names
+        if isinstance(id, (int, float, np.integer)) and not np.isnan(id)
+    ]
+    known_names = [station_names[id] for id in known_ids]
+    categories = names.cat.categories.union(pd.Index(known_names).unique())
+    names = names.cat.set_categories(categories)
+    # canonical_codes[id] is the category code of the canonical name of
+    # station id, or -1 if there isn't one.
+    canonical_codes = np.full(max(known_ids, default=-1) + 2, -1)
+    canonical_codes[known_ids] = categories.get_indexer(known_names)
+    # IDs out of range, or missing, pick the -1 on the end.
+    id_values = ids.to_numpy(dtype=np.float64, na_value=np.nan)
+    out_of_range = ~(id_values >= 0) | (id_values >= len(canonical_codes) - 1)
+    id_values = np.where(out_of_range, -1, id_values).astype(np.int64)
+    codes = canonical_codes[id_values]
+    codes = np.where(codes >= 0, codes, names.cat.codes.to_numpy())
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def finish_cleaning(df, station_ids, station_names):
+    """Finish cleaning df, made of DataFrames returned by `load_data_file` and
+    `load_problem_file`, using the dictionaries returned by
+    `pick_station_names`: Fill in missing station IDs, drop bad stations,
+    give the stations their canonical names, and rename the columns.
+    Duplicate trips are not dropped.
+    """
+    # If station ID isn't there, but name is, fill the ID using the name.
+    for id_column, name_column in STATION_COLUMNS:
+        filter = df[id_column].isna() & df[name_column].notna()
+        if filter.any():
+            df.loc[filter, id_column] = station_ids_from_names(
+                df.loc[filter, name_column], station_ids
+            )
 
-    # Drop one anomalous ID
-    df = df[df["StartStation Id"] != "Tabletop1"]
-    df["StartStation Id"] = df["StartStation Id"].astype(np.float_)
+    # Drop one anomalous ID. It can only be there if the column was read
+    # without a type, as in files that lacked other columns.
+    if df["StartStation Id"].dtype == object:
+        df = df[df["StartStation Id"] != "Tabletop1"]
 
     # There are stations that have been given the same ID as another, clearly
     # distinct station. We should really create new IDs for them, but we are
@@ -349,18 +650,46 @@ def load_clean_data(bikefolder="./bikes", num_files=None, datapaths=None):
     df = df[~df["EndStation Name"].isin(MISIDED_STATIONS_FLAT)]
     df = df[~df["StartStation Name"].isin(MISIDED_STATIONS_FLAT)]
 
+    df = df.rename(columns=COLUMN_RENAMES)
+    # Make sure every column has the type it should, whatever file it came
+    # from. Files that lacked some columns were read without types, and may
+    # have IDs as floats, or as strings.
+    for column, dtype in CLEAN_DTYPES.items():
+        if df[column].dtype != dtype:
+            if dtype.startswith("Int"):
+                df[column] = nullable_ints(df[column], dtype)
+            else:
+                df[column] = df[column].astype(dtype)
+
     # Convert the station names to the canonical ones.
-    inferred_start_names = df["StartStation Id"].apply(get_station_name)
-    df["StartStation Name"] = df["StartStation Name"].where(
-        inferred_start_names.isna(), other=inferred_start_names
-    )
-    inferred_end_names = df["EndStation Id"].apply(get_station_name)
-    df["EndStation Name"] = df["EndStation Name"].where(
-        inferred_end_names.isna(), other=inferred_end_names
-    )
+    for id_column, name_column in STATION_COLUMNS:
+        id_column = COLUMN_RENAMES[id_column]
+        name_column = COLUMN_RENAMES[name_column]
+        df[name_column] = canonical_station_names(
+            df[id_column], df[name_column], station_names
+        )
+    return df
 
-    df = df.rename(columns=COLUMN_RENAMES)
-    df = df.convert_dtypes()  # Convert floats to ints, with NaN -> NA
+
+def nullable_ints(values, dtype):
+    """Return the Series values as the nullable integer type dtype, with NA
+    for the values that aren't whole numbers within the range of dtype.
+    """
+    numbers = pd.to_numeric(values, errors="coerce").astype(np.float64)
+    info = np.iinfo(dtype.lower())
+    bad = (numbers % 1 != 0) | (numbers < info.min) | (numbers > info.max)
+    return numbers.mask(bad).astype(dtype)
+
+
+def combine_pieces(pieces, station_allnames):
+    """Concatenate the DataFrames returned by `load_data_file` and
+    `load_problem_file` into one, and finish cleaning it, using the dictionary
+    station_allnames of all the names each station ID goes by.
+
+    Return the same as `load_clean_data`.
+    """
+    station_ids, station_names = pick_station_names(station_allnames)
+    df = finish_cleaning(concat_pieces(pieces), station_ids, station_names)
     # TODO Do this for the start date too, and so that it deals with NaTs
     # correctly
     # df = df[df["end_date"] >= datetime(years=2010, month=1, day=1)]
@@ -378,6 +707,268 @@ def load_clean_data(bikefolder="./bikes", num_files=None, datapaths=None):
     return df, station_allnames
 
 
+def _split_path(path):
+    """Return the path to the file on disk that path refers to, and the name
+    of the member of the zip archive if path is a zipfile.Path, else None.
+    Unlike zipfile.Path objects, these can be passed to other processes.
+    """
+    if isinstance(path, zipfile.Path):
+        return path.root.filename, path.at
+    return path, None
+
+
+def _join_path(filepath, member):
+    """The inverse of `_split_path`."""
+    if member is not None:
+        return zipfile.Path(filepath, at=member)
+    return filepath
+
+
+def _load_data_file_job(filepath, member, cache_dir):
+    """Run `load_data_file` in a worker process. Return its output, and the
+    station names appearing in the file, as collected by
+    `collect_station_names`.
+    """
+    df = load_data_file(_join_path(filepath, member), cache_dir)
+    station_allnames = {}
+    if df is not None:
+        collect_station_names(station_allnames, df)
+    return df, station_allnames
+
+
+def _load_problem_file_job(filepath, member, station_ids):
+    """Run `load_problem_file` in a worker process."""
+    return load_problem_file(_join_path(filepath, member), station_ids)
+
+
+def _load_clean_data_parallel(datapaths, cache_dir, n_jobs):
+    """Do the same as `load_clean_data`, but parse the files in n_jobs worker
+    processes.
+    """
+    splitpaths = [_split_path(path) for path in datapaths]
+    station_allnames = {}
+    pieces = []
+    problem_paths = []
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # executor.map returns the results in the order of datapaths, so
+        # everything is collected in the same order as in the serial case.
+        results = executor.map(
+            _load_data_file_job,
+            *zip(*splitpaths),
+            [cache_dir] * len(splitpaths),
+        )
+        for splitpath, (df, file_allnames) in zip(splitpaths, results):
+            print("Processed {}".format(_join_path(*splitpath)))
+            if df is None:
+                problem_paths.append(splitpath)
+                continue
+            pieces.append(df)
+            for number, names in file_allnames.items():
+                station_allnames.setdefault(number, set()).update(names)
+
+        station_ids, _ = pick_station_names(station_allnames)
+        print(
+            "Doing the problem cases ({} of them).".format(len(problem_paths))
+        )
+        pieces += executor.map(
+            _load_problem_file_job,
+            *zip(*problem_paths),
+            [station_ids] * len(problem_paths),
+        )
+
+    return combine_pieces(pieces, station_allnames)
+
+
+def load_clean_data(
+    bikefolder="./bikes",
+    num_files=None,
+    datapaths=None,
+    zipfolder=None,
+    cache_dir=None,
+    n_jobs=None,
+):
+    """Load the cleaned bike usage data from disk.
+
+    Return a pd.DataFrame and a dictionary mapping station IDs to all names
+    they are known by.
+
+    Args:
+      bikefolder: Path to where the data is kept. Default: "./bikes?
+      num_files: Number of data files to load. Default: all (which probably
+      won't fit in memory!)
+      datapaths: A list of filenames to load. Default: all. Overrides the other
+      arguments if set.
+      zipfolder: Path to a folder of zip archives, whose CSV files are read
+      without extracting them. The download script leaves the CSV files of
+      the yearly archives zipped, so without it those years are left out.
+      Default: None
+      cache_dir: Path to a folder where each file is cached after it's been
+      parsed, so that only new or changed files are parsed the next time.
+      Default: None, no caching
+      n_jobs: Number of worker processes to parse the files in, or None to
+      parse them in this process. The result is the same either way.
+      Default: None
+    """
+    if datapaths is None:
+        # Collect the paths to all the CSV files.
+        datapaths = list_data_paths(bikefolder, num_files, zipfolder)
+    if n_jobs is not None:
+        return _load_clean_data_parallel(datapaths, cache_dir, n_jobs)
+
+    # Initialize a dictionary that will have as keys station ID numbers, and as
+    # values sets that include all the names this station has had in the files.
+    station_allnames = {}
+
+    # Each CSV file will list trips in some time window. We process them
+    # one-by-one, collect all the DataFrames for individual time windows to
+    # `pieces`, and concatenate them at the end.
+    pieces = []
+    # At least one CSV file gives us trouble because it doesn't list station
+    # IDs, only station names. We'll collect the paths to those CSV files to
+    # `problem_paths` and deal with them at the end.
+    problem_paths = []
+    for path in datapaths:
+        print("Processing {}".format(path))
+        df = load_data_file(path, cache_dir)
+        if df is None:
+            problem_paths.append(path)
+            continue
+        pieces.append(df)
+        # Add station names appearing in this file to our collection of names.
+        collect_station_names(station_allnames, df)
+
+    # Now that we've collected all the different names that the same station
+    # goes by, we'll pick one of them to be the name we'll use.
+    station_ids, _ = pick_station_names(station_allnames)
+
+    # Let's deal with the problem cases. They are ones that are missing station
+    # ID columns. They do have the station names though, so we'll use those,
+    # with the above dictionary, to get the IDs.
+    print("Doing the problem cases ({} of them).".format(len(problem_paths)))
+    for path in problem_paths:
+        print(path)
+        pieces.append(load_problem_file(path, station_ids))
+
+    return combine_pieces(pieces, station_allnames)
+
+
+class _SeenRentalIds:
+    """The set of rental IDs seen so far, kept as a bitmap that grows as
+    needed, so that it takes one bit per possible ID rather than tens of
+    bytes per ID seen.
+    """
+
+    def __init__(self):
+        self.bits = np.zeros(0, dtype=np.uint8)
+        self.seen_na = False
+
+    def filter_new(self, rental_ids):
+        """Return a boolean array that is True for the rental IDs that
+        haven't been seen before, counting the earlier ones in rental_ids,
+        and mark them all as seen.
+        """
+        isna = rental_ids.isna().to_numpy()
+        ids = rental_ids[~isna].to_numpy(dtype=np.int64)
+        max_id = ids.max(initial=-1)
+        if max_id // 8 >= len(self.bits):
+            bits = np.zeros(max(2 * len(self.bits), max_id // 8 + 1), np.uint8)
+            bits[: len(self.bits)] = self.bits  # noqa: E203
+            self.bits = bits
+        is_new = np.zeros(len(rental_ids), dtype=bool)
+        seen_before = (self.bits[ids // 8] >> (ids % 8)) & 1
+        first_in_chunk = ~pd.Series(ids).duplicated().to_numpy()
+        is_new[~isna] = (seen_before == 0) & first_in_chunk
+        np.bitwise_or.at(
+            self.bits, ids // 8, (1 << (ids % 8)).astype(np.uint8)
+        )
+        # Like drop_duplicates, keep the first row without a rental ID.
+        if isna.any() and not self.seen_na:
+            is_new[np.flatnonzero(isna)[0]] = True
+            self.seen_na = True
+        return is_new
+
+
+def iter_clean_data(
+    bikefolder="./bikes",
+    num_files=None,
+    datapaths=None,
+    zipfolder=None,
+    cache_dir=None,
+    station_allnames=None,
+    max_memory=DEFAULT_MAX_CHUNK_MEMORY,
+):
+    """Like `load_clean_data`, but yield the cleaned data in chunks rather
+    than returning all of it at once, so that it never all needs to be in
+    memory.
+
+    Each chunk is a pd.DataFrame made of the data from one or more files,
+    cleaned like the output of `load_clean_data`, indexed and sorted by
+    rental ID. Trips that are in more than one file are only yielded once.
+    Files are read until their combined size in memory exceeds max_memory,
+    and then yielded as a chunk, so a chunk is only bigger than max_memory if
+    a single file is.
+
+    The canonical station names depend on all the files, so unless
+    station_allnames is given, all the files are read twice: once to collect
+    the station names, and once to yield them. Setting cache_dir makes the
+    second time much faster.
+
+    Args:
+      bikefolder, num_files, datapaths, zipfolder, cache_dir: As for
+      `load_clean_data`.
+      station_allnames: The dictionary of station names returned by
+      `load_clean_data`, if it's known already. Default: None
+      max_memory: Size in bytes of the chunks to yield. Default: 1 GB
+    """
+    if datapaths is None:
+        datapaths = list_data_paths(bikefolder, num_files, zipfolder)
+    if station_allnames is None:
+        station_allnames = {}
+        for path in datapaths:
+            print("Collecting station names from {}".format(path))
+            df = load_data_file(path, cache_dir)
+            if df is not None:
+                collect_station_names(station_allnames, df)
+    station_ids, station_names = pick_station_names(station_allnames)
+
+    seen_rental_ids = _SeenRentalIds()
+
+    def make_chunk(pieces):
+        df = finish_cleaning(concat_pieces(pieces), station_ids, station_names)
+        df = df[seen_rental_ids.filter_new(df["rental_id"])]
+        df = df.sort_values("rental_id")
+        df = df.set_index("rental_id")
+        return df
+
+    # As in load_clean_data, files without station IDs are done last.
+    problem_paths = []
+    pieces = []
+    pieces_memory = 0
+    for path in datapaths:
+        print("Processing {}".format(path))
+        df = load_data_file(path, cache_dir)
+        if df is None:
+            problem_paths.append(path)
+            continue
+        pieces.append(df)
+        pieces_memory += df.memory_usage(deep=True).sum()
+        if pieces_memory >= max_memory:
+            yield make_chunk(pieces)
+            pieces = []
+            pieces_memory = 0
+    for path in problem_paths:
+        print("Processing {}".format(path))
+        df = load_problem_file(path, station_ids)
+        pieces.append(df)
+        pieces_memory += df.memory_usage(deep=True).sum()
+        if pieces_memory >= max_memory:
+            yield make_chunk(pieces)
+            pieces = []
+            pieces_memory = 0
+    if pieces:
+        yield make_chunk(pieces)
+
+
 def clean_station_json(filepath):
     """
     Given an input json files with station information
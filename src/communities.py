@@ -0,0 +1,213 @@
+"""Reproducible community detection, run many times in parallel and cached.
+
+The Louvain method starts from a random node order, so a single run gives a
+different partition each time. `detect_communities` runs it once for each
+seed and resolution, in a pool of worker processes, and picks one of the
+partitions, either the one of highest modularity, or the consensus: the
+partition that agrees most with all the others on which pairs of stations
+go together. The result is cached under a hash of the network's contents,
+so detecting the communities of an unchanged network again costs nothing.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import community
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+DEFAULT_SEEDS = tuple(range(8))
+DEFAULT_RESOLUTIONS = (1.0,)
+SELECTION_METHODS = ("modularity", "consensus")
+# Networks with fewer stations than this are partitioned in this process by
+# default, as a pool of worker processes takes longer to start than the runs.
+PARALLEL_MIN_NODES = 500
+
+
+def network_hash(network):
+    """Return a hash of the station IDs and trip counts of a TripNetwork."""
+    matrix = network.matrix.copy()
+    matrix.sort_indices()
+    digest = hashlib.sha1()
+    for array in (
+        network.node_ids.astype("int64"),
+        matrix.indptr.astype("int64"),
+        matrix.indices.astype("int64"),
+        matrix.data.astype("float64"),
+    ):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def _relabel(labels):
+    """Number the communities in the order they first appear in labels, so
+    that equal partitions have equal labels.
+    """
+    _, first, inverse = np.unique(
+        labels, return_index=True, return_inverse=True
+    )
+    order = np.argsort(np.argsort(first))
+    return order[inverse]
+
+
+def _communities(partition):
+    """Return a list of the sets of nodes of each community of partition, a
+    dictionary of the community of each node.
+    """
+    communities = {}
+    for node, label in partition.items():
+        communities.setdefault(label, set()).add(node)
+    return list(communities.values())
+
+
+def _run_louvain(network, seed, resolution, weight):
+    """Return the community of each node of network from one run of the
+    Louvain method, and the modularity of the partition.
+    """
+    graph = network.symmetrised().to_networkx(directed=False, weight=weight)
+    partition = community.best_partition(
+        graph, weight=weight, resolution=resolution, random_state=seed
+    )
+    # At the resolution of the run, so that runs at different resolutions
+    # are each scored by what they were optimising.
+    modularity = nx.community.modularity(
+        graph,
+        _communities(partition),
+        weight=weight,
+        resolution=resolution,
+    )
+    labels = np.array([partition[node] for node in network.node_ids.tolist()])
+    return _relabel(labels), modularity
+
+
+def _pairs(counts):
+    return (counts * (counts - 1) // 2).sum()
+
+
+def pair_agreement(labels1, labels2):
+    """Return the fraction of pairs of nodes that the two partitions agree
+    on, being in the same community in both or in different ones in both.
+    This is the Rand index.
+    """
+    num_nodes = len(labels1)
+    num_pairs = num_nodes * (num_nodes - 1) // 2
+    if num_pairs == 0:
+        return 1.0
+    _, both = np.unique(
+        np.stack([labels1, labels2]), axis=1, return_counts=True
+    )
+    together_in_both = _pairs(both)
+    together_in_1 = _pairs(np.unique(labels1, return_counts=True)[1])
+    together_in_2 = _pairs(np.unique(labels2, return_counts=True)[1])
+    disagreements = together_in_1 + together_in_2 - 2 * together_in_both
+    return 1 - disagreements / num_pairs
+
+
+def consensus(partitions):
+    """Return the index of the partition with the highest total agreement with
+    all the others, as by `pair_agreement`.
+    """
+    totals = [
+        sum(pair_agreement(labels, other) for other in partitions)
+        for labels in partitions
+    ]
+    return int(np.argmax(totals))
+
+
+def _cache_path(cache_dir, network, seeds, resolutions, method, weight):
+    key = json.dumps(
+        [
+            network_hash(network),
+            [int(seed) for seed in seeds],
+            [float(resolution) for resolution in resolutions],
+            method,
+            weight,
+        ]
+    )
+    return Path(cache_dir) / (hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+
+def detect_communities(
+    network,
+    seeds=DEFAULT_SEEDS,
+    resolutions=DEFAULT_RESOLUTIONS,
+    method="modularity",
+    weight="trip_count",
+    max_workers=None,
+    cache_dir=None,
+):
+    """Return a DataFrame of the community of each station of network, a
+    sparse_network.TripNetwork, with the columns id and partition.
+
+    The Louvain method is run on the symmetrised network once for each
+    combination of seeds and resolutions, and one of the partitions is
+    picked by method.
+
+    Args:
+      seeds: Random seeds for the runs.
+      resolutions: Resolutions for the runs.
+      method: "modularity" to pick the partition of the highest modularity,
+      each at the resolution of its run, or "consensus" to pick the one that
+      agrees most with the others.
+      weight: Name of the edge attribute to hold the trip counts.
+      max_workers: Number of worker processes. If 1, runs in this process.
+      Default: one per CPU, or 1 for networks of fewer than
+      PARALLEL_MIN_NODES stations
+      cache_dir: Path to a folder where results are cached, by the contents
+      of the network and these arguments. Default: None, no caching
+    """
+    if method not in SELECTION_METHODS:
+        raise ValueError(
+            "Unknown method {}, should be one of {}".format(
+                method, SELECTION_METHODS
+            )
+        )
+    if cache_dir is not None:
+        cache_path = _cache_path(
+            cache_dir, network, seeds, resolutions, method, weight
+        )
+        if cache_path.exists():
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            return pd.DataFrame(cached)
+
+    runs = [(seed, res) for res in resolutions for seed in seeds]
+    if max_workers is None and len(network) < PARALLEL_MIN_NODES:
+        max_workers = 1
+    if max_workers == 1 or len(runs) == 1:
+        results = [_run_louvain(network, *run, weight) for run in runs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(
+                    _run_louvain,
+                    [network] * len(runs),
+                    *zip(*runs),
+                    [weight] * len(runs),
+                )
+            )
+    partitions = [labels for labels, _ in results]
+    if method == "modularity":
+        best = int(np.argmax([modularity for _, modularity in results]))
+    else:
+        best = consensus(partitions)
+
+    df_partition = pd.DataFrame(
+        {"id": network.node_ids, "partition": partitions[best]}
+    )
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmppath = cache_path.with_suffix(".{}.tmp".format(os.getpid()))
+        with open(tmppath, "w") as f:
+            json.dump(
+                {
+                    column: df_partition[column].tolist()
+                    for column in df_partition.columns
+                },
+                f,
+            )
+        os.replace(tmppath, cache_path)
+    return df_partition
@@ -1,19 +1,25 @@
-import json
-import pickle
 import re
 
-import community
-import contextily as cx
 import geopandas as gpd
 import networkx as nx
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
-STATION_NAMES_FILE = "../data/station_names_20220615_1137.pickle"
-STATION_COORDS_FILE = "../data/stations_loc.json"
+from src.communities import detect_communities
+from src.sparse_network import TripNetwork
+from src.stations import DATA_DIR, get_registry
+from src.tile_cache import (
+    TILE_CACHE_DIR,
+    TONER_LITE_URL,
+    TileCache,
+    add_basemap,
+)
 
 TRIP_COUNT_THRESHOLD = 1e-5
+COMMUNITY_CACHE_DIR = DATA_DIR / "community_cache"
+BASEMAP_TILE_DIR = TILE_CACHE_DIR / "toner-lite"
+BASEMAP_ZOOM = 13
 MAP_BOUNDARIES = (-0.223, 0.005, 51.46, 51.555)
 FONT_SIZE = 10
 NODE_COLORMAP = "tab10"
@@ -37,77 +43,78 @@ LABEL_STATIONS = [
 
 
 def get_station_name(id):
-    with open(STATION_NAMES_FILE, "rb") as f:
-        station_allnames = pickle.load(f)
-
-    name = sorted(station_allnames[id])[0]
+    name = get_registry().name(id)
+    if name is None:
+        return str(id)
     name = re.split(";|,|:", name)[0].strip()
     return name
 
 
-def create_network_from_data(df, trip_count_threshold):
-    trip_counts = (
-        (
-            df[["start_station_id", "end_station_id", "bike_id"]]
+def count_trips(df):
+    """Return a DataFrame of the number of trips between each pair of
+    stations in df. df can also be an iterable of DataFrames, such as the
+    chunks yielded by clean_data.iter_clean_data, in which case the trips in
+    all of them are counted, one chunk at a time.
+    """
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    trip_counts = None
+    for chunk in chunks:
+        chunk_counts = (
+            chunk[["start_station_id", "end_station_id", "bike_id"]]
             .groupby(["start_station_id", "end_station_id"])
-            .count()
+            .count()["bike_id"]
         )
+        if trip_counts is None:
+            trip_counts = chunk_counts
+        else:
+            trip_counts = trip_counts.add(chunk_counts, fill_value=0)
+    trip_counts = (
+        trip_counts.astype(int)
         .reset_index()
         .rename(columns={"bike_id": "trip_count"})
     )
-    trip_counts = trip_counts.sort_values("trip_count")
-    total_num_trips = trip_counts["trip_count"].sum()
+    return trip_counts
 
-    trip_counts = trip_counts[
-        trip_counts["trip_count"] >= trip_count_threshold * total_num_trips
-    ]
 
-    graph = nx.from_pandas_edgelist(
-        trip_counts,
-        source="start_station_id",
-        target="end_station_id",
-        edge_attr="trip_count",
-        create_using=nx.DiGraph,
+def create_network_from_data(df, trip_count_threshold):
+    return create_network_from_trip_counts(
+        count_trips(df), trip_count_threshold
     )
 
-    return graph
 
+def create_network_from_trip_counts(trip_counts, trip_count_threshold):
+    """Return the sparse_network.TripNetwork of the trip counts, as output by
+    `count_trips` or `od_cube.ODCube.edge_list`, leaving out the edges with
+    fewer than trip_count_threshold times the total number of trips.
+    """
+    network = TripNetwork.from_trip_counts(trip_counts)
+    return network.threshold(trip_count_threshold)
 
-def get_node_info(graph):
-    with open(STATION_COORDS_FILE, "r") as f:
-        station_latlon = json.load(f)
 
-    nodes = graph.nodes()
+def get_node_info(network):
+    registry = get_registry()
+    nodes = network.node_ids
 
-    pos = [station_latlon[str(int(node))] for node in nodes]
-    pos = [(p["lon"], p["lat"]) for p in pos]
+    pos = [registry.location(node) for node in nodes]
+    pos = [(lon, lat) for lat, lon in pos]
 
-    station_sizes = [i[1] for i in list(graph.degree(weight="trip_count"))]
+    station_sizes = network.strength()
 
     labels = [get_station_name(int(node)) for node in nodes]
 
     nodes_df = pd.DataFrame(
-        {"id": list(nodes), "pos": pos, "size": station_sizes, "name": labels}
+        {"id": nodes, "pos": pos, "size": station_sizes, "name": labels}
     )
 
     return nodes_df
 
 
-def network_community_detection(graph, edge_weight):
-    graph_undirected = nx.Graph()
-    undirected_edges = set(sorted(graph.edges))
-    for edge in undirected_edges:
-        reverse_edge = (edge[1], edge[0])
-        trip_count = graph.edges[edge][edge_weight]
-        if reverse_edge in graph.edges:
-            trip_count += graph.edges[reverse_edge][edge_weight]
-        graph_undirected.add_edge(edge[0], edge[1], trip_count=trip_count)
-
-    partition = community.best_partition(graph_undirected, weight=edge_weight)
-    df_partition = pd.DataFrame(partition, index=[0]).T.reset_index()
-    df_partition.columns = ["id", "partition"]
-
-    return df_partition
+def network_community_detection(network, edge_weight, **kwargs):
+    """Return a DataFrame of the community of each station in network. The
+    keyword arguments are passed on to `communities.detect_communities`.
+    """
+    kwargs.setdefault("cache_dir", COMMUNITY_CACHE_DIR)
+    return detect_communities(network, weight=edge_weight, **kwargs)
 
 
 def visualise_network_map(network, node_info_df):
@@ -130,34 +137,70 @@ def _scale_range(values, min_scaled, max_scaled):
     return scaled
 
 
-def _drop_stations_without_location(graph):
-    with open(STATION_COORDS_FILE, "r") as f:
-        station_latlon = json.load(f)
-    nodes = tuple(graph.nodes)
-    stations_with_location = tuple(map(int, station_latlon.keys()))
-    for n in nodes:
-        if n not in stations_with_location:
-            print(f"Removing node {n} because of missing location data.")
-            graph.remove_node(n)
-    return None
+def drop_stations_without_location(network):
+    """Return network without the stations whose locations aren't known."""
+    registry = get_registry()
+    keep = np.array([registry.has_location(n) for n in network.node_ids])
+    for n in network.node_ids[~keep]:
+        print(f"Removing node {n} because of missing location data.")
+    return network.keep_nodes(keep)
 
 
 def create_network_and_map(
-    df,
+    df=None,
+    allow_self_loops=False,
+    min_edge_width=MIN_EDGE_WIDTH,
+    min_edge_alpha=MIN_EDGE_ALPHA,
+    arrows=True,
+    trip_counts=None,
+    community_kwargs=None,
+    tile_cache=None,
+):
+    """Plot the network of the trips in df on a map, with its stations
+    coloured by community. Instead of df, the trip counts between stations
+    can be given, as output by `count_trips` or `od_cube.ODCube.edge_list`.
+    The other arguments are as for `map_network`.
+    """
+    if trip_counts is None:
+        trip_counts = count_trips(df)
+    community_network = create_network_from_trip_counts(
+        trip_counts, TRIP_COUNT_THRESHOLD
+    )
+    community_network = drop_stations_without_location(community_network)
+    return map_network(
+        community_network,
+        allow_self_loops=allow_self_loops,
+        min_edge_width=min_edge_width,
+        min_edge_alpha=min_edge_alpha,
+        arrows=arrows,
+        community_kwargs=community_kwargs,
+        tile_cache=tile_cache,
+    )
+
+
+def map_network(
+    community_network,
     allow_self_loops=False,
     min_edge_width=MIN_EDGE_WIDTH,
     min_edge_alpha=MIN_EDGE_ALPHA,
     arrows=True,
+    community_kwargs=None,
+    tile_cache=None,
 ):
-    community_graph = create_network_from_data(df, TRIP_COUNT_THRESHOLD)
-    _drop_stations_without_location(community_graph)
-    nodes_info = get_node_info(community_graph)
-    visualisation_graph = community_graph.copy()
+    """Plot community_network, a sparse_network.TripNetwork whose stations
+    all have known locations, on a map, with its stations coloured by
+    community. community_kwargs are passed on to
+    `network_community_detection`. The basemap is drawn from tile_cache, a
+    tile_cache.TileCache, by default one of Stamen Toner Lite tiles in
+    BASEMAP_TILE_DIR.
+    """
+    nodes_info = get_node_info(community_network)
+    visualisation_network = community_network
     if not allow_self_loops:
-        visualisation_graph.remove_edges_from(
-            nx.selfloop_edges(community_graph)
-        )
-    community_df = network_community_detection(community_graph, "trip_count")
+        visualisation_network = community_network.without_self_loops()
+    community_df = network_community_detection(
+        community_network, "trip_count", **(community_kwargs or {})
+    )
     nodes_info = nodes_info.merge(community_df, on="id")
     nodes_info = nodes_info.sort_values(by="size", ascending=False)
     del community_df
@@ -177,9 +220,9 @@ def create_network_and_map(
 
     fig, ax = plt.subplots(1, 1, figsize=(20, 10))
     nodes_info.plot(ax=ax)
-    cx.add_basemap(
-        ax, crs=nodes_info.crs, source=cx.providers.Stamen.TonerLite
-    )
+    if tile_cache is None:
+        tile_cache = TileCache(BASEMAP_TILE_DIR, TONER_LITE_URL)
+    add_basemap(ax, tile_cache, BASEMAP_ZOOM)
 
     xynps = [
         np.array([p[0] for p in nodes_info["pos"]]),
@@ -190,16 +233,13 @@ def create_network_and_map(
     }
 
     sizes = _scale_range(nodes_info["size"], MIN_NODE_SIZE, MAX_NODE_SIZE)
-    weights = np.array(
-        [
-            visualisation_graph.edges[e]["trip_count"]
-            for e in visualisation_graph.edges
-        ]
-    )
+    sources, targets, weights = visualisation_network.edges()
+    edgelist = list(zip(sources.tolist(), targets.tolist()))
     weights = _scale_range(weights, min_edge_width, MAX_EDGE_WIDTH)
     edge_alpha = _scale_range(weights, min_edge_alpha, MAX_EDGE_ALPHA)
 
     # Plots
+    visualisation_graph = visualisation_network.to_networkx()
     nx.draw_networkx_nodes(
         visualisation_graph,
         pos=pos,
@@ -213,6 +253,7 @@ def create_network_and_map(
     nx.draw_networkx_edges(
         visualisation_graph,
         pos=pos,
+        edgelist=edgelist,
         edge_color=EDGE_COLOUR,
         width=weights,
         alpha=edge_alpha,
@@ -0,0 +1,158 @@
+"""Build, partition and plot the networks of many slices of the trips at once.
+
+The trips are counted once, into an od_cube.ODCube, and the edge list of
+each slice is taken from the cube. The slices are then partitioned into
+communities and plotted in a pool of worker processes, each writing an SVG
+file, and a summary of all of them is written as JSON.
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+
+import matplotlib
+from matplotlib import pyplot as plt
+
+from src.network import (
+    TRIP_COUNT_THRESHOLD,
+    create_network_from_trip_counts,
+    drop_stations_without_location,
+    map_network,
+)
+from src.od_cube import ODCube
+
+SUMMARY_FILENAME = "network_summary.json"
+
+
+class Slice(NamedTuple):
+    """A slice of the trips to make a map of, by start date. The map is
+    saved as latest_{name}_map.svg. The time conditions are as for
+    `od_cube.ODCube.edge_list`, and allow_self_loops and arrows as for
+    `network.map_network`.
+    """
+
+    name: str
+    title: str
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    hours: Optional[Tuple[int, ...]] = None
+    weekdays: Optional[Tuple[int, ...]] = None
+    months: Optional[Tuple[int, ...]] = None
+    allow_self_loops: bool = False
+    arrows: bool = True
+
+
+def slice_edge_lists(trips, slices):
+    """Return a list of the edge list of each of slices. trips may be an
+    ODCube, or anything that `ODCube.from_trips` takes.
+    """
+    cube = trips if isinstance(trips, ODCube) else ODCube.from_trips(trips)
+    return [
+        cube.edge_list(
+            trip_slice.start,
+            trip_slice.end,
+            trip_slice.hours,
+            trip_slice.weekdays,
+            trip_slice.months,
+        )
+        for trip_slice in slices
+    ]
+
+
+def _init_worker():
+    matplotlib.use("Agg")
+
+
+def _map_slice(
+    trip_slice, trip_counts, output_dir, community_kwargs, tile_cache
+):
+    """Partition and plot the network of one slice in a worker process, and
+    return a summary of it.
+    """
+    start_time = time.perf_counter()
+    network = drop_stations_without_location(
+        create_network_from_trip_counts(trip_counts, TRIP_COUNT_THRESHOLD)
+    )
+    fig, ax, nodes_info = map_network(
+        network,
+        allow_self_loops=trip_slice.allow_self_loops,
+        arrows=trip_slice.arrows,
+        community_kwargs=community_kwargs,
+        tile_cache=tile_cache,
+    )
+    ax.set_title(trip_slice.title)
+    path = os.path.join(
+        output_dir, "latest_{}_map.svg".format(trip_slice.name)
+    )
+    fig.savefig(path)
+    plt.close(fig)
+    return {
+        "name": trip_slice.name,
+        "title": trip_slice.title,
+        "path": path,
+        "num_trips": int(trip_counts["trip_count"].sum()),
+        "num_nodes": len(nodes_info),
+        "num_edges": network.num_edges,
+        "num_communities": int(nodes_info["partition"].nunique()),
+        "map_seconds": time.perf_counter() - start_time,
+    }
+
+
+def run_network_batch(
+    trips,
+    slices,
+    output_dir=".",
+    max_workers=None,
+    community_kwargs=None,
+    tile_cache=None,
+):
+    """Make the map of each of slices, in output_dir, and write a summary of
+    them to SUMMARY_FILENAME there. Return the summary: a dictionary of the
+    time taken to compute the edge lists, and a list of a dictionary for
+    each slice, of its numbers of trips, nodes, edges and communities, and
+    the time taken to partition and plot it.
+
+    Args:
+      trips: An ODCube, or anything that `ODCube.from_trips` takes.
+      slices: List of Slices.
+      output_dir: Folder to write the maps and the summary to.
+      max_workers: Number of worker processes. If 1, runs in this process.
+      Default: one per CPU
+      community_kwargs: Keyword arguments for
+      `network.network_community_detection`. Default: run the detection of
+      each slice in its worker process only
+      tile_cache: tile_cache.TileCache to draw the basemaps from. Seed it
+      beforehand, or make it offline, so that the workers don't all fetch
+      the same tiles. Default: as for `network.map_network`
+    """
+    if community_kwargs is None:
+        community_kwargs = {"max_workers": 1}
+    os.makedirs(output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    edge_lists = slice_edge_lists(trips, slices)
+    edge_list_seconds = time.perf_counter() - start_time
+
+    args = (
+        slices,
+        edge_lists,
+        [output_dir] * len(slices),
+        [community_kwargs] * len(slices),
+        [tile_cache] * len(slices),
+    )
+    if max_workers == 1:
+        slice_summaries = list(map(_map_slice, *args))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker
+        ) as executor:
+            slice_summaries = list(executor.map(_map_slice, *args))
+    summary = {
+        "edge_list_seconds": edge_list_seconds,
+        "slices": slice_summaries,
+    }
+    with open(os.path.join(output_dir, SUMMARY_FILENAME), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
@@ -0,0 +1,242 @@
+"""A sparse origin-destination cube of trip counts.
+
+Counting the trips between each pair of stations means grouping all the
+trips, for every map. The ODCube counts them once, by start station, end
+station, month, weekday and hour of the start date, keeping only the cells
+that have any trips. The trip counts of any slice of time made of whole
+months, weekdays and hours are then sums of cells, which are much fewer than
+the trips.
+
+Each cell is identified by its fields packed into one int64 key, with the
+station pair in the most significant bits, so that sorting the keys sorts
+the cells by station pair.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from src.trip_query import calendar_columns, lookup_table
+
+# Bits of each field of a cell key, from the least significant.
+HOUR_BITS = 5
+WEEKDAY_BITS = 3
+MONTH_BITS = 12
+STATION_BITS = 16
+WEEKDAY_SHIFT = HOUR_BITS
+MONTH_SHIFT = WEEKDAY_SHIFT + WEEKDAY_BITS
+END_SHIFT = MONTH_SHIFT + MONTH_BITS
+START_SHIFT = END_SHIFT + STATION_BITS
+# Months are counted from January of this year.
+FIRST_YEAR = 2000
+CELL_COLUMNS = [
+    "start_station_id",
+    "end_station_id",
+    "year",
+    "month",
+    "weekday",
+    "hour",
+]
+
+
+def _month_number(year, month):
+    return (year - FIRST_YEAR) * 12 + month - 1
+
+
+def _field(keys, shift, bits):
+    return (keys >> shift) & ((1 << bits) - 1)
+
+
+def _pack(start_station_id, end_station_id, month_number, weekday, hour):
+    keys = start_station_id.astype("int64") << START_SHIFT
+    keys |= end_station_id.astype("int64") << END_SHIFT
+    keys |= month_number.astype("int64") << MONTH_SHIFT
+    keys |= weekday.astype("int64") << WEEKDAY_SHIFT
+    keys |= hour.astype("int64")
+    return keys
+
+
+def _aggregate(keys, counts):
+    """Return the sorted unique keys, and the sum of counts for each."""
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+    return keys, counts.astype("int64")
+
+
+def _trip_keys(df):
+    """Return the cell keys of the trips in df that have a start date and
+    both station IDs. Trips whose station IDs or start dates are out of the
+    range of the cube are left out too, with a warning.
+    """
+    start = df["start_station_id"].to_numpy(dtype="float64", na_value=np.nan)
+    end = df["end_station_id"].to_numpy(dtype="float64", na_value=np.nan)
+    dates = df["start_date"].to_numpy(dtype="datetime64[ns]")
+    calendar = calendar_columns(dates)
+    month_number = _month_number(
+        calendar["year"].astype("int64"), calendar["month"].astype("int64")
+    )
+    valid = ~(np.isnan(start) | np.isnan(end) | np.isnat(dates))
+    # Comparisons with NaN are False, so missing values aren't counted here.
+    out_of_range = valid & (
+        (start < 0)
+        | (start >= 1 << STATION_BITS)
+        | (end < 0)
+        | (end >= 1 << STATION_BITS)
+        | (month_number < 0)
+        | (month_number >= 1 << MONTH_BITS)
+    )
+    if out_of_range.any():
+        logging.warning(
+            "Leaving out {} trips whose station IDs or start dates are out "
+            "of the range of the cube".format(out_of_range.sum())
+        )
+        valid &= ~out_of_range
+    return _pack(
+        start[valid],
+        end[valid],
+        month_number[valid],
+        calendar["weekday"][valid],
+        calendar["hour"][valid],
+    )
+
+
+class ODCube:
+    """Numbers of trips by start station, end station, month, weekday and
+    hour. Build one with `ODCube.from_trips`.
+    """
+
+    def __init__(self, keys=None, counts=None):
+        if keys is None:
+            keys = np.zeros(0, dtype="int64")
+            counts = np.zeros(0, dtype="int64")
+        self.keys = keys
+        self.counts = counts
+        self._pairs = keys >> END_SHIFT
+
+    @classmethod
+    def from_trips(cls, df):
+        """Count the trips in df, a DataFrame as output by
+        `clean_data.load_clean_data`, or an iterable of them, such as the
+        chunks yielded by `clean_data.iter_clean_data`.
+        """
+        cube = cls()
+        cube.update(df)
+        return cube
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, df):
+        """Add the trips in df, as for `from_trips`, to the counts."""
+        chunks = [df] if isinstance(df, pd.DataFrame) else df
+        keys = [self.keys]
+        counts = [self.counts]
+        for chunk in chunks:
+            chunk_keys, chunk_counts = np.unique(
+                _trip_keys(chunk), return_counts=True
+            )
+            keys.append(chunk_keys)
+            counts.append(chunk_counts)
+        self.keys, self.counts = _aggregate(
+            np.concatenate(keys), np.concatenate(counts)
+        )
+        self._pairs = self.keys >> END_SHIFT
+
+    def mask(
+        self, start=None, end=None, hours=None, weekdays=None, months=None
+    ):
+        """Return a boolean mask of the cells of the trips that started in
+        [start, end), and in one of the given hours (0-23), weekdays (0 is
+        Monday) and months (1-12). None means any. start and end must be the
+        starts of months, since the cube doesn't go finer than that.
+        """
+        mask = np.ones(len(self.keys), dtype=bool)
+        month_numbers = _field(self.keys, MONTH_SHIFT, MONTH_BITS)
+        for date, keep in ((start, np.greater_equal), (end, np.less)):
+            if date is None:
+                continue
+            date = pd.Timestamp(date)
+            if date != date.normalize() or date.day != 1:
+                raise ValueError(
+                    "The cube can only be sliced at the starts of months, "
+                    "not at {}".format(date)
+                )
+            mask &= keep(month_numbers, _month_number(date.year, date.month))
+        if months is not None:
+            month_of_year = (month_numbers % 12 + 1).astype("uint8")
+            mask &= lookup_table(months)[month_of_year]
+        for values, shift, bits in (
+            (hours, 0, HOUR_BITS),
+            (weekdays, WEEKDAY_SHIFT, WEEKDAY_BITS),
+        ):
+            if values is not None:
+                field = _field(self.keys, shift, bits).astype("uint8")
+                mask &= lookup_table(values)[field]
+        return mask
+
+    def edge_list(
+        self, start=None, end=None, hours=None, weekdays=None, months=None
+    ):
+        """Return the number of trips between each pair of stations in a
+        slice of time, given as for `mask`, as a DataFrame like that of
+        `network.count_trips`.
+        """
+        mask = self.mask(start, end, hours, weekdays, months)
+        pairs = self._pairs[mask]
+        counts = self.counts[mask]
+        # The cells are sorted by station pair, so the cells of each pair
+        # are next to each other.
+        if len(pairs):
+            firsts = np.flatnonzero(np.diff(pairs, prepend=-1))
+            pairs = pairs[firsts]
+            counts = np.add.reduceat(counts, firsts)
+        return pd.DataFrame(
+            {
+                "start_station_id": pairs >> STATION_BITS,
+                "end_station_id": _field(pairs, 0, STATION_BITS),
+                "trip_count": counts,
+            }
+        )
+
+    def to_frame(self):
+        """Return the cells as a DataFrame with the columns CELL_COLUMNS and
+        trip_count.
+        """
+        month_numbers = _field(self.keys, MONTH_SHIFT, MONTH_BITS)
+        return pd.DataFrame(
+            {
+                # Station IDs take up to STATION_BITS bits, unsigned.
+                "start_station_id": (self.keys >> START_SHIFT).astype(
+                    "uint16"
+                ),
+                "end_station_id": _field(
+                    self.keys, END_SHIFT, STATION_BITS
+                ).astype("uint16"),
+                "year": (month_numbers // 12 + FIRST_YEAR).astype("int16"),
+                "month": (month_numbers % 12 + 1).astype("uint8"),
+                "weekday": _field(
+                    self.keys, WEEKDAY_SHIFT, WEEKDAY_BITS
+                ).astype("uint8"),
+                "hour": _field(self.keys, 0, HOUR_BITS).astype("uint8"),
+                "trip_count": self.counts,
+            }
+        )
+
+    def save(self, path):
+        """Save the cube as a Parquet file."""
+        self.to_frame().to_parquet(path, index=False)
+
+    @classmethod
+    def load(cls, path):
+        df = pd.read_parquet(path, columns=CELL_COLUMNS + ["trip_count"])
+        keys = _pack(
+            df["start_station_id"].to_numpy(),
+            df["end_station_id"].to_numpy(),
+            _month_number(
+                df["year"].to_numpy().astype("int64"),
+                df["month"].to_numpy().astype("int64"),
+            ),
+            df["weekday"].to_numpy(),
+            df["hour"].to_numpy(),
+        )
+        return cls(*_aggregate(keys, df["trip_count"].to_numpy()))
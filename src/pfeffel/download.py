@@ -1,15 +1,28 @@
+import argparse
+import contextlib
+import hashlib
+import json
 import logging
 import os
 import shutil
+import threading
 import time
+import warnings
 import zipfile
-from typing import List
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import pandas as pd
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
 from tqdm.auto import tqdm
+from urllib3.util.retry import Retry
 
 try:
     import xlrd  # noqa: F401
@@ -30,71 +43,442 @@ PROJECT_ROOT = os.path.abspath(
 )
 CONFIG_FPATH = os.path.join(PROJECT_ROOT, "config.yaml")
 
+# Defaults for the concurrent downloader. Five requests per second per host
+# matches the old blanket 0.2 second sleep between calls.
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Every download directory gets a manifest of the files in it.
+MANIFEST_FILENAME = "manifest.json"
+CHUNK_SIZE = 1024 * 1024
+# Columns of the spreadsheets that hold dates.
+XLSX_DATE_COLUMNS = ("Start Date", "End Date")
 
-def download_file(output_dir: str, url: str, sleep_seconds: float = 0) -> str:
-    """Download the data from the given URL into the datafolder, unless it's
-    already there. Return path to downloaded file.
+
+class HostRateLimiter:
+    """Hand out request slots so that no single host is sent more than
+    `requests_per_second` requests per second, summed over all the threads
+    sharing this limiter. A `requests_per_second` of None means no limit.
+    """
+
+    def __init__(self, requests_per_second: Optional[float]) -> None:
+        if requests_per_second:
+            self.min_interval = 1.0 / requests_per_second
+        else:
+            self.min_interval = 0.0
+        self._next_slot: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        """Block until the host of `url` may be sent another request."""
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def make_session(
+    pool_size: int = DEFAULT_MAX_WORKERS,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+) -> requests.Session:
+    """Make a requests.Session whose connection pool is big enough for
+    `pool_size` threads, and that retries connection errors and transient
+    HTTP errors with exponential backoff.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Manifest:
+    """A record of every file downloaded into a directory: its size, SHA-256
+    checksum, and the ETag and Last-Modified headers it was served with.
+
+    The manifest lives in MANIFEST_FILENAME inside the directory, and is
+    rewritten atomically every time an entry changes, so that a killed run
+    never leaves it half-written. Entries of files that are still being
+    downloaded have "complete" set to False; their validators are used to
+    make sure a resumed download continues the same version of the file.
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def get(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            return self.entries.get(filename)
+
+    def set(self, filename: str, entry: dict) -> None:
+        with self._lock:
+            self.entries[filename] = entry
+            tmppath = self.path + ".tmp"
+            with open(tmppath, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmppath, self.path)
+
+
+def file_sha256(filepath: str) -> str:
+    """Return the hex SHA-256 checksum of the file at `filepath`."""
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _validators(rqst: requests.Response) -> dict:
+    return {
+        "etag": rqst.headers.get("ETag"),
+        "last_modified": rqst.headers.get("Last-Modified"),
+    }
+
+
+def _conditional_headers(entry: dict, range_start: int = 0) -> dict:
+    """Return the headers for a GET request that only transfers data if the
+    file has changed since `entry` was recorded, and if `range_start` is
+    positive, only the bytes from `range_start` onwards.
+    """
+    headers = {}
+    if range_start:
+        headers["Range"] = "bytes={}-".format(range_start)
+        # If the file has changed since the part we have was downloaded, the
+        # server should ignore the range and send us all of it.
+        validator = entry.get("etag") or entry.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+    else:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def _download_file(
+    output_dir: str,
+    url: str,
+    session: Optional[requests.Session] = None,
+    rate_limiter: Optional[HostRateLimiter] = None,
+    manifest: Optional[Manifest] = None,
+    refresh: bool = False,
+    verify: bool = False,
+) -> Tuple[str, int]:
+    """Download `url` into `output_dir`, unless it's already there. Return
+    the path to the file and the number of bytes transferred.
+
+    See `download_file` for what the arguments do.
     """
     os.makedirs(output_dir, exist_ok=True)
+    if session is None:
+        session = requests.Session()
+    if manifest is None:
+        manifest = Manifest(output_dir)
+
+    def request(method, headers=None):
+        if rate_limiter is not None:
+            rate_limiter.wait(url)
+        return session.request(
+            method,
+            url,
+            headers=headers,
+            timeout=DEFAULT_TIMEOUT,
+            stream=method == "GET",
+        )
 
     a = urlparse(url)
     filename = os.path.basename(a.path)
     filepath = os.path.join(output_dir, filename)
-    # Don't redownload if we already have this file.
+    partpath = filepath + ".part"
+    entry = manifest.get(filename)
+
+    if os.path.exists(filepath):
+        size = os.path.getsize(filepath)
+        if entry is None:
+            # A file from before we kept a manifest. Adopt it if it's as big
+            # as the server says it should be, otherwise resume it.
+            head = request("HEAD")
+            head.raise_for_status()
+            expected_size = head.headers.get("Content-Length")
+            if expected_size is not None and int(expected_size) == size:
+                entry = dict(
+                    _validators(head),
+                    size=size,
+                    sha256=file_sha256(filepath),
+                    complete=True,
+                )
+                manifest.set(filename, entry)
+            else:
+                logging.info("{} looks truncated".format(filename))
+                entry = dict(_validators(head), complete=False)
+                os.replace(filepath, partpath)
+        elif entry.get("complete") and entry.get("size") == size:
+            if verify and file_sha256(filepath) != entry.get("sha256"):
+                logging.info("{} fails its checksum".format(filename))
+                entry = None
+                os.remove(filepath)
+            elif not refresh:
+                logging.debug("Already have {}".format(filename))
+                return filepath, 0
+        elif entry.get("complete") and size < entry.get("size", 0):
+            # Probably truncated after it was downloaded. Resume it, as long
+            # as the server still has the same version.
+            logging.info("{} looks truncated".format(filename))
+            entry = dict(entry, complete=False)
+            os.replace(filepath, partpath)
+        else:
+            logging.info("{} has the wrong size".format(filename))
+            entry = None
+            os.remove(filepath)
+
+    range_start = 0
+    if os.path.exists(partpath):
+        if entry is not None and not entry.get("complete"):
+            range_start = os.path.getsize(partpath)
+        else:
+            os.remove(partpath)
+
     if os.path.exists(filepath):
-        logging.debug("Already have {}".format(filename))
+        logging.debug("Checking {} for updates".format(filename))
+        headers = _conditional_headers(entry)
+    elif range_start:
+        logging.info("Resuming {} from byte {}".format(filename, range_start))
+        headers = _conditional_headers(entry, range_start)
     else:
         logging.info("Downloading {}".format(filename))
-        rqst = requests.get(url)
+        headers = {}
+
+    # The body is streamed to disk in chunks, so that we never hold a whole
+    # archive in memory.
+    nbytes = 0
+    with request("GET", headers=headers) as rqst:
+        if rqst.status_code == 304:
+            logging.debug("{} has not changed".format(filename))
+            return filepath, 0
+        if rqst.status_code == 416 and not range_start:
+            # We asked for no range, so there's no part to blame. Keep the
+            # file we have, if any.
+            if os.path.exists(filepath):
+                logging.warning(
+                    "{} answered 416 to a refresh, keeping {}".format(
+                        url, filename
+                    )
+                )
+                return filepath, 0
+            rqst.raise_for_status()
+        if rqst.status_code == 416:
+            # The part we have is no use (e.g. the file got shorter). Start
+            # over.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partpath)
+            manifest.set(filename, dict(_validators(rqst), complete=False))
+            return _download_file(
+                output_dir,
+                url,
+                session,
+                rate_limiter,
+                manifest,
+                refresh,
+                verify,
+            )
         rqst.raise_for_status()
-        with open(filepath, "wb") as f:
-            f.write(rqst.content)
+
+        if rqst.status_code != 206:
+            range_start = 0
+        manifest.set(filename, dict(_validators(rqst), complete=False))
+        with open(partpath, "ab" if range_start else "wb") as f:
+            for chunk in rqst.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                nbytes += len(chunk)
+    os.replace(partpath, filepath)
+    manifest.set(
+        filename,
+        dict(
+            _validators(rqst),
+            size=os.path.getsize(filepath),
+            sha256=file_sha256(filepath),
+            complete=True,
+        ),
+    )
+    return filepath, nbytes
+
+
+def download_file(
+    output_dir: str,
+    url: str,
+    sleep_seconds: float = 0,
+    session: Optional[requests.Session] = None,
+    rate_limiter: Optional[HostRateLimiter] = None,
+    refresh: bool = False,
+    verify: bool = False,
+) -> str:
+    """Download the data from the given URL into the datafolder, unless it's
+    already there. Return path to downloaded file.
+
+    Every downloaded file is recorded in the folder's manifest. A file whose
+    size doesn't match the manifest is treated as a partial download, and
+    only its missing bytes are requested.
+
+    Args:
+      sleep_seconds: How long to sleep after downloading. Default: 0
+      session: Session to send the requests through. Default: a new one.
+      rate_limiter: Consulted before every request. Default: None.
+      refresh: If True, ask the server whether files we already have have
+        changed, and download them again if they have. Default: False
+      verify: If True, check the checksums of files we already have, and
+        download them again if they don't match. Default: False
+    """
+    filepath, nbytes = _download_file(
+        output_dir,
+        url,
+        session=session,
+        rate_limiter=rate_limiter,
+        refresh=refresh,
+        verify=verify,
+    )
+    if nbytes:
         time.sleep(sleep_seconds)
     return filepath
 
 
 def download_urls(
-    urls: List[str], output_dir: str, sleep_seconds: float = 0.2
+    urls: List[str],
+    output_dir: str,
+    sleep_seconds: Optional[float] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    requests_per_second: Optional[float] = DEFAULT_REQUESTS_PER_SECOND,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+    refresh: bool = False,
+    verify: bool = False,
 ) -> List[str]:
-    downloaded_fpaths = list()
-    for url in tqdm(urls):
-        # ensure that we're doing a small sleep between
-        #  calls so we don't overload API
-        downloaded_fpaths.append(
-            download_file(
-                output_dir=output_dir, url=url, sleep_seconds=sleep_seconds
-            )
+    """Download all of `urls` into `output_dir`, `max_workers` at a time.
+
+    All the workers share one pooled session, and one rate limiter that keeps
+    each host under `requests_per_second`. Failed requests are retried up to
+    `max_retries` times with exponential backoff. `refresh` and `verify` are
+    as for `download_file`. Return the paths of the downloaded files, in the
+    same order as `urls`.
+
+    `sleep_seconds` is deprecated. It used to be the pause between
+    downloads, and if given, it sets `requests_per_second` to one request
+    every `sleep_seconds` instead, or no limit if it's 0.
+    """
+    if sleep_seconds is not None:
+        warnings.warn(
+            "sleep_seconds is deprecated, use requests_per_second instead",
+            DeprecationWarning,
+            stacklevel=2,
         )
+        requests_per_second = 1 / sleep_seconds if sleep_seconds else None
+    session = make_session(
+        pool_size=max_workers,
+        max_retries=max_retries,
+        backoff_factor=backoff_factor,
+    )
+    rate_limiter = HostRateLimiter(requests_per_second)
+    manifest = Manifest(output_dir)
+
+    downloaded_fpaths = [None] * len(urls)
+    total_bytes = 0
+    start_time = time.monotonic()
+    with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                _download_file,
+                output_dir,
+                url,
+                session=session,
+                rate_limiter=rate_limiter,
+                manifest=manifest,
+                refresh=refresh,
+                verify=verify,
+            ): i
+            for i, url in enumerate(urls)
+        }
+        with tqdm(total=len(urls), unit="file") as progress:
+            for future in as_completed(futures):
+                filepath, nbytes = future.result()
+                downloaded_fpaths[futures[future]] = filepath
+                total_bytes += nbytes
+                elapsed = max(time.monotonic() - start_time, 1e-9)
+                progress.set_postfix_str(
+                    "{:.2f} MB/s".format(total_bytes / elapsed / 1e6)
+                )
+                progress.update()
 
     return downloaded_fpaths
 
 
-def extract_zips(zip_fpaths: List[str], csv_dir: str) -> None:
-    # get filenames currently in csv_dir
-    current_csvs = os.listdir(csv_dir)
+def extract_zips(
+    zip_fpaths: List[str],
+    csv_dir: str,
+    suffixes: Optional[Tuple[str, ...]] = None,
+) -> None:
+    """Extract the members of the given zip archives into `csv_dir`, skipping
+    members that are already there. If `suffixes` is given, only extract the
+    members whose names end with one of them.
+
+    `clean_data.load_clean_data` can read CSV files straight out of the
+    archives, so this is only needed for other kinds of files, such as
+    spreadsheets.
+    """
+    os.makedirs(csv_dir, exist_ok=True)
     for fpath in zip_fpaths:
         with zipfile.ZipFile(fpath, "r") as z:
-            namelist = z.namelist()
-            has_been_extracted = any(
-                name not in current_csvs for name in namelist
-            )
-            if has_been_extracted:
+            members = [
+                info
+                for info in z.infolist()
+                if not info.is_dir()
+                and (suffixes is None or info.filename.endswith(suffixes))
+            ]
+            # A member counts as extracted if a file of the right size is in
+            # csv_dir already.
+            to_extract = [
+                info
+                for info in members
+                if not os.path.exists(os.path.join(csv_dir, info.filename))
+                or os.path.getsize(os.path.join(csv_dir, info.filename))
+                != info.file_size
+            ]
+            if to_extract:
                 logging.info(f"Unzipping {fpath}")
-                z.extractall(csv_dir)
-                # add to already existing list
-                current_csvs.extend(namelist)
+                z.extractall(csv_dir, members=to_extract)
             else:
                 logging.debug(f"{fpath} has already been extracted.")
     return
 
 
 def xlsx_to_csv(csv_dir: str, xlsx_archive_dir: str) -> int:
-
     xlsx_files = [
         os.path.join(csv_dir, fname)
         for fname in os.listdir(csv_dir)
-        if fname.endswith(".zip")
+        if fname.endswith(".xlsx")
     ]
+    os.makedirs(xlsx_archive_dir, exist_ok=True)
     for xlsxfile in xlsx_files:
         csvfile = xlsxfile.replace(".xlsx", ".csv")
         if not os.path.exists(csvfile):
@@ -114,7 +498,83 @@ def xlsx_to_csv(csv_dir: str, xlsx_archive_dir: str) -> int:
     return len(xlsx_files)
 
 
+def _xlsx_to_parquet_file(xlsxfile: str) -> str:
+    """Convert one spreadsheet to a Parquet file next to it, with the date
+    columns stored as datetimes. Return the path to the Parquet file.
+    """
+    parquetfile = xlsxfile.replace(".xlsx", ".parquet")
+    if os.path.exists(parquetfile):
+        logging.debug("Already have {}".format(parquetfile))
+        return parquetfile
+    logging.info("Converting {} to .parquet.".format(xlsxfile))
+    df = pd.read_excel(xlsxfile)
+    for column in XLSX_DATE_COLUMNS:
+        if column in df.columns and df[column].dtype == object:
+            # Cells Excel didn't recognise as dates come through as strings
+            # like the ones in the CSV files.
+            df[column] = pd.to_datetime(df[column], dayfirst=True)
+    # Write to a temporary file first, so that a killed run doesn't leave a
+    # truncated Parquet file behind.
+    tmpfile = parquetfile + ".tmp"
+    df.to_parquet(tmpfile, index=False)
+    os.replace(tmpfile, parquetfile)
+    return parquetfile
+
+
+def xlsx_to_parquet(
+    csv_dir: str, xlsx_archive_dir: str, max_workers: Optional[int] = None
+) -> int:
+    """Convert all the .xlsx files in `csv_dir` to Parquet files in the same
+    folder, `max_workers` at a time in separate processes, and move the
+    spreadsheets to `xlsx_archive_dir`. Return the number of files converted.
+
+    Unlike `xlsx_to_csv`, the dates are kept as datetimes, so they don't need
+    parsing again when the data is loaded.
+    """
+    xlsx_files = sorted(
+        os.path.join(csv_dir, fname)
+        for fname in os.listdir(csv_dir)
+        if fname.endswith(".xlsx")
+    )
+    os.makedirs(xlsx_archive_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_xlsx_to_parquet_file, xlsxfile): xlsxfile
+            for xlsxfile in xlsx_files
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+            xlsxfile = futures[future]
+            shutil.move(
+                xlsxfile,
+                os.path.join(xlsx_archive_dir, os.path.basename(xlsxfile)),
+            )
+
+    logging.info(f"converted {len(xlsx_files)} files")
+    return len(xlsx_files)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the TfL data.")
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Check files we already have for updates on the server.",
+    )
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        help=(
+            "Extract the CSV files from the zip archives. Not needed by "
+            "clean_data.load_clean_data, which reads them from the archives."
+        ),
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check files we already have against their checksums.",
+    )
+    args = parser.parse_args()
 
     # load config with data locations
     with open(CONFIG_FPATH, "r") as f:
@@ -143,13 +603,33 @@ if __name__ == "__main__":
     )
 
     # download csvs
-    csv_fpaths = download_urls(urls=csv_urls, output_dir=csv_dir)
+    csv_fpaths = download_urls(
+        urls=csv_urls,
+        output_dir=csv_dir,
+        refresh=args.refresh,
+        verify=args.verify,
+    )
     # download zips
-    zip_fpaths = download_urls(urls=zip_urls, output_dir=zip_dir)
-    # extract zips
-    extract_zips(zip_fpaths=zip_fpaths, csv_dir=csv_dir)
+    zip_fpaths = download_urls(
+        urls=zip_urls,
+        output_dir=zip_dir,
+        refresh=args.refresh,
+        verify=args.verify,
+    )
+    # extract zips. Only the spreadsheets need extracting, unless asked.
+    extract_zips(
+        zip_fpaths=zip_fpaths,
+        csv_dir=csv_dir,
+        suffixes=None if args.extract else (".xlsx",),
+    )
+    if zip_fpaths and not args.extract:
+        logging.warning(
+            "The CSV files in {} are left in their zip archives. Pass "
+            "zipfolder={!r} to clean_data.load_clean_data to read them, or "
+            "run with --extract.".format(zip_dir, zip_dir)
+        )
 
     # convert any xlsx files
-    xlsx_to_csv(csv_dir=csv_dir, xlsx_archive_dir=xlsx_dir)
+    xlsx_to_parquet(csv_dir=csv_dir, xlsx_archive_dir=xlsx_dir)
 
     logging.info("done!")
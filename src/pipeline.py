@@ -0,0 +1,301 @@
+"""Download, extract and clean the TfL data as one streaming pipeline.
+
+Running the stages of `download.py` and `clean_data.load_clean_data` one
+after the other means nothing gets parsed until everything is downloaded.
+Here each file is handed on as soon as it lands: a pool of download threads
+puts the paths of finished files on a bounded queue, and the main thread
+takes them off it and hands their CSV files, including those inside zip
+archives, to a pool of processes that parse and clean them. At most
+`max_pending` files are being parsed or waiting to be collected at any time,
+so memory use doesn't grow with the backlog.
+
+Run from the project root with `python -m src.pipeline`.
+"""
+import logging
+import os
+import pickle
+import queue
+import threading
+import zipfile
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from datetime import datetime
+
+import yaml
+from tqdm.auto import tqdm
+
+from src.clean_data import (
+    collect_station_names,
+    combine_pieces,
+    load_data_file,
+    load_problem_file,
+    pick_station_names,
+)
+from src.pfeffel.download import (
+    CONFIG_FPATH,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_REQUESTS_PER_SECOND,
+    PROJECT_ROOT,
+    HostRateLimiter,
+    Manifest,
+    _download_file,
+    _xlsx_to_parquet_file,
+    extract_zips,
+    make_session,
+)
+from src.stations import STATION_REGISTRY_FILE, build_registry
+from src.trip_arrays import write_trip_arrays
+from src.trip_store import write_trip_store
+
+# Marks the end of the stream of downloaded files.
+_DONE = None
+# Seconds between checks of whether the downloads should stop, while waiting
+# for room on the queue.
+_STOP_POLL_SECONDS = 0.1
+DOWNLOADER_THREAD_NAME = "pfeffel-downloader"
+
+
+def _put(downloaded, item, stop):
+    """Put item on the queue downloaded, waiting for room unless the event
+    stop is set. Return whether it was put.
+    """
+    while not stop.is_set():
+        try:
+            downloaded.put(item, timeout=_STOP_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _download_stage(
+    urls_and_dirs, downloaded, max_workers, requests_per_second, stop
+):
+    """Download every (url, output_dir) pair in urls_and_dirs, and put the
+    path of each file on the queue `downloaded` as soon as it's done. Put
+    _DONE on the queue at the end, or an exception if a download fails. If
+    the event stop is set, because nothing takes from the queue any more,
+    cancel the downloads that haven't started and return.
+    """
+    session = make_session(pool_size=max_workers)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    manifests = {
+        output_dir: Manifest(output_dir)
+        for output_dir in set(d for _, d in urls_and_dirs)
+    }
+    try:
+        with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _download_file,
+                    output_dir,
+                    url,
+                    session=session,
+                    rate_limiter=rate_limiter,
+                    manifest=manifests[output_dir],
+                )
+                for url, output_dir in urls_and_dirs
+            ]
+            for future in as_completed(futures):
+                filepath, _ = future.result()
+                if not _put(downloaded, filepath, stop):
+                    for future in futures:
+                        future.cancel()
+                    return
+    except Exception as e:
+        _put(downloaded, e, stop)
+        return
+    _put(downloaded, _DONE, stop)
+
+
+def _parse_source(path, member=None, cache_dir=None):
+    """Parse and clean one data file in a worker process. If member is given,
+    path is a zip archive and member the name of the CSV file in it.
+    Spreadsheets are converted to Parquet first. cache_dir is as for
+    `clean_data.load_data_file`.
+
+    Return the source and the output of `clean_data.load_data_file`.
+    """
+    if member is not None:
+        source = zipfile.Path(path, at=member)
+    elif path.endswith(".xlsx"):
+        source = _xlsx_to_parquet_file(path)
+    else:
+        source = path
+    return (path, member), load_data_file(source, cache_dir)
+
+
+def _sources(filepath, csv_dir):
+    """Return the arguments for `_parse_source` for each data file in the
+    downloaded file at filepath. Spreadsheets in zip archives are extracted
+    to csv_dir.
+    """
+    if not filepath.endswith(".zip"):
+        return [(filepath, None)]
+    extract_zips([filepath], csv_dir, suffixes=(".xlsx",))
+    with zipfile.ZipFile(filepath) as z:
+        names = sorted(z.namelist())
+    sources = [(filepath, name) for name in names if name.endswith(".csv")]
+    sources += [
+        (os.path.join(csv_dir, name), None)
+        for name in names
+        if name.endswith(".xlsx")
+    ]
+    return sources
+
+
+def stream_clean_data(
+    csv_urls,
+    zip_urls,
+    csv_dir,
+    zip_dir,
+    max_download_workers=DEFAULT_MAX_WORKERS,
+    max_parse_workers=None,
+    max_pending=None,
+    requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+    cache_dir=None,
+):
+    """Download the CSV files at csv_urls to csv_dir and the zip archives at
+    zip_urls to zip_dir, parsing and cleaning each file as soon as it's
+    downloaded.
+
+    Return the same as `clean_data.load_clean_data`.
+
+    Args:
+      max_download_workers: Number of download threads.
+      max_parse_workers: Number of parsing processes. Default: one per CPU
+      max_pending: Maximum number of downloaded files waiting to be parsed,
+      and of files being parsed. Default: twice max_parse_workers
+      requests_per_second: Maximum request rate per host.
+      cache_dir: As for `clean_data.load_clean_data`. Default: None
+    """
+    if max_parse_workers is None:
+        max_parse_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * max_parse_workers
+
+    urls_and_dirs = [(url, csv_dir) for url in csv_urls]
+    urls_and_dirs += [(url, zip_dir) for url in zip_urls]
+    downloaded = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    downloader = threading.Thread(
+        target=_download_stage,
+        args=(
+            urls_and_dirs,
+            downloaded,
+            max_download_workers,
+            requests_per_second,
+            stop,
+        ),
+        name=DOWNLOADER_THREAD_NAME,
+        daemon=True,
+    )
+    downloader.start()
+
+    station_allnames = {}
+    pieces = []
+    problem_sources = []
+    progress = tqdm(total=len(urls_and_dirs), unit="file")
+
+    def collect(futures):
+        for future in futures:
+            source, df = future.result()
+            if df is None:
+                problem_sources.append(source)
+            else:
+                pieces.append((source, df))
+                collect_station_names(station_allnames, df)
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_parse_workers) as executor:
+            pending = set()
+            while True:
+                filepath = downloaded.get()
+                if filepath is _DONE:
+                    break
+                if isinstance(filepath, Exception):
+                    raise filepath
+                progress.update()
+                for source in _sources(filepath, csv_dir):
+                    # Wait for some of the parsing to finish before taking on
+                    # more, so that finished DataFrames don't pile up.
+                    while len(pending) >= max_pending:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED
+                        )
+                        collect(done)
+                    pending.add(
+                        executor.submit(_parse_source, *source, cache_dir)
+                    )
+            collect(as_completed(pending))
+    finally:
+        # If parsing failed, nothing takes from the queue any more, so the
+        # downloader mustn't wait for room on it.
+        stop.set()
+        progress.close()
+    downloader.join()
+
+    # Files finish parsing in whatever order they happen to. Put them back in
+    # order, so that the result doesn't depend on it.
+    pieces = [df for _, df in sorted(pieces, key=_source_key)]
+
+    # The files lacking station IDs need the station names from all the
+    # others, so they get done last, as in load_clean_data.
+    station_ids, _ = pick_station_names(station_allnames)
+    logging.info(
+        "Doing the problem cases ({} of them).".format(len(problem_sources))
+    )
+    for path, member in sorted(problem_sources, key=str):
+        if member is not None:
+            source = zipfile.Path(path, at=member)
+        elif path.endswith(".xlsx"):
+            source = path.replace(".xlsx", ".parquet")
+        else:
+            source = path
+        pieces.append(load_problem_file(source, station_ids))
+
+    return combine_pieces(pieces, station_allnames)
+
+
+def _source_key(piece):
+    path, member = piece[0]
+    return path, member or ""
+
+
+if __name__ == "__main__":
+    # load config with data locations
+    with open(CONFIG_FPATH, "r") as f:
+        config = yaml.safe_load(f)
+
+    data_root_dir = os.path.join(PROJECT_ROOT, config["data"]["root_dir"])
+    relative_paths = config["data"]["relative_paths"]
+    with open(os.path.join(data_root_dir, relative_paths["urls_file"])) as f:
+        urls = f.read().splitlines()
+
+    df, station_allnames = stream_clean_data(
+        csv_urls=[url for url in urls if url.endswith(".csv")],
+        zip_urls=[url for url in urls if url.endswith(".zip")],
+        csv_dir=os.path.join(data_root_dir, relative_paths["csvs_dir"]),
+        zip_dir=os.path.join(data_root_dir, relative_paths["zips_dir"]),
+    )
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M")
+    df.to_pickle(
+        os.path.join(data_root_dir, "cleaned_data_{}.pickle".format(timestamp))
+    )
+    names_path = os.path.join(
+        data_root_dir, "station_names_{}.pickle".format(timestamp)
+    )
+    with open(names_path, "wb") as f:
+        pickle.dump(station_allnames, f)
+    write_trip_store(df, os.path.join(data_root_dir, "trips"))
+    write_trip_arrays(df, os.path.join(data_root_dir, "trip_arrays"))
+    build_registry(df, station_allnames).save(
+        os.path.join(data_root_dir, STATION_REGISTRY_FILE.name)
+    )
+    logging.info("done!")
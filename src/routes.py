@@ -0,0 +1,492 @@
+"""Fetch cycling routes from the CycleStreets journey API, many at a time.
+
+For each trip the API is asked for a route under each of PLANS, and the
+route whose time is closest to the trip's duration is kept, as
+`trip.Trip.get_route` does. A RouteFetcher asks for all the plans of a trip,
+and the routes of many trips, at once, from an asyncio event loop, over a
+pooled requests.Session in a pool of threads. The requests are spaced out to
+stay within a number of requests per second, and connection errors and
+transient HTTP errors are retried with exponential backoff, each retry
+waiting for its own request slot. A trip whose route can't be had, after
+the retries, is logged and left without one, without failing the others.
+
+The routes of a trip depend only on its start and end stations, so a
+RouteStore keeps the routes of every plan in an SQLite file by station pair,
+for all the trips between them, and each trip's route is picked from them
+locally. Many processes can read and write the same RouteStore at once.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+JOURNEY_API_URL = "https://www.cyclestreets.net/api/journey.json"
+PLANS = ("balanced", "fastest", "quietest", "shortest")
+# Where `trip.Trip.get_route` caches the route of each trip.
+ROUTE_DIR = "output/routes"
+ROUTE_STORE_PATH = "output/routes.sqlite"
+# Seconds to wait for other processes to finish writing to a RouteStore.
+BUSY_TIMEOUT = 60
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+DEFAULT_MAX_CONCURRENT = 16
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+TIMEOUT = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def itinerary_points(start, end):
+    """Return the itinerarypoints parameter of the journey API for a route
+    from start to end, each a (latitude, longitude).
+    """
+    return "{},{}|{},{}".format(start[1], start[0], end[1], end[0])
+
+
+def closest_plan(plan_routes, duration):
+    """Return the route of plan_routes, a dictionary of routes by plan, whose
+    time is closest to duration, in seconds. Ties go to the earliest plan.
+    """
+    return min(
+        plan_routes.values(),
+        key=lambda route: abs(int(route["time"]) - duration),
+    )
+
+
+class RouteError(Exception):
+    """The journey API answered without a route."""
+
+
+class AsyncRateLimiter:
+    """Hand out request slots so that no more than requests_per_second
+    requests are started per second, summed over all the tasks sharing this
+    limiter. A requests_per_second of None means no limit.
+    """
+
+    def __init__(self, requests_per_second):
+        if requests_per_second:
+            self.min_interval = 1.0 / requests_per_second
+        else:
+            self.min_interval = 0.0
+        self._next_slot = None
+
+    async def wait(self):
+        """Wait until another request may be started."""
+        now = time.monotonic()
+        slot = now if self._next_slot is None else max(now, self._next_slot)
+        self._next_slot = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class RouteFetcher:
+    """Fetches routes from the journey API at url, with the API key key.
+
+    Args:
+      requests_per_second: Most requests to start per second. None for no
+      limit.
+      max_concurrent: Most requests in flight at once, and the size of the
+      connection pool.
+      max_retries: Number of times to retry a request that failed with a
+      connection error or one of RETRY_STATUSES.
+      backoff_factor: The nth retry waits backoff_factor * 2**(n - 1)
+      seconds, plus the wait for a request slot.
+    """
+
+    def __init__(
+        self,
+        key,
+        url=JOURNEY_API_URL,
+        requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+        max_concurrent=DEFAULT_MAX_CONCURRENT,
+        max_retries=DEFAULT_MAX_RETRIES,
+        backoff_factor=DEFAULT_BACKOFF_FACTOR,
+    ):
+        self.key = key
+        self.url = url
+        self.requests_per_second = requests_per_second
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_concurrent, max_retries=0
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get(self, params):
+        response = self.session.get(self.url, params=params, timeout=TIMEOUT)
+        if response.status_code in RETRY_STATUSES:
+            return response.status_code, None
+        response.raise_for_status()
+        return response.status_code, response.json()
+
+    async def fetch_plan(self, start, end, plan):
+        """Return the route from start to end under plan, the attributes of
+        the journey API's first marker. Only call from `fetch_routes_async`.
+        """
+        loop = asyncio.get_running_loop()
+        params = {
+            "key": self.key,
+            "itinerarypoints": itinerary_points(start, end),
+            "plan": plan,
+        }
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            async with self._semaphore:
+                await self._limiter.wait()
+                try:
+                    status, data = await loop.run_in_executor(
+                        self._executor, self._get, params
+                    )
+                except (requests.ConnectionError, requests.Timeout) as error:
+                    last_error = error
+                    continue
+            if data is not None:
+                if "marker" not in data:
+                    raise RouteError(
+                        "No route from {} for plan {} of {}: {}".format(
+                            self.url,
+                            plan,
+                            params["itinerarypoints"],
+                            data.get("error", data),
+                        )
+                    )
+                return data["marker"][0]["@attributes"]
+            last_error = requests.HTTPError(
+                "{} from {} for plan {} of {}".format(
+                    status, self.url, plan, params["itinerarypoints"]
+                )
+            )
+        raise last_error
+
+    async def fetch_plans(self, start, end):
+        """Return a dictionary of the route from start to end under each of
+        PLANS, fetching them all at once. Only call from `fetch_routes_async`
+        or `fetch_all_plans_async`.
+        """
+        routes = await asyncio.gather(
+            *[self.fetch_plan(start, end, plan) for plan in PLANS]
+        )
+        return dict(zip(PLANS, routes))
+
+    async def fetch_route(self, start, end, duration):
+        """Return the route from start to end whose time is closest to
+        duration. Only call from `fetch_routes_async`.
+        """
+        return closest_plan(await self.fetch_plans(start, end), duration)
+
+    @staticmethod
+    async def _or_none(coroutine):
+        try:
+            return await coroutine
+        except (requests.RequestException, RouteError) as error:
+            logging.warning("Leaving out a route: {}".format(error))
+            return None
+
+    async def _gather(self, coroutines, callback):
+        async def run(i, coroutine):
+            result = await self._or_none(coroutine)
+            if result is not None and callback is not None:
+                callback(i, result)
+            return result
+
+        self._limiter = AsyncRateLimiter(self.requests_per_second)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        # The requests are made in threads of their own, rather than the
+        # loop's default executor, which may have fewer.
+        with ThreadPoolExecutor(self.max_concurrent) as self._executor:
+            return await asyncio.gather(
+                *[run(i, coroutine) for i, coroutine in enumerate(coroutines)]
+            )
+
+    async def fetch_routes_async(self, journeys, callback=None):
+        """Return a list of the route of each of journeys, a list of (start,
+        end, duration), with start and end each a (latitude, longitude). The
+        route of a journey that failed is None. If callback is given,
+        callback(i, route) is called with the index in journeys and the route
+        of each journey as soon as it's fetched, in the thread of the event
+        loop.
+        """
+        return await self._gather(
+            [
+                self.fetch_route(start, end, duration)
+                for start, end, duration in journeys
+            ],
+            callback,
+        )
+
+    async def fetch_all_plans_async(self, pairs, callback=None):
+        """Return a list of the routes of each plan, as by `fetch_plans`, for
+        each of pairs, a list of (start, end). Those of a pair that failed
+        are None. callback is as for `fetch_routes_async`.
+        """
+        return await self._gather(
+            [self.fetch_plans(start, end) for start, end in pairs], callback
+        )
+
+    def fetch_routes(self, journeys, callback=None):
+        """As `fetch_routes_async`, but blocking until done."""
+        return _run(self.fetch_routes_async(journeys, callback))
+
+    def fetch_all_plans(self, pairs, callback=None):
+        """As `fetch_all_plans_async`, but blocking until done."""
+        return _run(self.fetch_all_plans_async(pairs, callback))
+
+
+def _run(coroutine):
+    """Run coroutine to completion and return its result. If this thread
+    already has an event loop running, as in Jupyter, where asyncio.run
+    can't be called, it is run in an event loop of its own in another
+    thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+class RouteStore:
+    """The routes of each plan between pairs of stations, in the SQLite
+    file at path, shared by all the trips between the same stations.
+
+    The file is in write-ahead log mode, and writers wait up to timeout
+    seconds for each other, so that many processes can use it at once. A
+    RouteStore can be passed to other processes, which open the file anew.
+    """
+
+    def __init__(self, path=ROUTE_STORE_PATH, timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # The routes fetched by a RouteFetcher are stored from the thread
+            # of its event loop, which may not be this one, while this one
+            # waits for it.
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS routes ("
+                    "start_station_id INTEGER NOT NULL, "
+                    "end_station_id INTEGER NOT NULL, "
+                    "plan TEXT NOT NULL, "
+                    "route TEXT NOT NULL, "
+                    "PRIMARY KEY (start_station_id, end_station_id, plan)"
+                    ") WITHOUT ROWID"
+                )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def plan_routes(self, start_id, end_id):
+        """Return a dictionary of the route from station start_id to station
+        end_id under each of PLANS, or None if any of them isn't stored.
+        """
+        rows = self.connection.execute(
+            "SELECT plan, route FROM routes "
+            "WHERE start_station_id = ? AND end_station_id = ?",
+            (int(start_id), int(end_id)),
+        ).fetchall()
+        routes = {plan: json.loads(route) for plan, route in rows}
+        if any(plan not in routes for plan in PLANS):
+            return None
+        return {plan: routes[plan] for plan in PLANS}
+
+    def route(self, start_id, end_id, duration):
+        """Return the route from station start_id to station end_id whose
+        time is closest to duration, or None if they aren't all stored.
+        """
+        routes = self.plan_routes(start_id, end_id)
+        if routes is None:
+            return None
+        return closest_plan(routes, duration)
+
+    def put(self, start_id, end_id, plan_routes):
+        """Store the routes from station start_id to station end_id in
+        plan_routes, a dictionary of routes by plan.
+        """
+        self.put_many([((start_id, end_id), plan_routes)])
+
+    def put_many(self, items):
+        """Store the routes of each of items, pairs of (start station ID,
+        end station ID) and a dictionary of routes by plan, all at once.
+        """
+        rows = [
+            (int(start_id), int(end_id), plan, json.dumps(route))
+            for (start_id, end_id), plan_routes in items
+            for plan, route in plan_routes.items()
+        ]
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)", rows
+            )
+
+    def complete_pairs(self):
+        """Return the set of (start station ID, end station ID) whose routes
+        are stored for all of PLANS.
+        """
+        rows = self.connection.execute(
+            "SELECT start_station_id, end_station_id FROM routes "
+            "WHERE plan IN ({}) "
+            "GROUP BY start_station_id, end_station_id "
+            "HAVING COUNT(*) = ?".format(", ".join("?" * len(PLANS))),
+            (*PLANS, len(PLANS)),
+        )
+        return set(rows)
+
+    def missing_pairs(self, pairs):
+        """Return a list of those of pairs, (start station ID, end station
+        ID), whose routes aren't all stored, in order.
+        """
+        complete = self.complete_pairs()
+        return [
+            pair
+            for pair in pairs
+            if (int(pair[0]), int(pair[1])) not in complete
+        ]
+
+    def __len__(self):
+        return len(self.complete_pairs())
+
+
+def _location(station):
+    return station["latitude"], station["longitude"]
+
+
+def route_path(trip, route_dir=ROUTE_DIR):
+    return os.path.join(
+        route_dir, "{}_{}.json".format(trip.bike_id, trip.trip_id)
+    )
+
+
+def _station_pair(trip):
+    return int(trip.init_station["id"]), int(trip.end_station["id"])
+
+
+def fetch_trip_routes(trips, fetcher, route_dir=ROUTE_DIR, store=None):
+    """Set the route of each of trips, trip.Trip objects, as
+    `trip.Trip.get_route` would, and cache it in route_dir where
+    `trip.Trip.get_route` will find it. Routes already cached are read from
+    there, and the others are fetched all at once with fetcher, a
+    RouteFetcher, each cached as soon as it arrives. Return the number of
+    routes fetched. Trips whose route couldn't be fetched are left with an
+    empty route, and not cached, so that they are tried again next time.
+
+    If store, a RouteStore, is given, it is used as the cache instead of
+    route_dir, and the routes of each pair of stations are fetched only
+    once, however many of trips are between them. The number returned is
+    then that of the pairs fetched.
+    """
+    if store is not None:
+        return _fetch_stored_routes(trips, fetcher, store)
+
+    os.makedirs(route_dir, exist_ok=True)
+    to_fetch = []
+    for trip in trips:
+        path = route_path(trip, route_dir)
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                trip.route = json.load(f)
+        elif trip.circular:
+            trip.route = {}
+            _save_route(trip, route_dir)
+        else:
+            to_fetch.append(trip)
+
+    def save(i, route):
+        trip = to_fetch[i]
+        trip.route = route
+        _save_route(trip, route_dir)
+
+    routes = fetcher.fetch_routes(
+        [
+            (
+                _location(trip.init_station),
+                _location(trip.end_station),
+                trip.duration,
+            )
+            for trip in to_fetch
+        ],
+        save,
+    )
+    for trip, route in zip(to_fetch, routes):
+        if route is None:
+            trip.route = {}
+    return sum(route is not None for route in routes)
+
+
+def _save_route(trip, route_dir):
+    with open(route_path(trip, route_dir), "w") as f:
+        json.dump(trip.route, f)
+
+
+def _fetch_stored_routes(trips, fetcher, store):
+    locations = {}
+    for trip in trips:
+        if not trip.circular:
+            locations.setdefault(
+                _station_pair(trip),
+                (_location(trip.init_station), _location(trip.end_station)),
+            )
+    missing = store.missing_pairs(locations)
+
+    def save(i, plan_routes):
+        store.put(*missing[i], plan_routes)
+
+    plan_routes = fetcher.fetch_all_plans(
+        [locations[pair] for pair in missing], save
+    )
+
+    for trip in trips:
+        if trip.circular:
+            trip.route = {}
+        else:
+            route = store.route(*_station_pair(trip), trip.duration)
+            trip.route = {} if route is None else route
+    return sum(routes is not None for routes in plan_routes)
@@ -0,0 +1,119 @@
+"""Networks of trips between stations as sparse matrices.
+
+A TripNetwork holds the trip counts between stations as a scipy.sparse CSR
+matrix, with a row and a column for each station, and the station IDs in the
+same order. Thresholding, symmetrising, strengths and removing self-loops
+are all matrix operations. Convert to networkx only to plot, or for
+algorithms that need a networkx graph.
+"""
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+
+
+class TripNetwork:
+    """A directed network of trip counts. matrix[i, j] is the number of trips
+    from station node_ids[i] to station node_ids[j].
+    """
+
+    def __init__(self, matrix, node_ids):
+        self.matrix = sp.csr_matrix(matrix)
+        self.matrix.eliminate_zeros()
+        self.node_ids = np.asarray(node_ids)
+
+    @classmethod
+    def from_trip_counts(cls, trip_counts):
+        """Make a network of trip counts as output by `network.count_trips`
+        or `od_cube.ODCube.edge_list`.
+        """
+        starts = trip_counts["start_station_id"].to_numpy(dtype="int64")
+        ends = trip_counts["end_station_id"].to_numpy(dtype="int64")
+        node_ids = np.unique(np.concatenate([starts, ends]))
+        matrix = sp.coo_matrix(
+            (
+                trip_counts["trip_count"].to_numpy(),
+                (node_ids.searchsorted(starts), node_ids.searchsorted(ends)),
+            ),
+            shape=(len(node_ids), len(node_ids)),
+        )
+        return cls(matrix, node_ids)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return self.matrix.nnz
+
+    def total_trips(self):
+        return self.matrix.sum()
+
+    def keep_nodes(self, keep):
+        """Return the network of the nodes where the boolean array keep is
+        True.
+        """
+        indices = np.flatnonzero(keep)
+        matrix = self.matrix[indices][:, indices]
+        return TripNetwork(matrix, self.node_ids[indices])
+
+    def drop_isolated(self):
+        """Return the network without the nodes that have no edges."""
+        return self.keep_nodes(
+            (self.matrix.getnnz(axis=0) + self.matrix.getnnz(axis=1)) > 0
+        )
+
+    def threshold(self, fraction):
+        """Return the network of the edges with at least fraction times the
+        total number of trips, and the nodes that still have edges.
+        """
+        matrix = self.matrix.copy()
+        matrix.data[matrix.data < fraction * self.total_trips()] = 0
+        return TripNetwork(matrix, self.node_ids).drop_isolated()
+
+    def without_self_loops(self):
+        matrix = self.matrix - sp.diags(self.matrix.diagonal())
+        return TripNetwork(matrix, self.node_ids)
+
+    def symmetrised(self):
+        """Return the network with the trips of each edge added to those of
+        its reverse, A + A^T. Self-loops get counted twice.
+        """
+        return TripNetwork(self.matrix + self.matrix.T, self.node_ids)
+
+    def strength(self):
+        """Return the number of trips from and to each node, counting
+        self-loops twice, as networkx's weighted degree does.
+        """
+        return np.asarray(
+            self.matrix.sum(axis=0) + self.matrix.sum(axis=1).T
+        ).ravel()
+
+    def edges(self):
+        """Return arrays of the source IDs, target IDs and trip counts of the
+        edges.
+        """
+        matrix = self.matrix.tocoo()
+        return (
+            self.node_ids[matrix.row],
+            self.node_ids[matrix.col],
+            matrix.data,
+        )
+
+    def to_networkx(self, directed=True, weight="trip_count"):
+        """Return the network as a networkx graph, with the trip counts as
+        the edge attribute weight. If directed is False, the matrix should
+        be symmetric, as from `symmetrised`, and only its upper triangle is
+        used.
+        """
+        graph = nx.DiGraph() if directed else nx.Graph()
+        graph.add_nodes_from(self.node_ids.tolist())
+        matrix = self.matrix.tocoo() if directed else sp.triu(self.matrix)
+        graph.add_weighted_edges_from(
+            zip(
+                self.node_ids[matrix.row].tolist(),
+                self.node_ids[matrix.col].tolist(),
+                matrix.data.tolist(),
+            ),
+            weight=weight,
+        )
+        return graph
@@ -0,0 +1,227 @@
+"""A registry of all the docking stations, for every module to share.
+
+The registry holds the ID, canonical name, other names, location, and the
+dates of the first and last trips of each station, in dictionaries, so that
+all lookups are O(1). It's built once from the output of
+`clean_data.load_clean_data` and the station locations in stations_loc.json,
+saved as a pickle, and loaded from there at most once per process by
+`get_registry`.
+
+`src/pipeline.py` builds the registry along with everything else. If it
+hasn't, `get_registry` builds it from the trip store the first time it's
+needed, and so does running this module with `python -m src.stations`.
+"""
+import functools
+import json
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, FrozenSet, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+from src.clean_data import pick_station_names
+from src.trip_store import read_trips
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+STATION_REGISTRY_FILE = DATA_DIR / "station_registry.pickle"
+STATION_COORDS_FILE = DATA_DIR / "stations_loc.json"
+# Written by src/pipeline.py.
+TRIP_STORE_DIR = DATA_DIR / "trips"
+
+
+class Station(NamedTuple):
+    id: int
+    name: Optional[str]
+    aliases: FrozenSet[str]
+    lat: Optional[float]
+    lon: Optional[float]
+    first_seen: Optional[pd.Timestamp]
+    last_seen: Optional[pd.Timestamp]
+
+
+class StationRegistry:
+    """All the docking stations, by ID, with lookups by any of their names."""
+
+    def __init__(self, stations):
+        self.stations: Dict[int, Station] = {
+            station.id: station for station in stations
+        }
+        self.ids: Dict[str, int] = {}
+        for station in self.stations.values():
+            for alias in station.aliases:
+                self.ids[alias] = station.id
+
+    def __getitem__(self, id) -> Station:
+        return self.stations[int(id)]
+
+    def __contains__(self, id) -> bool:
+        return self._key(id) in self.stations
+
+    def __iter__(self):
+        return iter(self.stations.values())
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+    @staticmethod
+    def _key(id):
+        try:
+            return int(id)
+        except (TypeError, ValueError):
+            return None
+
+    def name(self, id) -> Optional[str]:
+        """Return the canonical name of station id, or None."""
+        station = self.stations.get(self._key(id))
+        return None if station is None else station.name
+
+    def id_of(self, name) -> Optional[int]:
+        """Return the ID of the station that goes by name, or None."""
+        return self.ids.get(name)
+
+    def location(self, id) -> Optional[Tuple[float, float]]:
+        """Return the (latitude, longitude) of station id, or None."""
+        station = self.stations.get(self._key(id))
+        if station is None or station.lat is None:
+            return None
+        return station.lat, station.lon
+
+    def has_location(self, id) -> bool:
+        return self.location(id) is not None
+
+    def save(self, path=STATION_REGISTRY_FILE) -> None:
+        # Write to a temporary file first, so that other processes never see
+        # a half-written registry.
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmppath, "wb") as f:
+            pickle.dump(
+                [tuple(station) for station in self.stations.values()],
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmppath, path)
+
+    @classmethod
+    def load(cls, path=STATION_REGISTRY_FILE) -> "StationRegistry":
+        with open(path, "rb") as f:
+            return cls(Station(*station) for station in pickle.load(f))
+
+
+def _seen_dates(df):
+    """Return Series of the first and last dates each station was used on in
+    df, which may be a DataFrame or an iterable of them.
+    """
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    first_seen = []
+    last_seen = []
+    for chunk in chunks:
+        for id_column, date_column in (
+            ("start_station_id", "start_date"),
+            ("end_station_id", "end_date"),
+        ):
+            dates = chunk.groupby(id_column)[date_column]
+            first_seen.append(dates.min())
+            last_seen.append(dates.max())
+    first_seen = pd.concat(first_seen).groupby(level=0).min()
+    last_seen = pd.concat(last_seen).groupby(level=0).max()
+    return first_seen, last_seen
+
+
+def build_registry(df, station_allnames, station_coords=None):
+    """Build a StationRegistry from the output of `clean_data.load_clean_data`
+    (df may also be the chunks yielded by `clean_data.iter_clean_data`), and
+    a dictionary of station locations as in stations_loc.json. If
+    station_coords is None, it's read from STATION_COORDS_FILE.
+    """
+    if station_coords is None:
+        with open(STATION_COORDS_FILE, "r") as f:
+            station_coords = json.load(f)
+    _, station_names = pick_station_names(station_allnames)
+    first_seen, last_seen = _seen_dates(df)
+
+    ids = set(int(id) for id in station_allnames)
+    ids.update(int(id) for id in station_coords)
+    stations = []
+    for id in sorted(ids):
+        coords = station_coords.get(str(id), {})
+        aliases = frozenset(
+            name
+            for name in station_allnames.get(id, ())
+            if isinstance(name, str)
+        )
+        stations.append(
+            Station(
+                id=id,
+                name=station_names.get(id),
+                aliases=aliases,
+                lat=coords.get("lat"),
+                lon=coords.get("lon"),
+                first_seen=first_seen.get(id),
+                last_seen=last_seen.get(id),
+            )
+        )
+    return StationRegistry(stations)
+
+
+def _station_allnames(df):
+    """Return a dictionary of the set of names each station ID goes by in
+    df, a DataFrame as output by `clean_data.load_clean_data`.
+    """
+    station_allnames = {}
+    for id_column, name_column in (
+        ("start_station_id", "start_station_name"),
+        ("end_station_id", "end_station_name"),
+    ):
+        pairs = df[[id_column, name_column]].dropna().drop_duplicates()
+        for id, name in zip(pairs[id_column], pairs[name_column]):
+            station_allnames.setdefault(int(id), set()).add(name)
+    return station_allnames
+
+
+def build_registry_from_trip_store(root=TRIP_STORE_DIR, station_coords=None):
+    """Build a StationRegistry from the trip store at root, as written by
+    `trip_store.write_trip_store`, as by `build_registry`. The other names
+    of each station are only those that the cleaned trips still have.
+    """
+    df = read_trips(
+        root,
+        columns=[
+            "start_date",
+            "start_station_id",
+            "start_station_name",
+            "end_date",
+            "end_station_id",
+            "end_station_name",
+        ],
+    )
+    return build_registry(df, _station_allnames(df), station_coords)
+
+
+@functools.lru_cache(maxsize=None)
+def get_registry(
+    path=STATION_REGISTRY_FILE, trip_store=TRIP_STORE_DIR
+) -> StationRegistry:
+    """Return the registry saved at path, loading it the first time only. If
+    there is none, it's built from the trip store at trip_store, and saved
+    at path.
+    """
+    if os.path.exists(path):
+        return StationRegistry.load(path)
+    if not os.path.exists(trip_store):
+        raise FileNotFoundError(
+            "There is no station registry at {}, nor a trip store at {} to "
+            "build it from. Run python -m src.pipeline first.".format(
+                path, trip_store
+            )
+        )
+    logging.info("Building the station registry from {}".format(trip_store))
+    registry = build_registry_from_trip_store(trip_store)
+    registry.save(path)
+    return registry
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build_registry_from_trip_store().save(STATION_REGISTRY_FILE)
@@ -0,0 +1,212 @@
+"""A cache of map tiles on disk, for drawing basemaps without the network.
+
+Basemaps are made of 256x256 pixel tiles, numbered by zoom level z and
+column and row x and y, and fetched from a tile server. A TileCache keeps
+each tile it fetches at root/z/x/y.png, and reads it from there the next
+time. It can be filled in advance from a folder of tiles in the same layout,
+or from an MBTiles file, and with offline=True it never goes to the network,
+so that maps can be drawn on machines that can't reach the tile server.
+
+`add_basemap` draws a basemap from a TileCache under a matplotlib plot in
+longitude and latitude, as contextily.add_basemap does.
+"""
+import io
+import math
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import requests
+from PIL import Image
+
+TILE_CACHE_DIR = Path(__file__).resolve().parent.parent / "data" / "tiles"
+# Stamen's own tile servers are gone, and Stadia Maps serves their tiles
+# now. Outside of localhost they want an API key, which can be added with
+# tile_url(contextily.providers.Stadia.StamenTonerLite, api_key=...).
+TONER_LITE_URL = (
+    "https://tiles.stadiamaps.com/tiles/stamen_toner_lite/{z}/{x}/{y}.png"
+)
+OSM_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+TIMEOUT = 60
+USER_AGENT = "pfeffel"
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """Return the tile coordinates x and y of a point at a zoom level, as
+    floats, whose integer parts are the column and row of its tile.
+    """
+    n = 2**zoom
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - np.arcsinh(np.tan(np.radians(lat))) / math.pi) / 2.0 * n
+    return x, y
+
+
+def tile_url(url, **kwargs):
+    """Return the URL template of url, which may be a string with {z}, {x}
+    and {y} in it, or a tile provider of xyzservices, as in
+    contextily.providers, whose other placeholders are filled in from
+    kwargs, such as api_key.
+    """
+    if hasattr(url, "build_url"):
+        return url.build_url(**kwargs)
+    return url
+
+
+class TileCache:
+    """Map tiles from the server at url, cached in the folder root.
+
+    Args:
+      root: Folder of the cache, with a subfolder for each zoom level.
+      url: URL of the tiles, with {z}, {x} and {y} in place of the zoom
+      level, column and row, or a tile provider, as for `tile_url`. May be
+      None if offline.
+      offline: If True, tiles that aren't in the cache raise a
+      FileNotFoundError, rather than being fetched.
+    """
+
+    def __init__(self, root=TILE_CACHE_DIR, url=TONER_LITE_URL, offline=False):
+        self.root = Path(root)
+        self.url = None if url is None else tile_url(url)
+        self.offline = offline
+        self._session = None
+
+    def path(self, z, x, y):
+        return self.root / str(z) / str(x) / "{}.png".format(y)
+
+    def __contains__(self, tile):
+        return self.path(*tile).exists()
+
+    def _write(self, z, x, y, data):
+        path = self.path(z, x, y)
+        os.makedirs(path.parent, exist_ok=True)
+        # Write to a temporary file first, so that other processes never see
+        # a half-written tile.
+        tmppath = path.with_suffix(".{}.tmp".format(os.getpid()))
+        with open(tmppath, "wb") as f:
+            f.write(data)
+        os.replace(tmppath, path)
+
+    def get(self, z, x, y):
+        """Return the contents of the tile file at zoom z, column x, row y,
+        fetching it if it isn't in the cache.
+        """
+        path = self.path(z, x, y)
+        if path.exists():
+            return path.read_bytes()
+        if self.offline or self.url is None:
+            raise FileNotFoundError(
+                "Tile {}/{}/{} isn't in the cache at {}".format(
+                    z, x, y, self.root
+                )
+            )
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.headers["User-Agent"] = USER_AGENT
+        response = self._session.get(
+            self.url.format(z=z, x=x, y=y), timeout=TIMEOUT
+        )
+        response.raise_for_status()
+        self._write(z, x, y, response.content)
+        return response.content
+
+    def image(self, z, x, y, mode="RGB"):
+        """Return the tile at zoom z, column x, row y as a PIL Image."""
+        return Image.open(io.BytesIO(self.get(z, x, y))).convert(mode)
+
+    def seed_from_directory(self, directory):
+        """Copy the tiles in directory, laid out as z/x/y.png, to the cache.
+        Return the number of tiles copied.
+        """
+        num_tiles = 0
+        for path in Path(directory).glob("*/*/*.png"):
+            z, x = path.parent.parent.name, path.parent.name
+            self._write(z, x, path.stem, path.read_bytes())
+            num_tiles += 1
+        return num_tiles
+
+    def seed_from_mbtiles(self, mbtiles_path):
+        """Copy the tiles in an MBTiles file to the cache. Return the number
+        of tiles copied.
+        """
+        num_tiles = 0
+        with sqlite3.connect(mbtiles_path) as connection:
+            rows = connection.execute(
+                "SELECT zoom_level, tile_column, tile_row, tile_data "
+                "FROM tiles"
+            )
+            for z, x, tms_y, data in rows:
+                # MBTiles number the rows from the south, as in TMS.
+                y = 2**z - 1 - tms_y
+                self._write(z, x, y, data)
+                num_tiles += 1
+        return num_tiles
+
+    def seed(self, west, south, east, north, zoom):
+        """Fetch all the tiles of an area at a zoom level into the cache."""
+        for x, y in self._tiles(west, south, east, north, zoom):
+            self.get(zoom, x, y)
+
+    @staticmethod
+    def _tiles(west, south, east, north, zoom):
+        x0, y0 = lonlat_to_tile(west, north, zoom)
+        x1, y1 = lonlat_to_tile(east, south, zoom)
+        return [
+            (x, y)
+            for x in range(int(x0), int(x1) + 1)
+            for y in range(int(y0), int(y1) + 1)
+        ]
+
+    def mosaic(self, west, south, east, north, zoom, mode="RGB"):
+        """Return an image of an area at a zoom level, as an array of pixels,
+        resampled so that its rows are evenly spaced in latitude, like its
+        columns are in longitude. It can be drawn on a plot in longitude and
+        latitude with imshow(image, extent=(west, east, south, north)).
+        """
+        x0, y0 = lonlat_to_tile(west, north, zoom)
+        x1, y1 = lonlat_to_tile(east, south, zoom)
+        tile_x0, tile_y0 = int(x0), int(y0)
+        tiles = {
+            (x, y): np.asarray(self.image(zoom, x, y, mode))
+            for x, y in self._tiles(west, south, east, north, zoom)
+        }
+        tile_size = next(iter(tiles.values())).shape[0]
+        num_columns = int(x1) - tile_x0 + 1
+        num_rows = int(y1) - tile_y0 + 1
+        stitched = np.concatenate(
+            [
+                np.concatenate(
+                    [
+                        tiles[tile_x0 + i, tile_y0 + j]
+                        for i in range(num_columns)
+                    ],
+                    axis=1,
+                )
+                for j in range(num_rows)
+            ],
+            axis=0,
+        )
+
+        # Pixel columns are linear in longitude already, but pixel rows are
+        # linear in Web Mercator y, not latitude.
+        first_column = int((x0 - tile_x0) * tile_size)
+        last_column = int(math.ceil((x1 - tile_x0) * tile_size))
+        first_row = int((y0 - tile_y0) * tile_size)
+        last_row = int(math.ceil((y1 - tile_y0) * tile_size))
+        latitudes = np.linspace(north, south, max(last_row - first_row, 1))
+        _, ys = lonlat_to_tile(0.0, latitudes, zoom)
+        rows = ((ys - tile_y0) * tile_size).astype(int)
+        rows = np.clip(rows, 0, stitched.shape[0] - 1)
+        return stitched[rows, first_column:last_column]
+
+
+def add_basemap(ax, tile_cache, zoom, mode="RGB", **kwargs):
+    """Draw the tiles of tile_cache at a zoom level under everything else on
+    ax, a plot in longitude and latitude, filling its current limits. Other
+    keyword arguments are passed to imshow.
+    """
+    west, east, south, north = ax.axis()
+    image = tile_cache.mosaic(west, south, east, north, zoom, mode)
+    kwargs.setdefault("interpolation", "bilinear")
+    ax.imshow(image, extent=(west, east, south, north), zorder=0, **kwargs)
+    ax.axis((west, east, south, north))
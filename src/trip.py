@@ -1,34 +1,83 @@
+import functools
 import json
 import os
 
 import folium
+import numpy as np
 import requests as requests
 from folium import plugins
 
+try:
+    from routes import (
+        JOURNEY_API_URL,
+        PLANS,
+        TIMEOUT,
+        RouteError,
+        closest_plan,
+        itinerary_points,
+    )
+except ImportError:
+    # Imported as src.trip, as in the tests.
+    from src.routes import (
+        JOURNEY_API_URL,
+        PLANS,
+        TIMEOUT,
+        RouteError,
+        closest_plan,
+        itinerary_points,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _session():
+    """Return the session that the journey API requests share."""
+    return requests.Session()
+
+
+def station_location(station_data, station_id):
+    """Return the (latitude, longitude) of station station_id. station_data
+    is a stations.StationRegistry, or the dictionary in stations_loc.json.
+    """
+    if hasattr(station_data, "location"):
+        location = station_data.location(station_id)
+        if location is None:
+            raise KeyError(station_id)
+        return location
+    coords = station_data[str(int(station_id))]
+    return coords["lat"], coords["lon"]
+
 
 class Trip:
+    __slots__ = (
+        "init_station",
+        "end_station",
+        "bike",
+        "duration",
+        "date",
+        "circular",
+        "route",
+        "bike_id",
+        "trip_id",
+    )
+
     def __init__(self, data, bike_id, trip_id, station_data):
         df = data[data.index == trip_id]
 
+        start_id = df.start_station_id.values[0]
+        end_id = df.end_station_id.values[0]
+        start_lat, start_lon = station_location(station_data, start_id)
+        end_lat, end_lon = station_location(station_data, end_id)
         self.init_station = {
             "name": df.start_station_name.values[0],
-            "id": df.start_station_id.values[0],
-            "latitude": station_data[str(int(df.start_station_id.values[0]))][
-                "lat"
-            ],
-            "longitude": station_data[str(int(df.start_station_id.values[0]))][
-                "lon"
-            ],
+            "id": start_id,
+            "latitude": start_lat,
+            "longitude": start_lon,
         }
         self.end_station = {
             "name": df.end_station_name.values[0],
-            "id": df.end_station_id.values[0],
-            "latitude": station_data[str(int(df.end_station_id.values[0]))][
-                "lat"
-            ],
-            "longitude": station_data[str(int(df.end_station_id.values[0]))][
-                "lon"
-            ],
+            "id": end_id,
+            "latitude": end_lat,
+            "longitude": end_lon,
         }
         self.bike = df.bike_id.values[0]
         self.duration = df.duration.values[0]
@@ -41,7 +90,79 @@ class Trip:
         self.bike_id = bike_id
         self.trip_id = trip_id
 
-    def get_route(self, key):
+    @classmethod
+    def from_fields(
+        cls, bike_id, trip_id, init_station, end_station, bike, duration, date
+    ):
+        """Make a Trip from its attributes, rather than from a DataFrame."""
+        trip = cls.__new__(cls)
+        trip.init_station = init_station
+        trip.end_station = end_station
+        trip.bike = bike
+        trip.duration = duration
+        trip.date = date
+        trip.circular = init_station == end_station
+        trip.route = {}
+        trip.bike_id = bike_id
+        trip.trip_id = trip_id
+        return trip
+
+    def _fetch_plan_routes(self, key, fetcher=None):
+        """Return a dictionary of the route of this trip under each plan,
+        from the CycleStreets journey API, through fetcher, a
+        routes.RouteFetcher, if one is given.
+        """
+        start = (self.init_station["latitude"], self.init_station["longitude"])
+        end = (self.end_station["latitude"], self.end_station["longitude"])
+        if fetcher is not None:
+            (plan_routes,) = fetcher.fetch_all_plans([(start, end)])
+            if plan_routes is None:
+                raise RouteError(
+                    "No route for trip {} of bike {}".format(
+                        self.trip_id, self.bike_id
+                    )
+                )
+            return plan_routes
+
+        plan_routes = {}
+        for plan in PLANS:
+            response = _session().get(
+                JOURNEY_API_URL,
+                params={
+                    "key": key,
+                    "itinerarypoints": itinerary_points(start, end),
+                    "plan": plan,
+                },
+                timeout=TIMEOUT,
+            )
+            response.raise_for_status()
+            plan_routes[plan] = response.json()["marker"][0]["@attributes"]
+        return plan_routes
+
+    def _get_stored_route(self, key, store, fetcher):
+        if self.circular:
+            self.route = {}
+            return
+        start_id = self.init_station["id"]
+        end_id = self.end_station["id"]
+        route = store.route(start_id, end_id, self.duration)
+        if route is None:
+            store.put(start_id, end_id, self._fetch_plan_routes(key, fetcher))
+            route = store.route(start_id, end_id, self.duration)
+        self.route = route
+
+    def get_route(self, key, store=None, fetcher=None):
+        """Set the route of this trip to the CycleStreets route whose time
+        is closest to its duration, cached in output/routes. If store, a
+        routes.RouteStore, is given, the routes are cached there by start
+        and end station instead, and shared by all trips between them. If
+        fetcher, a routes.RouteFetcher, is given, the routes are fetched
+        through it, with its rate limit and retries.
+        """
+        if store is not None:
+            self._get_stored_route(key, store, fetcher)
+            return
+
         route_file_path = (
             "output/routes/"
             + str(self.bike_id)
@@ -58,39 +179,9 @@ class Trip:
                 self.route = {}
 
             else:
-                plans = ["balanced", "fastest", "quietest", "shortest"]
-
-                closest_time = False
-                trip_data = {}
-
-                for plan in plans:
-                    name = (
-                        "https://www.cyclestreets.net/api/journey.json?key="
-                        + key
-                        + "&itinerarypoints="
-                        + str(self.init_station["longitude"])
-                        + ","
-                        + str(self.init_station["latitude"])
-                        + "|"
-                        + str(self.end_station["longitude"])
-                        + ","
-                        + str(self.end_station["latitude"])
-                        + "&plan="
-                        + plan
-                    )
-                    data = requests.get(name).json()["marker"][0][
-                        "@attributes"
-                    ]
-                    time = int(data["time"])
-                    if closest_time is False:
-                        closest_time = abs(time - self.duration)
-                        trip_data = data
-
-                    elif abs(self.duration - time) < closest_time:
-                        closest_time = abs(time - self.duration)
-                        trip_data = data
-
-                self.route = trip_data
+                self.route = closest_plan(
+                    self._fetch_plan_routes(key, fetcher), self.duration
+                )
 
             with open(route_file_path, "w") as fp:
                 json.dump(self.route, fp)
@@ -159,3 +250,68 @@ class Trip:
             add_last_point=True,
         ).add_to(map)
         return map
+
+
+class TripCollection:
+    """The trips of a DataFrame, such as the trips of one chain, made all at
+    once. The columns are kept as arrays, the station locations looked up
+    once per station, and each Trip is only made the first time it's asked
+    for. station_data is as for `station_location`.
+    """
+
+    def __init__(self, data, bike_id, station_data):
+        self.bike_id = bike_id
+        self.trip_ids = data.index.to_numpy()
+        self.start_ids = data["start_station_id"].to_numpy()
+        self.end_ids = data["end_station_id"].to_numpy()
+        self.start_names = data["start_station_name"].to_numpy()
+        self.end_names = data["end_station_name"].to_numpy()
+        self.bikes = data["bike_id"].to_numpy()
+        self.durations = data["duration"].to_numpy()
+        self.start_dates = data["start_date"].to_numpy()
+        self.end_dates = data["end_date"].to_numpy()
+
+        station_ids = np.unique(
+            np.concatenate([self.start_ids, self.end_ids]).astype("int64")
+        )
+        locations = np.array(
+            [station_location(station_data, id) for id in station_ids],
+            dtype="float64",
+        ).reshape(-1, 2)
+        start = station_ids.searchsorted(self.start_ids.astype("int64"))
+        end = station_ids.searchsorted(self.end_ids.astype("int64"))
+        self.start_locations = locations[start]
+        self.end_locations = locations[end]
+        self._trips = [None] * len(self.trip_ids)
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    def __getitem__(self, i):
+        if self._trips[i] is None:
+            start_lat, start_lon = self.start_locations[i]
+            end_lat, end_lon = self.end_locations[i]
+            self._trips[i] = Trip.from_fields(
+                bike_id=self.bike_id,
+                trip_id=self.trip_ids[i],
+                init_station={
+                    "name": self.start_names[i],
+                    "id": self.start_ids[i],
+                    "latitude": start_lat,
+                    "longitude": start_lon,
+                },
+                end_station={
+                    "name": self.end_names[i],
+                    "id": self.end_ids[i],
+                    "latitude": end_lat,
+                    "longitude": end_lon,
+                },
+                bike=self.bikes[i],
+                duration=self.durations[i],
+                date={"start": self.start_dates[i], "end": self.end_dates[i]},
+            )
+        return self._trips[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,92 @@
+"""Memory-mapped arrays of the core trip columns, for sharing across processes.
+
+Pickling the cleaned DataFrame to each worker process gives every worker a
+copy of its own. Instead, `write_trip_arrays` writes each of the core columns
+to a .npy file of its own, and `load_trip_arrays` memory-maps them read-only,
+so all the processes on a machine that load them share the one copy in the
+page cache, and only the pages they touch get read from disk.
+
+The nullable integer columns of the cleaned data are stored as plain
+integers, with NA_VALUE in place of missing values. Missing dates are NaT.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+ARRAY_DTYPES = {
+    "rental_id": "int32",
+    "start_date": "datetime64[ns]",
+    "end_date": "datetime64[ns]",
+    "start_station_id": "int16",
+    "end_station_id": "int16",
+    "bike_id": "int32",
+    "duration": "int32",
+}
+NA_VALUE = -1
+META_FILENAME = "trip_arrays.json"
+
+
+def write_trip_arrays(df, directory):
+    """Write the core columns of the cleaned trips in df, as output by
+    `clean_data.load_clean_data`, to .npy files in directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    df = df.reset_index()
+    for column, dtype in ARRAY_DTYPES.items():
+        values = df[column]
+        if dtype.startswith("int"):
+            values = values.fillna(NA_VALUE)
+        values = values.to_numpy(dtype=dtype)
+        np.save(os.path.join(directory, column + ".npy"), values)
+    meta = {"length": len(df), "dtypes": ARRAY_DTYPES, "na_value": NA_VALUE}
+    with open(os.path.join(directory, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+class TripArrays:
+    """The trip arrays in a directory written by `write_trip_arrays`,
+    memory-mapped read-only. Index with a column name to get its array.
+    """
+
+    def __init__(self, directory, columns=None):
+        with open(os.path.join(directory, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        if columns is None:
+            columns = list(meta["dtypes"])
+        self.columns = columns
+        self.length = meta["length"]
+        self.arrays = {
+            column: np.load(
+                os.path.join(directory, column + ".npy"), mmap_mode="r"
+            )
+            for column in columns
+        }
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    def __len__(self):
+        return self.length
+
+    def to_frame(self, columns=None):
+        """Return a DataFrame of the given columns (default: all of them)
+        backed by the memory-mapped arrays, without copying them.
+
+        The DataFrame is read-only. pandas makes copies when it consolidates
+        columns of the same dtype, which many operations do, so take the
+        columns needed out of it, or select rows, before doing much else.
+        """
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame(
+            {column: self.arrays[column] for column in columns}, copy=False
+        )
+
+
+def load_trip_arrays(directory, columns=None):
+    """Memory-map the trip arrays in directory, as written by
+    `write_trip_arrays`. Only the given columns are opened, default all.
+    """
+    return TripArrays(directory, columns)
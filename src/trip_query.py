@@ -0,0 +1,116 @@
+"""Fast queries of the cleaned trips by date range and time of day or week.
+
+Filtering with `df["start_date"].dt.hour.isin(...)` computes the hour of
+every trip all over again for every query. A TripIndex sorts the trips by
+start date once, and computes compact calendar columns (hour, weekday, day,
+month and year) once, so that a date range is found by binary search and the
+other conditions are lookups into small boolean tables, combined with &.
+"""
+import numpy as np
+import pandas as pd
+
+NANOSECONDS_PER_HOUR = 3600 * 10**9
+NANOSECONDS_PER_DAY = 24 * NANOSECONDS_PER_HOUR
+# 1970-01-01 was a Thursday.
+EPOCH_WEEKDAY = 3
+# Calendar value of the trips that have no start date.
+MISSING = 255
+
+
+def calendar_columns(dates):
+    """Return a dictionary of the hour, weekday (0 is Monday), day, month and
+    year of each of the datetime64[ns] array dates, as uint8 arrays, except
+    for the year, which is int16. Missing dates get MISSING, or year -1.
+    """
+    missing = np.isnat(dates)
+    nanoseconds = dates.view("int64")
+    days = nanoseconds // NANOSECONDS_PER_DAY
+    months = dates.astype("datetime64[M]")
+    month_numbers = months.view("int64")
+    day = days - months.astype("datetime64[D]").view("int64") + 1
+    calendar = {
+        "hour": (nanoseconds // NANOSECONDS_PER_HOUR % 24).astype("uint8"),
+        "weekday": ((days + EPOCH_WEEKDAY) % 7).astype("uint8"),
+        "day": day.astype("uint8"),
+        "month": (month_numbers % 12 + 1).astype("uint8"),
+        "year": (month_numbers // 12 + 1970).astype("int16"),
+    }
+    for column in ("hour", "weekday", "day", "month"):
+        calendar[column][missing] = MISSING
+    calendar["year"][missing] = -1
+    return calendar
+
+
+def lookup_table(values):
+    """Return a boolean array with True at the given values, for indexing
+    with the uint8 calendar columns.
+    """
+    table = np.zeros(256, dtype=bool)
+    table[list(values)] = True
+    return table
+
+
+class TripIndex:
+    """The trips of a DataFrame as output by `clean_data.load_clean_data`,
+    sorted by start date, with calendar columns of their start dates.
+
+    Trips without a start date come last, and are never matched by a query.
+    """
+
+    def __init__(self, df):
+        if not df["start_date"].is_monotonic_increasing:
+            df = df.iloc[
+                np.argsort(df["start_date"].to_numpy(), kind="stable")
+            ]
+        self.df = df
+        self.start_dates = df["start_date"].to_numpy()
+
+        calendar = calendar_columns(self.start_dates)
+        self.hour = calendar["hour"]
+        self.weekday = calendar["weekday"]
+        self.day = calendar["day"]
+        self.month = calendar["month"]
+        self.year = calendar["year"]
+        self.num_dated = len(df) - np.isnat(self.start_dates).sum()
+
+    def __len__(self):
+        return len(self.df)
+
+    def date_range(self, start=None, end=None):
+        """Return the slice of the trips that started in [start, end)."""
+        dates = self.start_dates[: self.num_dated]
+        first = 0
+        last = self.num_dated
+        if start is not None:
+            first = dates.searchsorted(np.datetime64(pd.Timestamp(start)))
+        if end is not None:
+            last = dates.searchsorted(np.datetime64(pd.Timestamp(end)))
+        return slice(first, max(first, last))
+
+    def mask(
+        self, start=None, end=None, hours=None, weekdays=None, months=None
+    ):
+        """Return the slice of the trips that started in [start, end), and a
+        boolean mask of those of them that started in one of the given hours
+        (0-23), weekdays (0 is Monday) and months (1-12). None means any.
+        """
+        rows = self.date_range(start, end)
+        mask = np.ones(rows.stop - rows.start, dtype=bool)
+        for values, column in (
+            (hours, self.hour),
+            (weekdays, self.weekday),
+            (months, self.month),
+        ):
+            if values is not None:
+                mask &= lookup_table(values)[column[rows]]
+        return rows, mask
+
+    def query(
+        self, start=None, end=None, hours=None, weekdays=None, months=None
+    ):
+        """Return a DataFrame of the trips that match, as for `mask`."""
+        rows, mask = self.mask(start, end, hours, weekdays, months)
+        df = self.df.iloc[rows]
+        if mask.all():
+            return df
+        return df[mask]
@@ -0,0 +1,112 @@
+"""Store the cleaned trips as a Parquet dataset partitioned by month.
+
+`write_trip_store` writes the output of `clean_data.load_clean_data` into
+directories like root/year=2021/month=3/, by the start date of each trip.
+`read_trips` then only opens the directories of the months in the date range
+asked for, and only reads the columns asked for, so a one-year analysis
+doesn't pay for the whole decade.
+"""
+import os
+import shutil
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.clean_data import CLEAN_DTYPES
+
+PARTITION_COLUMNS = ["year", "month"]
+INDEX_COLUMN = "rental_id"
+
+
+def write_trip_store(df, root, overwrite=True):
+    """Write the cleaned trips in df to a Parquet dataset at root,
+    partitioned by the year and month of their start dates. df may also be
+    an iterable of DataFrames, such as the chunks yielded by
+    `clean_data.iter_clean_data`, which are written one at a time.
+
+    If overwrite is True, anything already at root is deleted first,
+    otherwise the trips are added to it.
+    """
+    if overwrite and os.path.exists(root):
+        shutil.rmtree(root)
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    # Files from earlier writes mustn't be overwritten, so each write gets
+    # file names of its own.
+    write_id = uuid.uuid4().hex
+    for i, chunk in enumerate(chunks):
+        chunk = chunk.reset_index()
+        chunk["year"] = chunk["start_date"].dt.year.astype("Int16")
+        chunk["month"] = chunk["start_date"].dt.month.astype("Int8")
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        pq.write_to_dataset(
+            table,
+            root,
+            partition_cols=PARTITION_COLUMNS,
+            basename_template="part-{}-{}-{{i}}.parquet".format(write_id, i),
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+
+def _month_filter(start, end):
+    """Return a filter expression on the partition columns that matches the
+    months that overlap with [start, end). Either may be None.
+    """
+    year = ds.field("year")
+    month = ds.field("month")
+    expression = None
+    if start is not None:
+        expression = (year > start.year) | (
+            (year == start.year) & (month >= start.month)
+        )
+    if end is not None:
+        end_expression = (year < end.year) | (
+            (year == end.year) & (month <= end.month)
+        )
+        if expression is None:
+            expression = end_expression
+        else:
+            expression = expression & end_expression
+    return expression
+
+
+def read_trips(root, start=None, end=None, columns=None):
+    """Read the trips that started in [start, end) from the trip store at
+    root, as a DataFrame indexed by rental ID, like the output of
+    `clean_data.load_clean_data`.
+
+    Only the partitions of the months in the range are opened, and only the
+    given columns are read.
+
+    Args:
+      root: Path to the trip store, as written by `write_trip_store`.
+      start: Earliest start date to include. Default: None, no limit
+      end: Start date after which not to include trips. Default: None, no
+      limit
+      columns: List of columns to read. Default: None, all
+    """
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+
+    filter = _month_filter(start, end)
+    start_date = ds.field("start_date")
+    if start is not None:
+        filter = filter & (start_date >= pa.scalar(start, pa.timestamp("ns")))
+    if end is not None:
+        filter = filter & (start_date < pa.scalar(end, pa.timestamp("ns")))
+
+    if columns is not None:
+        columns = [INDEX_COLUMN] + [c for c in columns if c != INDEX_COLUMN]
+    table = dataset.to_table(columns=columns, filter=filter)
+    df = table.to_pandas()
+    df = df.drop(columns=[c for c in PARTITION_COLUMNS if c in df.columns])
+    # Partitions are read in whatever order, and their categoricals may have
+    # different categories, so put things back the way they were.
+    for column, dtype in CLEAN_DTYPES.items():
+        if column in df.columns and df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    df = df.set_index(INDEX_COLUMN).sort_index()
+    return df
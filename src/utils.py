@@ -110,6 +110,11 @@ def get_trajectory(bike_id):
 
 
 def check_id(row, stations):
+    # stations is a stations.StationRegistry, or the dictionary in
+    # stations_loc.json.
+    if hasattr(stations, "has_location"):
+        has_start = stations.has_location(row["start_station_id"])
+        return has_start and stations.has_location(row["end_station_id"])
     start_id = str(int(row["start_station_id"]))
     end_id = str(int(row["end_station_id"]))
     if str(start_id) in stations.keys() and str(end_id) in stations.keys():
@@ -0,0 +1,124 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from src.chains import BikeIndex, assign_chain_ids
+
+
+def chains_by_loop(df):
+    """Return the chains of df as a set of frozensets of rental IDs, found
+    one bike and one trip at a time.
+    """
+    chains = set()
+    for _, trips in df.groupby("bike_id"):
+        trips = trips.sort_values("start_date", kind="stable")
+        chain = []
+        last_end = None
+        for rental_id, trip in trips.iterrows():
+            if chain and trip["start_station_id"] != last_end:
+                chains.add(frozenset(chain))
+                chain = []
+            chain.append(rental_id)
+            last_end = trip["end_station_id"]
+        chains.add(frozenset(chain))
+    return chains
+
+
+class TestChains(TestCase):
+    def test_assign_chain_ids(self):
+        rng = np.random.default_rng(0)
+        num_trips = 500
+        df = pd.DataFrame(
+            {
+                "bike_id": pd.array(
+                    rng.integers(0, 10, size=num_trips), dtype="Int32"
+                ),
+                "start_date": pd.Timestamp("2020-01-01")
+                + pd.to_timedelta(rng.permutation(num_trips) * 3600, unit="s"),
+                "start_station_id": pd.array(
+                    rng.integers(1, 4, size=num_trips), dtype="Int16"
+                ),
+                "end_station_id": pd.array(
+                    rng.integers(1, 4, size=num_trips), dtype="Int16"
+                ),
+            },
+            index=pd.RangeIndex(1000, 1000 + num_trips, name="rental_id"),
+        )
+        chain_ids = assign_chain_ids(df)
+        pd.testing.assert_index_equal(chain_ids.index, df.index)
+        self.assertEqual(chain_ids.dtype, "int32")
+        chains = set(
+            frozenset(group.index) for _, group in chain_ids.groupby(chain_ids)
+        )
+        self.assertEqual(chains, chains_by_loop(df))
+        self.assertEqual(chain_ids.max() + 1, len(chains))
+        # Chains are numbered by bike, then by time.
+        first = df.groupby(chain_ids)[["bike_id", "start_date"]].min()
+        self.assertTrue(
+            first.sort_values(
+                ["bike_id", "start_date"]
+            ).index.is_monotonic_increasing
+        )
+
+    def test_missing_ids(self):
+        df = pd.DataFrame(
+            {
+                "bike_id": pd.array([1, 1, 1, None, None], dtype="Int32"),
+                "start_date": pd.date_range("2020-01-01", periods=5, freq="H"),
+                "start_station_id": pd.array(
+                    [1, 2, None, 1, 1], dtype="Int16"
+                ),
+                "end_station_id": pd.array([2, 3, 1, 1, 1], dtype="Int16"),
+            }
+        )
+        self.assertEqual(list(assign_chain_ids(df)), [2, 2, 3, 0, 1])
+
+
+class TestBikeIndex(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        num_trips = 300
+        self.df = pd.DataFrame(
+            {
+                "bike_id": pd.array(
+                    rng.integers(0, 5, size=num_trips), dtype="Int32"
+                ),
+                "start_date": pd.Timestamp("2020-01-01")
+                + pd.to_timedelta(rng.permutation(num_trips) * 60, unit="s"),
+                "start_station_id": pd.array(
+                    rng.integers(1, 3, size=num_trips), dtype="Int16"
+                ),
+                "end_station_id": pd.array(
+                    rng.integers(1, 3, size=num_trips), dtype="Int16"
+                ),
+            },
+            index=pd.RangeIndex(num_trips, name="rental_id"),
+        )
+        self.df.loc[0, "bike_id"] = pd.NA
+        self.index = BikeIndex(self.df)
+
+    def test_trips(self):
+        self.assertEqual(sorted(self.index.bike_ids), [0, 1, 2, 3, 4])
+        for bike_id in range(5):
+            expected = self.df[self.df["bike_id"] == bike_id]
+            trips = self.index.trips(bike_id)
+            self.assertTrue(trips["start_date"].is_monotonic_increasing)
+            pd.testing.assert_frame_equal(
+                trips.drop(columns="chain_id").sort_index(), expected
+            )
+        self.assertEqual(len(self.index.trips(99)), 0)
+
+    def test_chains(self):
+        chain_ids = assign_chain_ids(self.df)
+        for bike_id in self.index.bike_ids:
+            chains = self.index.chains(bike_id)
+            for chain_id, trips in chains.items():
+                self.assertEqual(
+                    set(trips.index),
+                    set(chain_ids.index[chain_ids == chain_id]),
+                )
+            self.assertEqual(
+                sum(len(trips) for trips in chains.values()),
+                len(self.index.trips(bike_id)),
+            )
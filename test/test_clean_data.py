@@ -0,0 +1,267 @@
+import os
+import tempfile
+import zipfile
+from unittest import TestCase, mock
+
+import pandas as pd
+
+from src.clean_data import (
+    CACHE_VERSION,
+    CLEAN_DTYPES,
+    clean_datetime_column,
+    concat_pieces,
+    iter_clean_data,
+    list_data_paths,
+    load_clean_data,
+    parse_timestamps,
+)
+
+STATIONS = {
+    1: "River Street, Clerkenwell",
+    2: "Phillimore Gardens, Kensington",
+    3: "Christopher Street, Liverpool Street",
+}
+
+
+def make_csv(first_rental_id, num_rows, seconds=False):
+    """Return the contents of a CSV file like the TfL ones, with num_rows
+    trips, numbered from first_rental_id.
+    """
+    rows = []
+    time_format = "{:02d}/01/2016 08:{:02d}" + (":00" if seconds else "")
+    for i in range(num_rows):
+        rental_id = first_rental_id + i
+        start = 1 + rental_id % 3
+        end = 1 + (rental_id // 3) % 3
+        minute = rental_id % 50
+        rows.append(
+            {
+                "Rental Id": rental_id,
+                "Duration": 600,
+                "Bike Id": 100 + rental_id % 7,
+                "End Date": time_format.format(1 + i % 28, minute + 10),
+                "EndStation Id": end,
+                "EndStation Name": STATIONS[end],
+                "Start Date": time_format.format(1 + i % 28, minute),
+                "StartStation Id": start,
+                "StartStation Name": STATIONS[start],
+            }
+        )
+    return pd.DataFrame(rows).to_csv(index=False)
+
+
+def make_problem_csv(first_rental_id, num_rows):
+    """Return a CSV file that only has station names, not station IDs."""
+    df = pd.read_csv(
+        pd.io.common.StringIO(make_csv(first_rental_id, num_rows))
+    )
+    df = df.drop(columns=["EndStation Id", "StartStation Id"])
+    return df.to_csv(index=False)
+
+
+def write_data_folder(folder):
+    """Write a folder of CSV files, and a zip archive of more, into folder.
+    Return the paths of the CSV folder and of the zip folder.
+    """
+    csv_dir = os.path.join(folder, "bike_data")
+    zip_dir = os.path.join(folder, "bike_zips")
+    os.makedirs(csv_dir)
+    os.makedirs(zip_dir)
+    with open(os.path.join(csv_dir, "01aJourneyDataExtract.csv"), "w") as f:
+        f.write(make_csv(1000, 60))
+    with open(os.path.join(csv_dir, "01bJourneyDataExtract.csv"), "w") as f:
+        f.write(make_csv(2000, 60, seconds=True))
+    with open(os.path.join(csv_dir, "01cJourneyDataExtract.csv"), "w") as f:
+        f.write(make_problem_csv(3000, 30))
+    with zipfile.ZipFile(os.path.join(zip_dir, "2017.zip"), "w") as z:
+        z.writestr("02aJourneyDataExtract.csv", make_csv(4000, 40))
+        z.writestr("02bJourneyDataExtract.csv", make_csv(5000, 40, True))
+    return csv_dir, zip_dir
+
+
+class TestCleanData(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.csv_dir, self.zip_dir = write_data_folder(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_load_clean_data(self):
+        df, station_allnames = load_clean_data(self.csv_dir)
+        self.assertEqual(len(df), 150)
+        self.assertTrue(df.index.is_monotonic_increasing)
+        self.assertEqual(df.loc[3002, "start_station_id"], 3)
+        self.assertEqual(df.loc[3002, "start_station_name"], STATIONS[3])
+        self.assertEqual(
+            df.loc[1000, "start_date"], pd.Timestamp("2016-01-01 08:00")
+        )
+        self.assertEqual(
+            df.loc[2001, "end_date"], pd.Timestamp("2016-01-02 08:11")
+        )
+        self.assertEqual(
+            station_allnames, {k: {v} for k, v in STATIONS.items()}
+        )
+        for column, dtype in CLEAN_DTYPES.items():
+            if column in df.columns:
+                self.assertEqual(df[column].dtype, dtype)
+
+    def test_load_from_zips(self):
+        paths = list_data_paths(self.csv_dir, zipfolder=self.zip_dir)
+        self.assertEqual(len(paths), 5)
+        df, _ = load_clean_data(self.csv_dir, zipfolder=self.zip_dir)
+        self.assertEqual(len(df), 230)
+        self.assertEqual(
+            str(df.loc[4000, "filename"]),
+            os.path.join(
+                self.zip_dir, "2017.zip", "02aJourneyDataExtract.csv"
+            ),
+        )
+        self.assertEqual(
+            df.loc[5001, "start_date"], pd.Timestamp("2016-01-02 08:01")
+        )
+
+    def test_load_parquet(self):
+        # As written by download.xlsx_to_parquet.
+        df = pd.read_csv(pd.io.common.StringIO(make_csv(6000, 20)))
+        for column in ("Start Date", "End Date"):
+            df[column] = pd.to_datetime(df[column], dayfirst=True)
+        df.to_parquet(
+            os.path.join(self.csv_dir, "03JourneyDataExtract.parquet"),
+            index=False,
+        )
+        df, _ = load_clean_data(self.csv_dir)
+        self.assertEqual(len(df), 170)
+        self.assertEqual(
+            df.loc[6001, "start_date"], pd.Timestamp("2016-01-02 08:01")
+        )
+
+    def test_cache(self):
+        expected_df, expected_allnames = load_clean_data(self.csv_dir)
+        cache_dir = os.path.join(self.folder.name, "cache")
+        load_clean_data(self.csv_dir, cache_dir=cache_dir)
+        # One entry per file, except the one lacking station IDs.
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        df, station_allnames = load_clean_data(
+            self.csv_dir, cache_dir=cache_dir
+        )
+        pd.testing.assert_frame_equal(df, expected_df)
+        self.assertEqual(station_allnames, expected_allnames)
+
+        # Changing a file invalidates its entry.
+        with open(
+            os.path.join(self.csv_dir, "01aJourneyDataExtract.csv")
+        ) as f:
+            lines = f.readlines()
+        with open(
+            os.path.join(self.csv_dir, "01aJourneyDataExtract.csv"), "w"
+        ) as f:
+            f.writelines(lines[:11])
+        df, _ = load_clean_data(self.csv_dir, cache_dir=cache_dir)
+        self.assertEqual(len(df), 100)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+        # So does a new version of the cleaning code.
+        with mock.patch("src.clean_data.CACHE_VERSION", CACHE_VERSION + 1):
+            load_clean_data(self.csv_dir, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 5)
+
+    def test_parallel(self):
+        expected_df, expected_allnames = load_clean_data(
+            self.csv_dir, zipfolder=self.zip_dir
+        )
+        df, station_allnames = load_clean_data(
+            self.csv_dir, zipfolder=self.zip_dir, n_jobs=2
+        )
+        pd.testing.assert_frame_equal(df, expected_df)
+        self.assertEqual(station_allnames, expected_allnames)
+
+    def test_iter_clean_data(self):
+        # Overlapping files, whose duplicate trips should only appear once.
+        with open(
+            os.path.join(self.csv_dir, "01dJourneyDataExtract.csv"), "w"
+        ) as f:
+            f.write(make_csv(1050, 20))
+        expected_df, expected_allnames = load_clean_data(self.csv_dir)
+        chunks = list(iter_clean_data(self.csv_dir, max_memory=1))
+        self.assertEqual(len(chunks), 4)
+        df = concat_pieces(chunks).sort_index()
+        pd.testing.assert_frame_equal(df, expected_df)
+
+        chunks = list(
+            iter_clean_data(self.csv_dir, station_allnames=expected_allnames)
+        )
+        self.assertEqual(len(chunks), 1)
+        pd.testing.assert_frame_equal(chunks[0], expected_df)
+
+    def test_parse_timestamps(self):
+        parsed = parse_timestamps(
+            [
+                "01/02/2016 08:05",
+                "01/02/2016 08:05:59",
+                "2016-03-04 10:00",
+                "31/02/2016 10:00",
+                "",
+            ]
+        )
+        expected = pd.DatetimeIndex(
+            [
+                "2016-02-01 08:05",
+                "2016-02-01 08:05:59",
+                "2016-03-04 10:00",
+                "NaT",
+                "NaT",
+            ]
+        )
+        pd.testing.assert_index_equal(parsed, expected)
+
+    def test_clean_datetime_column(self):
+        df = pd.DataFrame(
+            {
+                "start_date": ["01/02/2016 08:05:29", None, "bad"],
+                "end_date": pd.Series([None, None, None], dtype="category"),
+            }
+        )
+        df = clean_datetime_column(df, "start_date")
+        df = clean_datetime_column(df, "end_date")
+        pd.testing.assert_series_equal(
+            df["start_date"],
+            pd.Series(
+                pd.DatetimeIndex(["2016-02-01 08:05", "NaT", "NaT"]),
+                name="start_date",
+            ),
+        )
+        self.assertTrue(df["end_date"].isna().all())
+        self.assertEqual(df["end_date"].dtype, "datetime64[ns]")
+
+    def test_bad_ids(self):
+        # IDs that aren't whole numbers, or don't fit in their types.
+        df = pd.read_csv(pd.io.common.StringIO(make_csv(7000, 30)))
+        df["StartStation Id"] = df["StartStation Id"].astype(object)
+        df.loc[0, "StartStation Id"] = "12.5"
+        df.loc[1, "StartStation Id"] = 40000
+        path = os.path.join(self.csv_dir, "03aJourneyDataExtract.csv")
+        df.to_csv(path, index=False)
+        df, _ = load_clean_data(self.csv_dir)
+        self.assertEqual(len(df), 180)
+        self.assertTrue(df.loc[[7000, 7001], "start_station_id"].isna().all())
+        self.assertEqual(df.loc[7002, "start_station_id"], 1)
+        self.assertEqual(df["start_station_id"].dtype, "Int16")
+
+    def test_canonical_station_names(self):
+        # A file in which station 1 goes by another name.
+        csv = make_csv(7000, 30).replace(
+            STATIONS[1], "River Street: Clerkenwell"
+        )
+        with open(
+            os.path.join(self.csv_dir, "04JourneyDataExtract.csv"), "w"
+        ) as f:
+            f.write(csv)
+        df, station_allnames = load_clean_data(self.csv_dir)
+        self.assertEqual(
+            station_allnames[1], {STATIONS[1], "River Street: Clerkenwell"}
+        )
+        names = df.loc[df["start_station_id"] == 1, "start_station_name"]
+        self.assertEqual(set(names), {STATIONS[1]})
+        # The file lacking station IDs gets them from the names.
+        self.assertEqual(df.loc[3006, "end_station_id"], 1)
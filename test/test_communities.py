@@ -0,0 +1,106 @@
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+
+from src.communities import (
+    _run_louvain,
+    consensus,
+    detect_communities,
+    network_hash,
+    pair_agreement,
+)
+from src.sparse_network import TripNetwork
+
+
+def two_clusters():
+    """Return a network of two groups of stations, with many trips within
+    each group and few between them.
+    """
+    rows = []
+    for group in ((1, 2, 3, 4), (5, 6, 7, 8)):
+        for start in group:
+            for end in group:
+                if start != end:
+                    rows.append((start, end, 50))
+    rows.append((4, 5, 1))
+    trip_counts = pd.DataFrame(
+        rows, columns=["start_station_id", "end_station_id", "trip_count"]
+    )
+    return TripNetwork.from_trip_counts(trip_counts)
+
+
+class TestCommunities(TestCase):
+    def setUp(self):
+        self.network = two_clusters()
+
+    def test_detect_communities(self):
+        for method in ("modularity", "consensus"):
+            df = detect_communities(
+                self.network, seeds=range(4), method=method, max_workers=2
+            )
+            self.assertEqual(list(df["id"]), list(range(1, 9)))
+            self.assertEqual(list(df["partition"]), [0] * 4 + [1] * 4)
+        with self.assertRaises(ValueError):
+            detect_communities(self.network, method="best")
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            expected = detect_communities(
+                self.network,
+                seeds=range(3),
+                max_workers=1,
+                cache_dir=cache_dir,
+            )
+            with mock.patch("src.communities._run_louvain") as run_louvain:
+                df = detect_communities(
+                    self.network,
+                    seeds=range(3),
+                    max_workers=1,
+                    cache_dir=cache_dir,
+                )
+                run_louvain.assert_not_called()
+            pd.testing.assert_frame_equal(df, expected)
+
+    def test_small_networks_run_serially(self):
+        with mock.patch("src.communities.ProcessPoolExecutor") as executor:
+            detect_communities(self.network, seeds=range(3))
+            executor.assert_not_called()
+
+    def test_network_hash(self):
+        self.assertEqual(
+            network_hash(self.network), network_hash(two_clusters())
+        )
+        matrix = self.network.matrix.copy()
+        matrix[0, 1] += 1
+        changed = TripNetwork(matrix, self.network.node_ids)
+        self.assertNotEqual(network_hash(self.network), network_hash(changed))
+
+    def test_consensus(self):
+        a = np.array([0, 0, 1, 1])
+        b = np.array([1, 1, 0, 0])
+        c = np.array([0, 1, 1, 1])
+        self.assertEqual(pair_agreement(a, b), 1.0)
+        self.assertEqual(pair_agreement(a, c), 0.5)
+        self.assertEqual(consensus([c, a, b]), 1)
+
+    def test_modularity_resolution(self):
+        graph = self.network.symmetrised().to_networkx(
+            directed=False, weight="trip_count"
+        )
+        total = graph.size(weight="trip_count")
+        between = graph[4][5]["trip_count"]
+        degrees = np.array(
+            [graph.degree(n, weight="trip_count") for n in range(1, 9)]
+        )
+        for resolution in (0.5, 1.0, 2.0):
+            labels, modularity = _run_louvain(
+                self.network, 0, resolution, "trip_count"
+            )
+            self.assertEqual(list(labels), [0] * 4 + [1] * 4)
+            # Every edge but one is within a community.
+            expected = (total - between) / total - resolution * sum(
+                (degrees[labels == c].sum() / (2 * total)) ** 2 for c in (0, 1)
+            )
+            self.assertAlmostEqual(modularity, expected)
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+from src.pfeffel.download import (
+    MANIFEST_FILENAME,
+    HostRateLimiter,
+    download_file,
+    download_urls,
+)
+
+FILES = {
+    "/usage-stats/{}JourneyDataExtract.csv".format(i): (
+        "Rental Id,Duration\n{},60\n".format(i).encode() * 100
+    )
+    for i in range(10)
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves `server.files`, failing the first `server.failures[path]`
+    requests for a path with a 503, and all requests for a path in
+    `server.statuses`, if there is one, with the status given there. Supports
+    ETags, Range requests and conditional GETs like the TfL server does, and
+    counts the bytes of body it has sent in `server.bytes_sent`.
+    """
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+        if failures:
+            self.send_error(503)
+            return
+        status = getattr(server, "statuses", {}).get(self.path)
+        if status is not None:
+            self.send_error(status)
+            return
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        body = server.files[self.path]
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and if_range in (None, etag):
+            status = 206
+            range_start = int(range_header[len("bytes=") : -1])  # noqa: E203
+            body = body[range_start:]
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+            with server.lock:
+                server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownload(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.files = dict(FILES)
+        self.server.failures = {}
+        self.server.request_count = 0
+        self.server.bytes_sent = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.output_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.output_dir.cleanup()
+
+    def test_download_urls_concurrent(self):
+        urls = [self.base_url + path for path in FILES]
+        fpaths = download_urls(
+            urls, self.output_dir.name, max_workers=4, requests_per_second=None
+        )
+        self.assertEqual(len(fpaths), len(urls))
+        for path, fpath in zip(FILES, fpaths):
+            self.assertEqual(os.path.basename(path), os.path.basename(fpath))
+            with open(fpath, "rb") as f:
+                self.assertEqual(f.read(), FILES[path])
+
+        # A second run finds everything on disk.
+        download_urls(urls, self.output_dir.name, requests_per_second=None)
+        self.assertEqual(self.server.request_count, len(urls))
+
+    def test_download_urls_retries(self):
+        path = next(iter(FILES))
+        self.server.failures[path] = 2
+        fpaths = download_urls(
+            [self.base_url + path],
+            self.output_dir.name,
+            requests_per_second=None,
+            backoff_factor=0,
+        )
+        with open(fpaths[0], "rb") as f:
+            self.assertEqual(f.read(), FILES[path])
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_download_urls_sleep_seconds(self):
+        urls = [self.base_url + path for path in list(FILES)[:3]]
+        start = time.monotonic()
+        with self.assertWarns(DeprecationWarning):
+            fpaths = download_urls(urls, self.output_dir.name, 0.05)
+        # As one request every 0.05 s.
+        self.assertGreaterEqual(time.monotonic() - start, 2 * 0.05)
+        self.assertEqual(len(fpaths), len(urls))
+
+    def test_host_rate_limiter(self):
+        rate_limiter = HostRateLimiter(requests_per_second=50)
+        start = time.monotonic()
+        for _ in range(6):
+            rate_limiter.wait(self.base_url)
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50)
+
+    def test_manifest(self):
+        urls = [self.base_url + path for path in FILES]
+        download_urls(urls, self.output_dir.name, requests_per_second=None)
+        with open(os.path.join(self.output_dir.name, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+        for path, body in FILES.items():
+            entry = manifest[os.path.basename(path)]
+            self.assertTrue(entry["complete"])
+            self.assertEqual(entry["size"], len(body))
+            self.assertEqual(entry["sha256"], hashlib.sha256(body).hexdigest())
+            self.assertIsNotNone(entry["etag"])
+
+    def test_resume_truncated_file(self):
+        path = next(iter(FILES))
+        url = self.base_url + path
+        fpath = download_file(self.output_dir.name, url)
+        # Chop the file in half, as a killed run would leave it.
+        with open(fpath, "rb+") as f:
+            f.truncate(len(FILES[path]) // 2)
+        self.server.bytes_sent = 0
+        download_file(self.output_dir.name, url)
+        with open(fpath, "rb") as f:
+            self.assertEqual(f.read(), FILES[path])
+        self.assertEqual(
+            self.server.bytes_sent, len(FILES[path]) - len(FILES[path]) // 2
+        )
+
+    def test_adopt_file_without_manifest(self):
+        path = next(iter(FILES))
+        fpath = os.path.join(self.output_dir.name, os.path.basename(path))
+        with open(fpath, "wb") as f:
+            f.write(FILES[path][:10])
+        download_file(self.output_dir.name, self.base_url + path)
+        with open(fpath, "rb") as f:
+            self.assertEqual(f.read(), FILES[path])
+        self.assertEqual(self.server.bytes_sent, len(FILES[path]) - 10)
+
+    def test_refresh(self):
+        urls = [self.base_url + path for path in FILES]
+        download_urls(urls, self.output_dir.name, requests_per_second=None)
+        changed_path = next(iter(FILES))
+        self.server.files[changed_path] = b"Republished"
+        self.server.bytes_sent = 0
+        fpaths = download_urls(
+            urls, self.output_dir.name, requests_per_second=None, refresh=True
+        )
+        with open(fpaths[0], "rb") as f:
+            self.assertEqual(f.read(), b"Republished")
+        self.assertEqual(self.server.bytes_sent, len(b"Republished"))
+
+    def test_refresh_range_not_satisfiable(self):
+        path = next(iter(FILES))
+        url = self.base_url + path
+        fpath = download_file(self.output_dir.name, url)
+        self.server.statuses = {path: 416}
+        download_file(self.output_dir.name, url, refresh=True)
+        with open(fpath, "rb") as f:
+            self.assertEqual(f.read(), FILES[path])
+        self.assertFalse(os.path.exists(fpath + ".part"))
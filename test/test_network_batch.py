@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import matplotlib
+import numpy as np
+import pandas as pd
+from test_tile_cache import make_tile
+
+from src.network import BASEMAP_ZOOM
+from src.network_batch import SUMMARY_FILENAME, Slice, run_network_batch
+from src.od_cube import ODCube
+from src.stations import Station, StationRegistry
+from src.tile_cache import TileCache, lonlat_to_tile
+
+matplotlib.use("Agg")
+
+# Two clusters of stations, in the west and the east of central London.
+LOCATIONS = {
+    id: (51.50 + 0.004 * (id % 5), -0.16 + 0.06 * (id // 5) + 0.003 * id)
+    for id in range(1, 11)
+}
+# A station whose location isn't known.
+NO_LOCATION = 99
+
+
+def make_registry():
+    stations = [
+        Station(id, "Station {}".format(id), frozenset(), lat, lon, None, None)
+        for id, (lat, lon) in LOCATIONS.items()
+    ]
+    stations.append(
+        Station(NO_LOCATION, "Nowhere", frozenset(), None, None, None, None)
+    )
+    return StationRegistry(stations)
+
+
+def make_trips(num_trips, seed):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 365 * 24 * 3600, size=num_trips)
+    start_ids = rng.integers(1, 11, size=num_trips)
+    # Most trips stay within their cluster.
+    end_ids = np.where(
+        rng.random(num_trips) < 0.9,
+        (start_ids - 1) // 5 * 5 + rng.integers(1, 6, size=num_trips),
+        rng.integers(1, 11, size=num_trips),
+    )
+    end_ids[:5] = NO_LOCATION
+    return pd.DataFrame(
+        {
+            "start_date": pd.Timestamp("2021-01-01")
+            + pd.to_timedelta(seconds, unit="s"),
+            "start_station_id": pd.array(start_ids, dtype="Int16"),
+            "end_station_id": pd.array(end_ids, dtype="Int16"),
+        }
+    )
+
+
+def seed_tiles(cache):
+    lats = [lat for lat, _ in LOCATIONS.values()]
+    lons = [lon for _, lon in LOCATIONS.values()]
+    x0, y0 = lonlat_to_tile(min(lons) - 0.05, max(lats) + 0.05, BASEMAP_ZOOM)
+    x1, y1 = lonlat_to_tile(max(lons) + 0.05, min(lats) - 0.05, BASEMAP_ZOOM)
+    for x in range(int(x0), int(x1) + 1):
+        for y in range(int(y0), int(y1) + 1):
+            cache._write(BASEMAP_ZOOM, x, y, make_tile(x, y))
+
+
+class TestNetworkBatch(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.df = make_trips(3000, 0)
+        self.tile_cache = TileCache(
+            os.path.join(self.folder.name, "tiles"), url=None, offline=True
+        )
+        seed_tiles(self.tile_cache)
+        patcher = mock.patch(
+            "src.network.get_registry", return_value=make_registry()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_run_network_batch(self):
+        slices = [
+            Slice(
+                "weekday_morning",
+                "Weekday mornings",
+                hours=(7, 8, 9, 10),
+                weekdays=(0, 1, 2, 3, 4),
+            ),
+            Slice("weekends", "Weekends", weekdays=(5, 6), arrows=False),
+        ]
+        output_dir = os.path.join(self.folder.name, "maps")
+        summary = run_network_batch(
+            ODCube.from_trips(self.df),
+            slices,
+            output_dir,
+            max_workers=1,
+            community_kwargs={
+                "max_workers": 1,
+                "cache_dir": os.path.join(self.folder.name, "communities"),
+            },
+            tile_cache=self.tile_cache,
+        )
+        self.assertEqual(
+            sorted(os.listdir(output_dir)),
+            sorted(
+                ["latest_weekday_morning_map.svg", "latest_weekends_map.svg"]
+                + [SUMMARY_FILENAME]
+            ),
+        )
+        with open(os.path.join(output_dir, SUMMARY_FILENAME)) as f:
+            self.assertEqual(json.load(f), summary)
+
+        dates = self.df["start_date"]
+        masks = [
+            dates.dt.hour.isin((7, 8, 9, 10)) & (dates.dt.weekday < 5),
+            dates.dt.weekday >= 5,
+        ]
+        self.assertEqual(len(summary["slices"]), len(slices))
+        for trip_slice, slice_summary, mask in zip(
+            slices, summary["slices"], masks
+        ):
+            df = self.df[mask]
+            located = df[df["end_station_id"] != NO_LOCATION]
+            pairs = located.groupby(
+                ["start_station_id", "end_station_id"]
+            ).size()
+            stations = set(located["start_station_id"]) | set(
+                located["end_station_id"]
+            )
+            self.assertEqual(slice_summary["name"], trip_slice.name)
+            self.assertEqual(slice_summary["num_trips"], len(df))
+            self.assertEqual(slice_summary["num_nodes"], len(stations))
+            self.assertEqual(slice_summary["num_edges"], len(pairs))
+            self.assertGreaterEqual(slice_summary["num_communities"], 2)
@@ -0,0 +1,114 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from src.od_cube import ODCube
+
+
+def make_trips(num_trips, seed):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 3 * 365 * 24 * 3600, size=num_trips)
+    df = pd.DataFrame(
+        {
+            "start_date": pd.Timestamp("2019-01-01")
+            + pd.to_timedelta(seconds, unit="s"),
+            "start_station_id": pd.array(
+                rng.integers(1, 20, size=num_trips), dtype="Int16"
+            ),
+            "end_station_id": pd.array(
+                rng.integers(1, 20, size=num_trips), dtype="Int16"
+            ),
+            "bike_id": rng.integers(0, 100, size=num_trips),
+        }
+    )
+    df.loc[0, "end_station_id"] = pd.NA
+    return df
+
+
+def count_trips(df):
+    return (
+        df.groupby(["start_station_id", "end_station_id"])
+        .size()
+        .rename("trip_count")
+        .reset_index()
+        .astype("int64")
+    )
+
+
+class TestODCube(TestCase):
+    def setUp(self):
+        self.df = make_trips(5000, 0)
+        self.cube = ODCube.from_trips(self.df)
+
+    def assert_same_counts(self, edge_list, df):
+        pd.testing.assert_frame_equal(
+            edge_list.astype("int64"), count_trips(df)
+        )
+
+    def test_edge_list(self):
+        self.assert_same_counts(self.cube.edge_list(), self.df)
+
+        dates = self.df["start_date"]
+        df = self.df[
+            (dates >= "2020-01-01")
+            & (dates < "2021-03-01")
+            & dates.dt.hour.isin((7, 8, 9, 10))
+            & dates.dt.weekday.isin(range(5))
+        ]
+        edge_list = self.cube.edge_list(
+            "2020-01-01",
+            "2021-03-01",
+            hours=(7, 8, 9, 10),
+            weekdays=range(5),
+        )
+        self.assert_same_counts(edge_list, df)
+
+        df = self.df[dates.dt.month.isin((6, 7))]
+        self.assert_same_counts(self.cube.edge_list(months=(6, 7)), df)
+        with self.assertRaises(ValueError):
+            self.cube.edge_list("2020-01-15")
+
+    def test_update_and_save(self):
+        more = make_trips(1000, 1)
+        cube = ODCube.from_trips([self.df.iloc[:2000], self.df.iloc[2000:]])
+        cube.update(more)
+        expected = ODCube.from_trips(pd.concat([self.df, more]))
+        np.testing.assert_array_equal(cube.keys, expected.keys)
+        np.testing.assert_array_equal(cube.counts, expected.counts)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "od_cube.parquet")
+            cube.save(path)
+            loaded = ODCube.load(path)
+        np.testing.assert_array_equal(loaded.keys, cube.keys)
+        np.testing.assert_array_equal(loaded.counts, cube.counts)
+        self.assertEqual(loaded.to_frame()["trip_count"].sum(), 5998)
+
+    def test_save_high_ids(self):
+        # IDs that don't fit in an int16, but do in STATION_BITS.
+        df = self.df.astype({"start_station_id": "Int32"})
+        df.loc[1:10, "start_station_id"] = 40000
+        df.loc[11:20, "end_station_id"] = 32767
+        cube = ODCube.from_trips(df)
+        frame = cube.to_frame()
+        self.assertEqual(frame["start_station_id"].max(), 40000)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "od_cube.parquet")
+            cube.save(path)
+            loaded = ODCube.load(path)
+        np.testing.assert_array_equal(loaded.keys, cube.keys)
+        np.testing.assert_array_equal(loaded.counts, cube.counts)
+
+    def test_out_of_range(self):
+        df = self.df.astype({"start_station_id": "Int32"})
+        df.loc[1, "start_date"] = pd.Timestamp("1900-01-01 08:00")
+        df.loc[2, "start_station_id"] = 70000
+        with self.assertLogs(level="WARNING") as logs:
+            cube = ODCube.from_trips(df)
+        self.assertIn("Leaving out 2 trips", logs.output[0])
+        expected = ODCube.from_trips(self.df.drop(index=[1, 2]))
+        np.testing.assert_array_equal(cube.keys, expected.keys)
+        np.testing.assert_array_equal(cube.counts, expected.counts)
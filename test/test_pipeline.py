@@ -0,0 +1,82 @@
+import os
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+from unittest import TestCase, mock
+
+import pandas as pd
+from test_clean_data import write_data_folder
+from test_download import StandInHandler
+
+from src.clean_data import load_clean_data
+from src.pipeline import DOWNLOADER_THREAD_NAME, stream_clean_data
+
+
+class TestPipeline(TestCase):
+    def setUp(self):
+        # Serve the files of a data folder, as the TfL server would.
+        self.source = tempfile.TemporaryDirectory()
+        csv_dir, zip_dir = write_data_folder(self.source.name)
+        files = {}
+        for folder in (csv_dir, zip_dir):
+            for fname in os.listdir(folder):
+                with open(os.path.join(folder, fname), "rb") as f:
+                    files["/usage-stats/" + fname] = f.read()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.files = files
+        self.server.failures = {}
+        self.server.request_count = 0
+        self.server.bytes_sent = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        base_url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.urls = [base_url + path for path in sorted(files)]
+        self.expected = load_clean_data(csv_dir, zipfolder=zip_dir)
+        self.output_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.source.cleanup()
+        self.output_dir.cleanup()
+
+    def test_stream_clean_data(self):
+        df, station_allnames = stream_clean_data(
+            csv_urls=[url for url in self.urls if url.endswith(".csv")],
+            zip_urls=[url for url in self.urls if url.endswith(".zip")],
+            csv_dir=os.path.join(self.output_dir.name, "bike_data"),
+            zip_dir=os.path.join(self.output_dir.name, "bike_zips"),
+            max_parse_workers=2,
+            max_pending=1,
+            requests_per_second=None,
+        )
+        expected_df, expected_allnames = self.expected
+        columns = [c for c in df.columns if c != "filename"]
+        pd.testing.assert_frame_equal(df[columns], expected_df[columns])
+        self.assertEqual(station_allnames, expected_allnames)
+
+    def test_failing_parse(self):
+        with mock.patch(
+            "src.pipeline.load_data_file", side_effect=ValueError("Garbled")
+        ):
+            with self.assertRaises(ValueError):
+                stream_clean_data(
+                    csv_urls=self.urls,
+                    zip_urls=[],
+                    csv_dir=os.path.join(self.output_dir.name, "bike_data"),
+                    zip_dir=os.path.join(self.output_dir.name, "bike_zips"),
+                    max_parse_workers=1,
+                    max_pending=1,
+                    requests_per_second=None,
+                )
+        # The downloader stops, rather than waiting for room on the queue.
+        downloaders = [
+            thread
+            for thread in threading.enumerate()
+            if thread.name == DOWNLOADER_THREAD_NAME
+        ]
+        for thread in downloaders:
+            thread.join(timeout=10)
+            self.assertFalse(thread.is_alive())
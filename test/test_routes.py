@@ -0,0 +1,435 @@
+import asyncio
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+from urllib.parse import parse_qs, urlparse
+
+from src.routes import (
+    PLANS,
+    RouteFetcher,
+    RouteStore,
+    closest_plan,
+    fetch_trip_routes,
+)
+from src.trip import Trip
+
+# The time of each plan's route, in seconds, as returned by the stand-in.
+PLAN_TIMES = {
+    "balanced": 600,
+    "fastest": 400,
+    "quietest": 900,
+    "shortest": 500,
+}
+
+
+class JourneyHandler(BaseHTTPRequestHandler):
+    """Stands in for the CycleStreets journey API, failing the first
+    `server.failures[plan]` requests for a plan with a 503. Answers requests
+    for the itinerarypoints in `server.errors` with that status, or with
+    that error message if it's a string. Keeps the most requests it has had
+    in flight at once in `server.max_in_flight`.
+    """
+
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        plan = query["plan"][0]
+        with server.lock:
+            server.request_count += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failures = server.failures.get(plan, 0)
+            if failures:
+                server.failures[plan] = failures - 1
+        time.sleep(0.05)
+        with server.lock:
+            server.in_flight -= 1
+        error = server.errors.get(query["itinerarypoints"][0])
+        if failures:
+            self.send_error(503)
+            return
+        if isinstance(error, int):
+            self.send_error(error)
+            return
+        if error is not None:
+            self.send_json({"error": error})
+            return
+        self.send_json(
+            {
+                "marker": [
+                    {
+                        "@attributes": {
+                            "plan": plan,
+                            "time": str(PLAN_TIMES[plan]),
+                            "itinerarypoints": query["itinerarypoints"][0],
+                        }
+                    }
+                ]
+            }
+        )
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def plan_routes(start_id, end_id):
+    return {
+        plan: {"plan": plan, "time": str(t), "from": start_id, "to": end_id}
+        for plan, t in PLAN_TIMES.items()
+    }
+
+
+def make_trip(trip_id, start_id, end_id, duration):
+    def station(station_id):
+        return {
+            "name": str(station_id),
+            "id": station_id,
+            "latitude": 51.5 + station_id / 100,
+            "longitude": -0.1 - station_id / 100,
+        }
+
+    return Trip.from_fields(
+        bike_id=7,
+        trip_id=trip_id,
+        init_station=station(start_id),
+        end_station=station(end_id),
+        bike=7,
+        duration=duration,
+        date={},
+    )
+
+
+class TestRoutes(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), JourneyHandler)
+        self.server.failures = {}
+        self.server.errors = {}
+        self.server.request_count = 0
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/api/journey.json".format(
+            self.server.server_address[1]
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault("requests_per_second", None)
+        kwargs.setdefault("backoff_factor", 0.01)
+        return RouteFetcher("KEY", url=self.url, **kwargs)
+
+    def test_closest_plan(self):
+        routes = {plan: {"time": str(t)} for plan, t in PLAN_TIMES.items()}
+        self.assertEqual(closest_plan(routes, 420)["time"], "400")
+        self.assertEqual(closest_plan(routes, 800)["time"], "900")
+        # Ties go to the earliest plan.
+        self.assertEqual(closest_plan(routes, 550)["time"], "600")
+
+    def test_fetch_routes(self):
+        journeys = [
+            ((51.5, -0.1), (51.6, -0.2), 420),
+            ((51.6, -0.2), (51.5, -0.1), 2000),
+        ]
+        with self.fetcher() as fetcher:
+            routes = fetcher.fetch_routes(journeys)
+        self.assertEqual(self.server.request_count, 2 * len(PLANS))
+        self.assertEqual(
+            [route["plan"] for route in routes], ["fastest", "quietest"]
+        )
+        self.assertEqual(routes[0]["itinerarypoints"], "-0.1,51.5|-0.2,51.6")
+        # The plans of both journeys are all fetched at once.
+        self.assertEqual(self.server.max_in_flight, 2 * len(PLANS))
+
+    def test_fetch_routes_in_running_loop(self):
+        # As when called from a Jupyter notebook.
+        async def fetch():
+            with self.fetcher() as fetcher:
+                return fetcher.fetch_routes(
+                    [((51.5, -0.1), (51.6, -0.2), 420)]
+                )
+
+        (route,) = asyncio.run(fetch())
+        self.assertEqual(route["plan"], "fastest")
+
+    def test_max_concurrent(self):
+        journeys = [((51.5, -0.1), (51.6, -0.2), 420)] * 3
+        with self.fetcher(max_concurrent=2) as fetcher:
+            fetcher.fetch_routes(journeys)
+        self.assertLessEqual(self.server.max_in_flight, 2)
+
+    def test_requests_per_second(self):
+        journeys = [((51.5, -0.1), (51.6, -0.2), 420)] * 2
+        start = time.monotonic()
+        with self.fetcher(requests_per_second=20) as fetcher:
+            fetcher.fetch_routes(journeys)
+        # Eight requests, at least 1/20 s apart.
+        self.assertGreaterEqual(time.monotonic() - start, 7 / 20)
+
+    def test_retries(self):
+        self.server.failures = {"fastest": 2}
+        with self.fetcher(max_retries=2) as fetcher:
+            (route,) = fetcher.fetch_routes([((51.5, -0.1), (51.6, -0.2), 0)])
+        self.assertEqual(route["plan"], "fastest")
+        self.assertEqual(self.server.request_count, len(PLANS) + 2)
+
+    def test_too_many_failures(self):
+        self.server.failures = {"quietest": 3}
+        with self.fetcher(max_retries=2) as fetcher:
+            with self.assertLogs(level="WARNING"):
+                routes = fetcher.fetch_routes(
+                    [((51.5, -0.1), (51.6, -0.2), 0)]
+                )
+        self.assertEqual(routes, [None])
+
+    def test_unroutable_pairs(self):
+        self.server.errors = {
+            "-0.2,51.6|-0.1,51.5": 400,
+            "-0.3,51.7|-0.1,51.5": "Unknown location",
+        }
+        journeys = [
+            ((51.5, -0.1), (51.6, -0.2), 420),
+            ((51.5, -0.1), (51.6, -0.2), 2000),
+            ((51.6, -0.2), (51.5, -0.1), 420),
+            ((51.7, -0.3), (51.5, -0.1), 420),
+        ]
+        with self.fetcher() as fetcher:
+            with self.assertLogs(level="WARNING") as logs:
+                routes = fetcher.fetch_routes(journeys)
+        # The other journeys get their routes.
+        self.assertEqual(
+            [route and route["plan"] for route in routes],
+            ["fastest", "quietest", None, None],
+        )
+        self.assertTrue(
+            any("Unknown location" in line for line in logs.output)
+        )
+
+    def test_fetch_trip_routes(self):
+        trips = [
+            make_trip(1, 1, 2, 420),
+            make_trip(2, 3, 3, 420),
+            make_trip(3, 2, 1, 2000),
+        ]
+        with tempfile.TemporaryDirectory() as route_dir:
+            with self.fetcher() as fetcher:
+                num_fetched = fetch_trip_routes(trips, fetcher, route_dir)
+                self.assertEqual(num_fetched, 2)
+                self.assertEqual(
+                    [trip.route.get("plan") for trip in trips],
+                    ["fastest", None, "quietest"],
+                )
+                self.assertEqual(len(os.listdir(route_dir)), 3)
+                with open(os.path.join(route_dir, "7_3.json")) as f:
+                    self.assertEqual(json.load(f)["plan"], "quietest")
+
+                # Routes already cached aren't fetched again.
+                request_count = self.server.request_count
+                trips = [make_trip(1, 1, 2, 420), make_trip(4, 1, 2, 900)]
+                num_fetched = fetch_trip_routes(trips, fetcher, route_dir)
+                self.assertEqual(num_fetched, 1)
+                self.assertEqual(
+                    self.server.request_count, request_count + len(PLANS)
+                )
+                self.assertEqual(trips[0].route["plan"], "fastest")
+
+    def test_fetch_trip_routes_unroutable(self):
+        trips = [make_trip(1, 1, 2, 420), make_trip(2, 2, 1, 420)]
+        start, end = (trip.init_station for trip in trips)
+        self.server.errors = {
+            "{},{}|{},{}".format(
+                end["longitude"],
+                end["latitude"],
+                start["longitude"],
+                start["latitude"],
+            ): 400
+        }
+        with tempfile.TemporaryDirectory() as route_dir:
+            with self.fetcher() as fetcher:
+                with self.assertLogs(level="WARNING"):
+                    num_fetched = fetch_trip_routes(trips, fetcher, route_dir)
+                self.assertEqual(num_fetched, 1)
+                self.assertEqual(trips[0].route["plan"], "fastest")
+                self.assertEqual(trips[1].route, {})
+                # The trip that failed isn't cached, and is tried again.
+                self.assertEqual(os.listdir(route_dir), ["7_1.json"])
+                self.server.errors = {}
+                num_fetched = fetch_trip_routes(trips, fetcher, route_dir)
+                self.assertEqual(num_fetched, 1)
+                self.assertEqual(trips[1].route["plan"], "fastest")
+
+    def test_fetch_trip_routes_with_store(self):
+        # Three trips between the same stations, one back, and one circular.
+        trips = [
+            make_trip(1, 1, 2, 420),
+            make_trip(2, 1, 2, 2000),
+            make_trip(3, 1, 2, 550),
+            make_trip(4, 2, 1, 420),
+            make_trip(5, 3, 3, 420),
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "routes.sqlite")
+            with self.fetcher() as fetcher, RouteStore(path) as store:
+                num_fetched = fetch_trip_routes(trips, fetcher, store=store)
+                self.assertEqual(num_fetched, 2)
+                self.assertEqual(self.server.request_count, 2 * len(PLANS))
+                self.assertEqual(
+                    [trip.route.get("plan") for trip in trips],
+                    ["fastest", "quietest", "balanced", "fastest", None],
+                )
+                self.assertEqual(len(store), 2)
+
+                # Another trip between the same stations costs no requests.
+                trips = [make_trip(6, 2, 1, 900)]
+                num_fetched = fetch_trip_routes(trips, fetcher, store=store)
+                self.assertEqual(num_fetched, 0)
+                self.assertEqual(self.server.request_count, 2 * len(PLANS))
+                self.assertEqual(trips[0].route["plan"], "quietest")
+            self.assertEqual(os.listdir(tmpdir), ["routes.sqlite"])
+
+    def test_fetch_trip_routes_saves_each_pair(self):
+        trips = [
+            make_trip(1, 1, 2, 420),
+            make_trip(2, 2, 1, 420),
+            make_trip(3, 1, 3, 420),
+        ]
+        start, end = trips[1].init_station, trips[1].end_station
+        self.server.errors = {
+            "{},{}|{},{}".format(
+                start["longitude"],
+                start["latitude"],
+                end["longitude"],
+                end["latitude"],
+            ): 400
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "routes.sqlite")
+            with self.fetcher() as fetcher, RouteStore(path) as store:
+                put = store.put
+
+                def put_then_fail(*args):
+                    put(*args)
+                    raise RuntimeError("Interrupted")
+
+                # The routes fetched before the interruption are kept.
+                with mock.patch.object(store, "put", put_then_fail):
+                    with self.assertRaises(RuntimeError):
+                        fetch_trip_routes(trips, fetcher, store=store)
+                self.assertGreaterEqual(len(store), 1)
+
+                # The pair that fails is left out, and the others stored.
+                with self.assertLogs(level="WARNING"):
+                    num_fetched = fetch_trip_routes(
+                        trips, fetcher, store=store
+                    )
+                self.assertEqual(num_fetched, 1)
+                self.assertEqual(len(store), 2)
+                self.assertEqual(
+                    [trip.route.get("plan") for trip in trips],
+                    ["fastest", None, "fastest"],
+                )
+
+    def test_trip_get_route_with_fetcher(self):
+        trips = [make_trip(1, 1, 2, 420), make_trip(2, 1, 2, 2000)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "routes.sqlite")
+            with self.fetcher() as fetcher, RouteStore(path) as store:
+                for trip in trips:
+                    trip.get_route("KEY", store, fetcher)
+        self.assertEqual(self.server.request_count, len(PLANS))
+        self.assertEqual(
+            [trip.route["plan"] for trip in trips], ["fastest", "quietest"]
+        )
+        # Longitude first, from the start station.
+        self.assertTrue(
+            trips[0].route["itinerarypoints"].startswith("-0.11,51.51|")
+        )
+
+
+class TestRouteStore(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "routes.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_put_and_route(self):
+        with RouteStore(self.path) as store:
+            self.assertIsNone(store.route(1, 2, 420))
+            store.put(1, 2, plan_routes(1, 2))
+            self.assertEqual(store.plan_routes(1, 2), plan_routes(1, 2))
+            self.assertEqual(store.route(1, 2, 420)["plan"], "fastest")
+            self.assertEqual(store.route(1, 2, 800)["plan"], "quietest")
+            # The direction matters.
+            self.assertIsNone(store.route(2, 1, 420))
+
+        # Routes are kept in the file.
+        with RouteStore(self.path) as store:
+            self.assertEqual(store.plan_routes(1, 2), plan_routes(1, 2))
+
+    def test_missing_pairs(self):
+        with RouteStore(self.path) as store:
+            store.put_many(
+                [((1, 2), plan_routes(1, 2)), ((2, 3), plan_routes(2, 3))]
+            )
+            # Pairs without all the plans count as missing.
+            store.put(3, 4, {"fastest": plan_routes(3, 4)["fastest"]})
+            self.assertIsNone(store.plan_routes(3, 4))
+            self.assertEqual(len(store), 2)
+            self.assertEqual(
+                store.missing_pairs([(3, 4), (1, 2), (2, 1), (2, 3)]),
+                [(3, 4), (2, 1)],
+            )
+
+    def test_concurrent_writers(self):
+        def write(first):
+            with RouteStore(self.path, timeout=10) as store:
+                for start_id in range(first, first + 20):
+                    store.put(start_id, 0, plan_routes(start_id, 0))
+
+        threads = [
+            threading.Thread(target=write, args=(first,))
+            for first in range(0, 80, 20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with RouteStore(self.path) as store:
+            self.assertEqual(len(store), 80)
+
+    def test_pickle(self):
+        with RouteStore(self.path) as store:
+            store.put(1, 2, plan_routes(1, 2))
+            copy = pickle.loads(pickle.dumps(store))
+            self.assertEqual(copy.route(1, 2, 420)["plan"], "fastest")
+            copy.close()
+
+    def test_trip_get_route(self):
+        with RouteStore(self.path) as store:
+            store.put(1, 2, plan_routes(1, 2))
+            trip = make_trip(1, 1, 2, 2000)
+            trip.get_route("KEY", store)
+            self.assertEqual(trip.route["plan"], "quietest")
+            trip = make_trip(2, 3, 3, 2000)
+            trip.get_route("KEY", store)
+            self.assertEqual(trip.route, {})
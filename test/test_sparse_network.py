@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from src.sparse_network import TripNetwork
+
+
+class TestTripNetwork(TestCase):
+    def setUp(self):
+        self.trip_counts = pd.DataFrame(
+            {
+                "start_station_id": [10, 10, 20, 30, 30, 40],
+                "end_station_id": [20, 10, 10, 10, 40, 30],
+                "trip_count": [5, 2, 3, 100, 1, 7],
+            }
+        )
+        self.network = TripNetwork.from_trip_counts(self.trip_counts)
+        self.graph = nx.from_pandas_edgelist(
+            self.trip_counts,
+            source="start_station_id",
+            target="end_station_id",
+            edge_attr="trip_count",
+            create_using=nx.DiGraph,
+        )
+
+    def test_strength(self):
+        np.testing.assert_array_equal(self.network.node_ids, [10, 20, 30, 40])
+        expected = dict(self.graph.degree(weight="trip_count"))
+        self.assertEqual(
+            dict(zip(self.network.node_ids, self.network.strength())),
+            expected,
+        )
+        self.assertEqual(self.network.total_trips(), 118)
+
+    def test_threshold(self):
+        network = self.network.threshold(0.05)
+        np.testing.assert_array_equal(network.node_ids, [10, 30, 40])
+        sources, targets, counts = network.edges()
+        self.assertEqual(
+            sorted(zip(sources, targets, counts)), [(30, 10, 100), (40, 30, 7)]
+        )
+        network = self.network.without_self_loops()
+        self.assertEqual(network.num_edges, 5)
+        self.assertEqual(network.matrix.diagonal().sum(), 0)
+
+    def test_to_networkx(self):
+        graph = self.network.to_networkx()
+        self.assertEqual(
+            nx.to_dict_of_dicts(graph), nx.to_dict_of_dicts(self.graph)
+        )
+        undirected = self.network.symmetrised().to_networkx(directed=False)
+        self.assertEqual(undirected.edges[10, 20]["trip_count"], 8)
+        self.assertEqual(undirected.edges[30, 40]["trip_count"], 8)
+        self.assertEqual(undirected.edges[10, 10]["trip_count"], 4)
+        self.assertEqual(undirected.number_of_edges(), 4)
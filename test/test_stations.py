@@ -0,0 +1,84 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import pandas as pd
+from test_clean_data import STATIONS, make_csv
+
+from src.clean_data import load_clean_data
+from src.stations import (
+    StationRegistry,
+    build_registry,
+    build_registry_from_trip_store,
+    get_registry,
+)
+from src.trip_store import write_trip_store
+
+STATION_COORDS = {
+    "1": {"lat": 51.529163, "lon": -0.10997},
+    "2": {"lat": 51.499606, "lon": -0.197574},
+    "4": {"lat": 51.521283, "lon": -0.084605},
+}
+
+
+class TestStations(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        csv = make_csv(1000, 60)
+        alias_csv = make_csv(2000, 60).replace(
+            STATIONS[1], "River Street: Clerkenwell"
+        )
+        for fname, contents in (("01.csv", csv), ("02.csv", alias_csv)):
+            with open(os.path.join(self.folder.name, fname), "w") as f:
+                f.write(contents)
+        df, station_allnames = load_clean_data(self.folder.name)
+        self.df = df
+        self.registry = build_registry(df, station_allnames, STATION_COORDS)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_lookups(self):
+        self.assertEqual(len(self.registry), 4)
+        self.assertEqual(self.registry.name(1), STATIONS[1])
+        self.assertEqual(self.registry.name(1.0), STATIONS[1])
+        self.assertEqual(self.registry.id_of("River Street: Clerkenwell"), 1)
+        self.assertEqual(self.registry.location(2), (51.499606, -0.197574))
+        self.assertFalse(self.registry.has_location(3))
+        self.assertFalse(self.registry.has_location(pd.NA))
+        self.assertIsNone(self.registry.name(4))
+        self.assertEqual(
+            self.registry[3].first_seen,
+            self.df.loc[self.df["start_station_id"] == 3, "start_date"].min(),
+        )
+
+    def test_save_load(self):
+        path = os.path.join(self.folder.name, "registry.pickle")
+        self.registry.save(path)
+        registry = StationRegistry.load(path)
+        self.assertEqual(list(registry), list(self.registry))
+
+    def test_build_from_trip_store(self):
+        root = os.path.join(self.folder.name, "trips")
+        write_trip_store(self.df, root)
+        registry = build_registry_from_trip_store(root, STATION_COORDS)
+        for station in self.registry:
+            self.assertEqual(registry.name(station.id), station.name)
+            self.assertEqual(
+                registry.location(station.id),
+                self.registry.location(station.id),
+            )
+            self.assertEqual(
+                registry[station.id].first_seen, station.first_seen
+            )
+
+        # get_registry builds it when there is none saved, and saves it.
+        path = os.path.join(self.folder.name, "registry.pickle")
+        registry = get_registry(path, root)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(registry.name(1), STATIONS[1])
+        with self.assertRaises(FileNotFoundError):
+            get_registry(
+                os.path.join(self.folder.name, "missing.pickle"),
+                os.path.join(self.folder.name, "missing"),
+            )
@@ -0,0 +1,148 @@
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+from test_download import StandInHandler
+
+from src.tile_cache import TileCache, lonlat_to_tile, tile_url
+
+ZOOM = 12
+# London, as in network.MAP_BOUNDARIES.
+WEST, EAST, SOUTH, NORTH = -0.223, 0.005, 51.46, 51.555
+
+
+def make_tile(x, y):
+    """Return a PNG tile of one colour, depending on its column and row."""
+    image = Image.new("RGB", (256, 256), (x % 256, y % 256, 0))
+    data = io.BytesIO()
+    image.save(data, format="PNG")
+    return data.getvalue()
+
+
+def london_tiles():
+    x0, y0 = lonlat_to_tile(WEST, NORTH, ZOOM)
+    x1, y1 = lonlat_to_tile(EAST, SOUTH, ZOOM)
+    return {
+        (x, y): make_tile(x, y)
+        for x in range(int(x0), int(x1) + 1)
+        for y in range(int(y0), int(y1) + 1)
+    }
+
+
+class TestTileCache(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.tiles = london_tiles()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.files = {
+            "/{}/{}/{}.png".format(ZOOM, x, y): data
+            for (x, y), data in self.tiles.items()
+        }
+        self.server.failures = {}
+        self.server.request_count = 0
+        self.server.bytes_sent = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png".format(
+            self.server.server_port
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.folder.cleanup()
+
+    def test_fetch_once(self):
+        cache = TileCache(os.path.join(self.folder.name, "tiles"), self.url)
+        cache.seed(WEST, SOUTH, EAST, NORTH, ZOOM)
+        self.assertEqual(self.server.request_count, len(self.tiles))
+        image = cache.mosaic(WEST, SOUTH, EAST, NORTH, ZOOM)
+        self.assertEqual(self.server.request_count, len(self.tiles))
+
+        # The corners of the image are from the corner tiles.
+        (x0, y0), (x1, y1) = min(self.tiles), max(self.tiles)
+        np.testing.assert_array_equal(image[0, 0], [x0 % 256, y0 % 256, 0])
+        np.testing.assert_array_equal(image[-1, -1], [x1 % 256, y1 % 256, 0])
+        # The image keeps the resolution of the tiles, in which a degree of
+        # latitude near London has 1 / cos(51.5) times the pixels of a degree
+        # of longitude.
+        height, width, _ = image.shape
+        aspect = (width / (EAST - WEST)) / (height / (NORTH - SOUTH))
+        self.assertAlmostEqual(aspect, np.cos(np.radians(51.5)), 2)
+
+    def test_offline(self):
+        cache = TileCache(
+            os.path.join(self.folder.name, "tiles"), self.url, offline=True
+        )
+        x, y = min(self.tiles)
+        with self.assertRaises(FileNotFoundError):
+            cache.get(ZOOM, x, y)
+        self.assertEqual(self.server.request_count, 0)
+
+    def test_tile_provider(self):
+        class Provider:
+            """Stands in for an xyzservices.TileProvider."""
+
+            def __init__(self, url):
+                self.url = url
+
+            def build_url(self, api_key="none"):
+                return self.url + "?api_key=" + api_key
+
+        url = "https://tiles.example.com/{z}/{x}/{y}.png"
+        self.assertEqual(tile_url(url), url)
+        self.assertEqual(
+            tile_url(Provider(url), api_key="KEY"), url + "?api_key=KEY"
+        )
+        cache = TileCache(self.folder.name, Provider(url))
+        self.assertEqual(cache.url, url + "?api_key=none")
+
+    def test_no_url(self):
+        cache = TileCache(os.path.join(self.folder.name, "tiles"), url=None)
+        x, y = min(self.tiles)
+        with self.assertRaises(FileNotFoundError):
+            cache.get(ZOOM, x, y)
+
+    def test_seed(self):
+        source = os.path.join(self.folder.name, "source")
+        for (x, y), data in self.tiles.items():
+            os.makedirs(os.path.join(source, str(ZOOM), str(x)), exist_ok=True)
+            with open(
+                os.path.join(source, str(ZOOM), str(x), "{}.png".format(y)),
+                "wb",
+            ) as f:
+                f.write(data)
+        cache = TileCache(
+            os.path.join(self.folder.name, "from_dir"), offline=True
+        )
+        self.assertEqual(cache.seed_from_directory(source), len(self.tiles))
+        cache.mosaic(WEST, SOUTH, EAST, NORTH, ZOOM)
+
+        mbtiles = os.path.join(self.folder.name, "london.mbtiles")
+        with sqlite3.connect(mbtiles) as connection:
+            connection.execute(
+                "CREATE TABLE tiles (zoom_level integer, tile_column integer, "
+                "tile_row integer, tile_data blob)"
+            )
+            connection.executemany(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                [
+                    (ZOOM, x, 2**ZOOM - 1 - y, data)
+                    for (x, y), data in self.tiles.items()
+                ],
+            )
+        cache = TileCache(
+            os.path.join(self.folder.name, "from_mbtiles"), offline=True
+        )
+        self.assertEqual(cache.seed_from_mbtiles(mbtiles), len(self.tiles))
+        for (x, y), data in self.tiles.items():
+            self.assertEqual(cache.get(ZOOM, x, y), data)
+        self.assertEqual(self.server.request_count, 0)
@@ -1,10 +1,14 @@
 import json
+import os
+import tempfile
 from unittest import TestCase
 
 import folium
+from test_clean_data import make_csv
 
 from src.clean_data import load_clean_data
-from src.trip import Trip
+from src.stations import build_registry
+from src.trip import Trip, TripCollection
 
 
 class TestTrip(TestCase):
@@ -50,3 +54,53 @@ class TestTrip(TestCase):
 
         f = "map_trip.html"
         map.save(f)
+
+
+class TestTripCollection(TestCase):
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(
+                os.path.join(folder, "01JourneyDataExtract.csv"), "w"
+            ) as f:
+                f.write(make_csv(1000, 30))
+            self.data, station_allnames = load_clean_data(folder)
+        self.stations = {
+            str(id): {"lat": 51.5 + id / 100, "lon": -0.1 - id / 100}
+            for id in (1, 2, 3)
+        }
+        self.registry = build_registry(
+            self.data, station_allnames, self.stations
+        )
+
+    def assert_same_trip(self, trip, expected):
+        for attribute in (
+            "init_station",
+            "end_station",
+            "bike",
+            "duration",
+            "date",
+            "circular",
+            "route",
+            "bike_id",
+            "trip_id",
+        ):
+            self.assertEqual(
+                getattr(trip, attribute), getattr(expected, attribute)
+            )
+
+    def test_trips(self):
+        for station_data in (self.stations, self.registry):
+            trips = TripCollection(self.data, 105, station_data)
+            self.assertEqual(len(trips), 30)
+            for trip, trip_id in zip(trips, self.data.index):
+                expected = Trip(self.data, 105, trip_id, station_data)
+                self.assert_same_trip(trip, expected)
+            self.assertIs(trips[3], trips[3])
+            # Rental 1008 starts and ends at station 1.
+            self.assertTrue(trips[8].circular)
+            self.assertFalse(trips[0].circular)
+
+    def test_missing_station(self):
+        del self.stations["3"]
+        with self.assertRaises(KeyError):
+            TripCollection(self.data, 105, self.stations)
@@ -0,0 +1,60 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from test_clean_data import write_data_folder
+
+from src.clean_data import load_clean_data
+from src.trip_arrays import NA_VALUE, load_trip_arrays, write_trip_arrays
+
+
+def count_bike_trips(directory, bike_id):
+    arrays = load_trip_arrays(directory, columns=["bike_id"])
+    return int((arrays["bike_id"] == bike_id).sum())
+
+
+class TestTripArrays(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        csv_dir, _ = write_data_folder(self.folder.name)
+        self.df, _ = load_clean_data(csv_dir)
+        self.df.loc[1000, "bike_id"] = pd.NA
+        self.directory = os.path.join(self.folder.name, "arrays")
+        write_trip_arrays(self.df, self.directory)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_load_trip_arrays(self):
+        arrays = load_trip_arrays(self.directory)
+        self.assertEqual(len(arrays), len(self.df))
+        self.assertIsInstance(arrays["start_date"], np.memmap)
+        np.testing.assert_array_equal(arrays["rental_id"], self.df.index)
+        np.testing.assert_array_equal(
+            arrays["end_date"], self.df["end_date"].to_numpy()
+        )
+        self.assertEqual(arrays["bike_id"][0], NA_VALUE)
+
+        df = arrays.to_frame(["start_station_id", "end_station_id"])
+        for column in df.columns:
+            self.assertTrue(
+                np.shares_memory(df[column].to_numpy(), arrays[column])
+            )
+        np.testing.assert_array_equal(
+            df["end_station_id"], self.df["end_station_id"]
+        )
+
+    def test_workers(self):
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            counts = list(
+                executor.map(
+                    count_bike_trips,
+                    [self.directory] * 2,
+                    [101, 102],
+                )
+            )
+        expected = [(self.df["bike_id"] == b).sum() for b in (101, 102)]
+        self.assertEqual(counts, expected)
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from src.trip_query import TripIndex
+
+
+class TestTripIndex(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        seconds = rng.integers(0, 10 * 365 * 24 * 3600, size=2000)
+        start_dates = pd.Timestamp("2012-01-01") + pd.to_timedelta(
+            seconds, unit="s"
+        )
+        self.df = pd.DataFrame(
+            {
+                "start_date": start_dates,
+                "bike_id": rng.integers(0, 100, size=2000),
+            },
+            index=pd.RangeIndex(2000, name="rental_id"),
+        )
+        self.df.loc[[3, 1500], "start_date"] = pd.NaT
+        self.index = TripIndex(self.df)
+
+    def test_calendar_columns(self):
+        dates = self.index.df["start_date"].dt
+        dated = slice(0, self.index.num_dated)
+        for column, expected in (
+            (self.index.hour, dates.hour),
+            (self.index.weekday, dates.weekday),
+            (self.index.day, dates.day),
+            (self.index.month, dates.month),
+            (self.index.year, dates.year),
+        ):
+            np.testing.assert_array_equal(column[dated], expected[dated])
+        self.assertEqual(self.index.num_dated, 1998)
+
+    def test_query(self):
+        start = pd.Timestamp("2021-01-01")
+        end = pd.Timestamp("2022-01-01")
+        df = self.index.query(
+            start, end, hours=range(7, 11), weekdays=range(5)
+        )
+        dates = self.df["start_date"]
+        expected = self.df[
+            (dates >= start)
+            & (dates < end)
+            & dates.dt.hour.isin(range(7, 11))
+            & dates.dt.weekday.isin(range(5))
+        ]
+        self.assertGreater(len(expected), 0)
+        pd.testing.assert_frame_equal(df.sort_index(), expected)
+
+        df = self.index.query(weekdays=(5, 6), months=(12,))
+        expected = self.df[
+            dates.dt.weekday.isin((5, 6)) & (dates.dt.month == 12)
+        ]
+        pd.testing.assert_frame_equal(df.sort_index(), expected)
+        self.assertEqual(len(self.index.query()), 1998)
@@ -0,0 +1,64 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import pandas as pd
+from test_clean_data import make_csv
+
+from src.clean_data import load_clean_data
+from src.trip_store import read_trips, write_trip_store
+
+
+class TestTripStore(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        csv_dir = os.path.join(self.folder.name, "bike_data")
+        os.makedirs(csv_dir)
+        for month in (1, 2, 3):
+            csv = make_csv(1000 * month, 60).replace(
+                "/01/2016", "/{:02d}/2016".format(month)
+            )
+            fname = "{:02d}JourneyDataExtract.csv".format(month)
+            with open(os.path.join(csv_dir, fname), "w") as f:
+                f.write(csv)
+        self.df, _ = load_clean_data(csv_dir)
+        self.root = os.path.join(self.folder.name, "trips")
+        write_trip_store(self.df, self.root)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_partitions(self):
+        self.assertEqual(os.listdir(self.root), ["year=2016"])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.root, "year=2016"))),
+            ["month=1", "month=2", "month=3"],
+        )
+
+    def test_read_trips(self):
+        df = read_trips(self.root)
+        pd.testing.assert_frame_equal(df, self.df)
+
+        start = pd.Timestamp("2016-02-10")
+        end = pd.Timestamp("2016-03-05 08:30")
+        df = read_trips(
+            self.root, start, end, columns=["start_date", "bike_id"]
+        )
+        expected = self.df[
+            (self.df["start_date"] >= start) & (self.df["start_date"] < end)
+        ][["start_date", "bike_id"]]
+        self.assertGreater(len(expected), 0)
+        pd.testing.assert_frame_equal(df, expected)
+
+    def test_append_chunks(self):
+        root = os.path.join(self.folder.name, "chunked")
+        write_trip_store([self.df.iloc[:50], self.df.iloc[50:100]], root)
+        write_trip_store([self.df.iloc[100:]], root, overwrite=False)
+        pd.testing.assert_frame_equal(read_trips(root), self.df)
+
+    def test_append_same_months(self):
+        root = os.path.join(self.folder.name, "appended")
+        for i in range(3):
+            # Each append has trips of all three months.
+            write_trip_store(self.df.iloc[i::3], root, overwrite=False)
+        pd.testing.assert_frame_equal(read_trips(root), self.df)